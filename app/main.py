@@ -2,16 +2,27 @@
 # main.py
 
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from app.tasks import process_receipt
+from app.utils import results
+from app.utils import deadletter
+from app.utils import incoming_store
+from app.utils.fairqueue import submit as submit_fair
+from app.utils.imageprobe import probe, probe_file, rejection
+from app.utils.metrics import metrics_payload, observe_webhook
+from app.utils import whatsapp_media
+from app.utils.outbound import CircuitOpenError, aclose as outbound_aclose
+from app.utils.tracing import export, make_span, new_span_id, new_trace_id, SPAN_KIND_SERVER
 from dotenv import load_dotenv
 import uvicorn
-import requests
 import os
 import json
+import base64
+import time
+import asyncio
 import logging
+import threading
 from typing import Dict, Any
 from datetime import datetime
 import pytz
@@ -32,12 +43,12 @@ INCOMING_DIR = os.path.join(BASE_DIR, "incoming")
 os.makedirs(INCOMING_DIR, exist_ok=True)
 
 WHATSAPP_API_VERSION = "v20.0"
-WHATSAPP_GRAPH_URL = "https://graph.facebook.com"
+WHATSAPP_GRAPH_URL = os.getenv("WHATSAPP_GRAPH_URL", "https://graph.facebook.com")  # fake: app/utils/fakes.py
+
+RESULT_MAX_WAIT_S = float(os.getenv("RESULT_MAX_WAIT_S", "60"))
 
 app = FastAPI()
 
-# Serve files (local + cloud)
-app.mount("/files", StaticFiles(directory=INCOMING_DIR), name="files")
 
 
 # ------------------- Routes -------------------
@@ -47,6 +58,26 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/files/{name}")
+async def serve_file(name: str):
+    """Receipt image by received name or <sha256><ext> (app/utils/incoming_store.py)"""
+    path = incoming_store.resolve(name)
+    if path is None:
+        # Images saved before the store, not migrated yet
+        legacy = os.path.join(INCOMING_DIR, os.path.basename(name))
+        path = legacy if os.path.isfile(legacy) else None
+    if path is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return FileResponse(path)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics (see app/utils/metrics.py)"""
+    body, content_type = metrics_payload()
+    return Response(content=body, media_type=content_type)
+
+
 @app.get("/webhook")
 async def verify(request: Request):
     """WhatsApp webhook verification"""
@@ -60,28 +91,38 @@ async def verify(request: Request):
 
 
 async def download_and_save_image(media_id: str, timestamp: str) -> Dict[str, Any]:
-    """Download and save image from WhatsApp API"""
+    """Download and save image from WhatsApp API (streamed, see app/utils/whatsapp_media.py)"""
+    name = f"{timestamp}_{os.path.basename(str(media_id))}.jpg"
+    staged = incoming_store.staging_path(name)
     try:
-        headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
-        media_info_url = f"{WHATSAPP_GRAPH_URL}/{WHATSAPP_API_VERSION}/{media_id}"
-        media_info = requests.get(media_info_url, headers=headers).json()
-
-        download_url = media_info["url"]
-        response = requests.get(download_url, headers=headers)
-        response.raise_for_status()
-
-        filename = f"{INCOMING_DIR}/{timestamp}_{media_id}.jpg"
-        with open(filename, "wb") as f:
-            f.write(response.content)
-
-        logger.info(f"✅ Image saved successfully: {filename}")
-        return {"filename": filename, "size": len(response.content)}
-
+        media = await whatsapp_media.download(media_id, staged, WHATSAPP_TOKEN,
+                                              f"{WHATSAPP_GRAPH_URL}/{WHATSAPP_API_VERSION}")
+        too_large = rejection(media["size"], probe_file(staged))
+        if too_large:
+            os.remove(staged)
+            raise HTTPException(status_code=413, detail=too_large)
+        stored = await asyncio.to_thread(incoming_store.put_file, staged, name=name, message_id=str(media_id))
+        logger.info(f"✅ Image saved successfully: {stored['path']}")
+        return {"filename": stored["path"], "name": name, "size": media["size"], "mime_type": media["mime_type"]}
+
+    except HTTPException:
+        raise
+    except whatsapp_media.MediaTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except CircuitOpenError as e:
+        logger.warning(f"⏳ Not downloading {media_id}: {e}")
+        raise HTTPException(status_code=503, detail="WhatsApp media API unavailable, retry later",
+                            headers={"Retry-After": str(max(1, round(e.retry_in_s)))})
     except Exception as e:
         logger.error(f"❌ Failed to download image: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to download image")
 
 
+@app.on_event("shutdown")
+async def close_outbound_clients():
+    await outbound_aclose()
+
+
 
 # @app.post("/webhook")
 # async def webhook_receiver(request: Request):
@@ -183,27 +224,46 @@ async def download_and_save_image(media_id: str, timestamp: str) -> Dict[str, An
 @app.post("/webhook")
 async def webhook_receiver(request: Request):
     """Handle image receipt webhook (from listener or WhatsApp directly)"""
+    received_at = time.time()
+    # Join the caller's trace if it sent a W3C traceparent, otherwise start one
+    traceparent = request.headers.get("traceparent", "").split("-")
+    trace_id = traceparent[1] if len(traceparent) == 4 and len(traceparent[1]) == 32 else new_trace_id()
+    caller_span = traceparent[2] if len(traceparent) == 4 else None
+    span_id = new_span_id()
     try:
         data = await request.json()
         logger.info(f"Received webhook: {json.dumps(data, indent=2)}")
 
         # Check if image is sent as Base64
         if "image_base64" in data:
-            image_filename = data.get("image_filename", "unnamed.jpg")
-            local_path = os.path.join(INCOMING_DIR, image_filename)
+            image_name = os.path.basename(data.get("image_filename", "unnamed.jpg"))
 
             # Decode and save the image
-            import base64
             image_bytes = base64.b64decode(data["image_base64"])
-            with open(local_path, "wb") as f:
-                f.write(image_bytes)
+            # Header-only size check, before anything is stored or queued
+            too_large = rejection(len(image_bytes), probe(image_bytes))
+            if too_large:
+                raise HTTPException(status_code=413, detail=too_large)
+            # Content-addressed store; the received name stays the /files/ link
+            stored = await asyncio.to_thread(incoming_store.put, image_bytes, name=image_name,
+                                             message_id=data.get("message_id"), group_name=data.get("group_name"))
+            local_path = stored["path"]
             logger.info(f"✅ Image saved from Base64: {local_path}")
 
+        elif "media_id" in data:
+            # WhatsApp Cloud API: the webhook carries only the media id
+            saved = await download_and_save_image(data["media_id"], str(int(received_at)))
+            local_path, image_name = saved["filename"], saved["name"]
+
         elif "local_image_path" in data:
             # Fallback (not recommended on Render)
             local_path = data["local_image_path"]
             if not os.path.exists(local_path):
                 raise HTTPException(status_code=404, detail="Image file not found")
+            too_large = rejection(os.path.getsize(local_path), probe_file(local_path))
+            if too_large:
+                raise HTTPException(status_code=413, detail=too_large)
+            image_name = os.path.basename(local_path)
         else:
             raise HTTPException(status_code=400, detail="No image data provided")
 
@@ -236,8 +296,12 @@ async def webhook_receiver(request: Request):
             "file_size": file_stats.st_size,
             "sent_at": sent_at_formatted,
             # "skip_ocr": data.get("skip_ocr", False),
-            "image_url": f"{PUBLIC_URL}/files/{os.path.basename(local_path)}",
-            "image_filename": os.path.basename(local_path)
+            "image_url": f"{PUBLIC_URL}/files/{image_name}",
+            "image_filename": image_name,
+            "priority": bool(data.get("priority", False)),   # fair-queue priority lane
+            "received_at": received_at,
+            "trace_id": trace_id,
+            "trace_parent": span_id,
         }
 
         # Changes for pdf
@@ -258,17 +322,154 @@ async def webhook_receiver(request: Request):
         logger.info(f"Metadata: {metadata}")
 
         # Queue OCR processing
-        process_receipt.delay(encoded_image, metadata)
+        metadata["queued_at"] = time.time()
+        # Both talk to Redis: keep them off the event loop
+        await asyncio.to_thread(results.mark_queued, metadata)   # before queueing, so a fast worker's update is not overwritten
+        # Per-group fair queue, drained by the worker; straight to Celery if it is off
+        if not await asyncio.to_thread(submit_fair, encoded_image, metadata):
+            await asyncio.to_thread(process_receipt.delay, encoded_image, metadata)
         logger.info(f"📤 Queued OCR task for {local_path}")
+        observe_webhook(time.time() - received_at, "ok")
+        export([make_span(trace_id, "webhook_receiver", received_at, time.time(), parent=caller_span,
+                          span_id=span_id, kind=SPAN_KIND_SERVER, message_id=metadata["message_id"],
+                          group=metadata["group_name"], image_bytes=metadata["file_size"])])
 
-        return JSONResponse(content={
+        content = {
             "status": "success",
-            "message": "Image processed successfully",
-            "filename": local_path
-        })
-
+            "message": "Image queued",
+            "filename": local_path,
+            "state": "queued",
+            "message_id": metadata["message_id"],
+            "trace_id": trace_id,
+        }
+        if metadata["message_id"] not in ("", "N/A"):
+            content["status_url"] = f"/receipts/{metadata['message_id']}"
+        return JSONResponse(content=content)
+
+    except HTTPException as e:
+        logger.error(f"Rejected webhook ({e.status_code}): {e.detail}")
+        observe_webhook(time.time() - received_at, "rejected")
+        raise
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
+        observe_webhook(time.time() - received_at, "error")
+        export([make_span(trace_id, "webhook_receiver", received_at, time.time(), parent=caller_span,
+                          span_id=span_id, kind=SPAN_KIND_SERVER, error=str(e)[:200])])
         raise HTTPException(status_code=500, detail="Internal server error")
+
+
+@app.get("/receipts/{message_id}")
+async def receipt_status(message_id: str, wait: float = 0):
+    """
+    Status, stage timings and extracted fields of one receipt.
+    With ?wait=N (seconds) the request is held until the receipt is done or N
+    seconds pass (long-poll).
+    """
+    try:
+        if wait > 0:
+            stored = await results.wait_for_change(message_id, min(wait, RESULT_MAX_WAIT_S))
+        else:
+            stored = await results.fetch_async(message_id)
+    except Exception as e:
+        logger.error(f"Result store unavailable: {e}")
+        raise HTTPException(status_code=503, detail="Result store unavailable")
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Unknown message_id")
+    return results.to_response(message_id, stored)
+
+
+@app.get("/receipts/{message_id}/events")
+async def receipt_events(message_id: str):
+    """Server-sent events: one `status` event per state change, closed once the receipt is done."""
+    try:
+        stored = await results.fetch_async(message_id)
+    except Exception as e:
+        logger.error(f"Result store unavailable: {e}")
+        raise HTTPException(status_code=503, detail="Result store unavailable")
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Unknown message_id")
+
+    async def events(stored):
+        known = None
+        deadline = time.monotonic() + 30 * 60
+        while stored is not None and time.monotonic() < deadline:
+            status = stored.get("status")
+            if status == known:
+                yield ": keepalive\n\n"   # keeps proxies from closing an idle stream
+            else:
+                known = status
+                yield f"event: status\ndata: {json.dumps(results.to_response(message_id, stored), ensure_ascii=False)}\n\n"
+                if results.is_done(stored):
+                    return
+            try:
+                stored = await results.wait_for_change(message_id, 15, known_status=known)
+            except Exception as e:
+                logger.error(f"Result store unavailable: {e}")
+                yield "event: error\ndata: {\"detail\": \"Result store unavailable\"}\n\n"
+                return
+
+    return StreamingResponse(events(stored), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ------------------- Dead letters (app/utils/deadletter.py) -------------------
+
+_replay_lock = threading.Lock()
+
+
+@app.get("/dead-letters")
+async def dead_letters(stage: str = None, reason: str = None, state: str = "dead", limit: int = 100):
+    """Failed receipts kept for replay, with counts per stage and reason."""
+    return {
+        "stats": deadletter.stats(),
+        "items": deadletter.list_letters(stage=stage, reason=reason, state=state, limit=min(limit, 1000)),
+    }
+
+
+@app.post("/dead-letters/replay")
+async def replay_dead_letters(request: Request):
+    """
+    Replay dead letters in the background, resuming each from its failed stage.
+    Body (all optional): {"stage", "reason", "ids": [...], "limit": 100, "concurrency": 4}
+    """
+    body = await request.json() if await request.body() else {}
+    if body.get("stage") and body["stage"] not in deadletter.STAGES:
+        raise HTTPException(status_code=400, detail=f"stage must be one of {', '.join(deadletter.STAGES)}")
+    ids = body.get("ids")
+    try:
+        options = {
+            "stage": body.get("stage"),
+            "reason": body.get("reason"),
+            "ids": [int(i) for i in ids] if ids is not None else None,
+            "limit": min(int(body.get("limit", 100)), 5000),
+            "concurrency": max(1, min(int(body.get("concurrency", 4)), 32)),
+        }
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="ids must be a list of integers, limit and concurrency integers")
+    if not _replay_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A replay is already running")
+    try:
+        selected = len(deadletter.list_letters(options["stage"], options["reason"], ids=options["ids"],
+                                               limit=options["limit"]))
+    except Exception:
+        _replay_lock.release()
+        raise
+
+    def send(image_base64, metadata):
+        if not submit_fair(image_base64, metadata):
+            process_receipt.delay(image_base64, metadata)
+
+    def run():
+        try:
+            deadletter.replay(send=send, **options)
+        except Exception as e:
+            logger.error(f"Dead-letter replay failed: {e}", exc_info=True)
+        finally:
+            _replay_lock.release()
+
+    threading.Thread(target=run, name="deadletter-replay", daemon=True).start()
+    return JSONResponse(status_code=202, content={"status": "replaying", "selected": selected, **options})
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -1,20 +1,40 @@
-from app.utils.drive import upload_file_and_get_link, get_drive_service, get_or_create_folder
-from app.utils.gsheet import write_row
-from celery import Celery
+from app.utils.uploader import submit_upload, resume_spool, start_spool_watcher
+from app.utils.gsheet import build_sheet_row
+from app.utils.outbox import enqueue_row, start_flusher_thread
+from app.utils.sheet_routing import route_row
+from app.utils.receipt_store import record_receipt
+from app.utils.dedup import payment_key, claim as claim_payment, describe as describe_original, DUPLICATE_POLICY
+from app.utils.parser import clean_ocr_text, detect_supplier, extract_fields, build_confidence_index
+from app.utils.ocr import parse_paddle_result, save_ocr_result, load_stored_ocr
+from app.utils.deadletter import capture as capture_dead_letter, resolve as resolve_dead_letter
+from app.utils.image_hash import content_hash
+from app.utils.archive import transcode_for_archive, replace_incoming_copy, ARCHIVE_INCOMING
+from app.utils.fairqueue import FAIR_QUEUE, start_dispatcher_thread
+from app.utils.autoscale import note_service_time, note_warmup
+from app.utils.imageprobe import probe, rejection, reduce_factor
+from app.utils.incoming_store import start_sweeper_thread
+from app.utils.results import StageTimer, mark_processing, record as record_result
+from app.utils.tracing import Trace, maybe_profile
+from app.utils.metrics import (observe_queue_wait, count_receipt, count_failure, set_model_loaded,
+                               clear_multiproc_dir, mark_process_dead, start_worker_exporter,
+                               observe_child_rss)
+from celery import Celery, Task
+from celery.exceptions import SoftTimeLimitExceeded, WorkerLostError
+from celery.worker.request import Request
+from celery.signals import worker_init, worker_ready, worker_process_shutdown
 import cv2
 import numpy as np
+import paddleocr
 from paddleocr import PaddleOCR
 # from deepseek_ocr import DeepSeekOCR
 import os
 import re
 import logging
 import json
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional
 import time
 import base64
 import tempfile
-import pytz
-from datetime import datetime
 
 # Configure logging
 logging.basicConfig(
@@ -27,10 +47,58 @@ logger = logging.getLogger(__name__)
 # app = Celery('tasks', broker='redis://redis:6379/0')
 BROKER_URL = os.environ.get("REDIS_URL", os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/0"))
 app = Celery('tasks', broker=BROKER_URL)
+# OCR tasks take seconds: a child reserves one at a time, so receipts stay in the
+# fair queue (app/utils/fairqueue.py) instead of piling up in a busy child
+app.conf.worker_prefetch_multiplier = 1
+# A child whose RSS grew past WORKER_MAX_MEMORY_MB is replaced once its task is done.
+# The OCR engine is loaded before the pool forks, so the new child does not reload it.
+app.conf.worker_max_memory_per_child = int(os.environ.get("WORKER_MAX_MEMORY_MB", "2048")) * 1024   # KB
+# OCR that runs past the soft limit is interrupted; past the hard limit the child is killed
+TASK_SOFT_TIME_LIMIT_S = int(os.environ.get("TASK_SOFT_TIME_LIMIT_S", "120"))
+TASK_TIME_LIMIT_S = int(os.environ.get("TASK_TIME_LIMIT_S", "180"))
+
+# Recorded with every persisted OCR result so replays know which engine produced it
+OCR_ENGINE_INFO = {
+    "engine": "paddleocr",
+    "engine_version": getattr(paddleocr, "__version__", None),
+    "lang": "es",
+    "model_version": os.environ.get("OCR_MODEL_VERSION"),
+}
+
+@worker_init.connect
+def _reset_metrics(**kwargs):
+    """Drop multiprocess metric files of a previous run before the pool starts."""
+    clear_multiproc_dir()
+
+@worker_ready.connect
+def _start_background_work(**kwargs):
+    """
+    Drain the sheet-row outbox from the worker's main process (OUTBOX_FLUSHER=0 to disable),
+    move receipts from the per-group fair queue to Celery, resume Drive uploads
+    left in the spool by a previous run or an exited child, apply the incoming/ retention and serve metrics.
+    """
+    if os.environ.get("OUTBOX_FLUSHER", "1") != "0":
+        start_flusher_thread()
+    if os.environ.get("INCOMING_SWEEPER", "1") != "0":
+        start_sweeper_thread()
+    if FAIR_QUEUE:
+        start_dispatcher_thread(process_receipt.delay)
+    resume_spool()
+    start_spool_watcher()   # uploads of prefork children that exit mid-upload
+    # The engine was loaded at import, before worker_init cleared the metric files
+    set_model_loaded(ocr_engine is not None, ocr_load_seconds)
+    note_warmup(ocr_load_seconds)   # the autoscaler weighs new capacity against it
+    start_worker_exporter()
+
+@worker_process_shutdown.connect
+def _forget_process_metrics(pid=None, **kwargs):
+    mark_process_dead(pid or os.getpid())
 
 # PaddleOCR initialization with retries
 def initialize_paddle_ocr(max_retries=3, delay=5):
     """Initialize PaddleOCR with retries"""
+    global ocr_load_seconds
+    started = time.perf_counter()
     for attempt in range(max_retries):
         try:
             logger.info(f"Attempting PaddleOCR initialization (attempt {attempt + 1}/{max_retries})...")
@@ -41,15 +109,19 @@ def initialize_paddle_ocr(max_retries=3, delay=5):
                 # show_log=False,
                 # enable_mkldnn=True  # Better CPU performance
             )
-            logger.info("✅ PaddleOCR engine initialized successfully")
+            ocr_load_seconds = time.perf_counter() - started
+            logger.info(f"✅ PaddleOCR engine initialized successfully ({ocr_load_seconds:.1f}s)")
+            set_model_loaded(True, ocr_load_seconds)
             return engine
         except Exception as e:
             logger.error(f"❌ Attempt {attempt + 1} failed: {str(e)}")
             if attempt < max_retries - 1:
                 time.sleep(delay)
+    set_model_loaded(False)
     return None
 
 # Global OCR engine initialization
+ocr_load_seconds = None
 ocr_engine = initialize_paddle_ocr()
 
 if ocr_engine is None:
@@ -65,32 +137,6 @@ def get_ocr_engine():
 
 
 
-# Supplier detection
-SUPPLIERS = [
-    "Transgestiona",
-    "Prestigio pagos",
-    "Plataforma de pago",
-    "Aurinegros",
-    "Cobro Express",
-    "Cobro Sur Sa",
-    "CLAN SRL",
-    "RAZ Y CIA",
-    "Cobro sur"
-]
-DEFAULT_SUPPLIER = "Other"
-
-def detect_supplier(text: str) -> str:
-    text_lower = text.lower()
-    bank_ciudad_pattern = r'(?:banco\s+destino|para|banco)\s*[:\-]?\s*([a-z\s\n]+ciudad[a-z\s\n]*?)'
-    
-    # 1. Check for the hardcoded rule FIRST.
-    if re.search(bank_ciudad_pattern, text_lower, re.S):
-        return "Transgestiona"
-    for supplier in SUPPLIERS:
-        if supplier.lower() in text_lower:
-            return supplier
-    return DEFAULT_SUPPLIER
-
 FOLDER_GROUPS = {
     "Prestigio": ["Transgestiona", "Prestigio pagos", "Plataforma de pago", "Aurinegros", "Cobro Sur Sa", "Cobro sur"],
     "Cobro_Express": ["Cobro Express"],
@@ -111,28 +157,21 @@ def get_folder_for_supplier(supplier_name: str) -> str:
     return "Others"
 
 
-def extract_text_from_result(page_results: List[Any]) -> List[str]:
+_REDUCED_READ = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def preprocess_image_for_ocr(path: str, reduce: int = 1) -> Optional[np.ndarray]:
     """
-    Extract text lines from a single page's PaddleOCR result structure.
+    Load image and return the raw BGR NumPy array for OCR. With reduce > 1 the
+    image is decoded at 1/reduce scale (JPEG decodes straight to the smaller
+    size) and written back to `path`, so the OCR engine reads the small copy.
     """
-    text_lines = []
-    if not isinstance(page_results, list): return text_lines
-    for line_data in page_results:
-        try:
-            if isinstance(line_data, (list, tuple)) and len(line_data) >= 2 and isinstance(line_data[1], (list, tuple)):
-                text = line_data[1][0]
-                if text and isinstance(text, str):
-                    text_lines.append(text.strip())
-        except Exception:
-            continue
-    return text_lines
-
-def preprocess_image_for_ocr(path: str) -> Optional[np.ndarray]:
-    """Load image and return the raw BGR NumPy array for OCR."""
     try:
-        img = cv2.imread(path)
+        img = cv2.imread(path, _REDUCED_READ.get(reduce, cv2.IMREAD_COLOR))
         if img is None:
             return None
+        if reduce > 1:
+            cv2.imwrite(path, img, [cv2.IMWRITE_JPEG_QUALITY, 95])
         if len(img.shape) == 2:
             img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
         return img 
@@ -140,17 +179,110 @@ def preprocess_image_for_ocr(path: str) -> Optional[np.ndarray]:
         logger.error(f"Image loading/preprocessing failed: {e}")
         return None
 
-def normalize_amount(raw_amount: str) -> str:
-    """Normalize amount string to a standard integer format."""
-    norm = raw_amount.strip().replace(" ", "")
-    norm = re.sub(r'[\$£€]', '', norm)
-    # Simple strategy: remove all non-digits, assuming the user only wants the integer part
-    return re.sub(r'[^0-9]', '', norm)
+_lost_task_ids = set()
+
+
+def _child_lost(request: Request, status: str, error: str):
+    """Record a receipt whose child was killed mid-task as failed, and dead-letter it."""
+    if request.id in _lost_task_ids:
+        return   # a hard timeout can also surface as a lost worker
+    if len(_lost_task_ids) > 10000:
+        _lost_task_ids.clear()
+    _lost_task_ids.add(request.id)
+    args = list(request.args or [])
+    image_base64 = args[0] if args else request.kwargs.get("image_base64")
+    metadata = (args[1] if len(args) > 1 else request.kwargs.get("metadata")) or {}
+    logger.error(f"☠️ Receipt {metadata.get('message_id')} lost with its worker process: {error}")
+    timer = StageTimer()
+    timer.started_at = request.time_start or timer.started_at
+    timer.error = error
+    try:
+        count_failure(status)
+        _dead_letter(image_base64, metadata, timer, status)
+        record_result(metadata, timer, status)
+    except Exception as e:
+        logger.error(f"Could not record lost receipt {metadata.get('message_id')}: {e}")
 
 
-@app.task
+class ReceiptRequest(Request):
+    """
+    Runs in the worker's main process. A child killed by the hard time limit,
+    SIGKILL or the OOM killer never reaches process_receipt's finally block,
+    so the receipt is recorded and dead-lettered here instead of being lost
+    (the message was acked when the task started).
+    """
+
+    def on_timeout(self, soft, timeout):
+        super().on_timeout(soft, timeout)
+        if not soft:
+            _child_lost(self, "ocr_timeout", f"killed at the {timeout}s hard time limit")
+
+    def on_failure(self, exc_info, send_failed_event=True, return_ok=False):
+        super().on_failure(exc_info, send_failed_event=send_failed_event, return_ok=return_ok)
+        if isinstance(exc_info.exception, WorkerLostError):
+            _child_lost(self, "worker_lost", f"{type(exc_info.exception).__name__}: {exc_info.exception}")
+
+
+class ReceiptTask(Task):
+    Request = ReceiptRequest
+
+
+@app.task(base=ReceiptTask, soft_time_limit=TASK_SOFT_TIME_LIMIT_S, time_limit=TASK_TIME_LIMIT_S)
 def process_receipt(image_base64: str, metadata: Dict[str, Any]) -> Dict[str, Any]:
     """Process receipt image and extract structured data."""
+    trace = Trace.from_metadata(metadata)
+    timer = StageTimer(trace)
+    queued_at = metadata.get("queued_at")
+    observe_queue_wait(queued_at, timer.started_at)
+    if isinstance(queued_at, (int, float)):
+        trace.add("queue_wait", queued_at, timer.started_at, parent=trace.parent)
+    logger.info(f"Receipt {metadata.get('message_id')} trace {trace.trace_id}")
+    mark_processing(metadata, timer)
+    result = None
+    status = "exception"
+    try:
+        with maybe_profile(metadata, trace.trace_id):
+            result = _process_receipt(image_base64, metadata, timer)
+        if result:
+            status = "ok"
+            count_receipt(result.get("Supplier"), result.get("Destination_Bank"))
+        else:
+            status = timer.failure or "failed"
+        return result
+    except Exception as e:
+        timer.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if status != "ok":
+            count_failure(status)
+            _dead_letter(image_base64, metadata, timer, status)
+        elif metadata.get("replay"):
+            resolve_dead_letter(metadata.get("message_id"), ("ocr", "extract"))   # replays carry the idem key
+        record_result(metadata, timer, status, result)
+        note_service_time(time.time() - timer.started_at)
+        rss = observe_child_rss()
+        if rss is not None:
+            logger.info(f"Worker process RSS after receipt: {rss / 1048576:.0f} MB")
+        trace.finish("process_receipt", timer.started_at, status,
+                     message_id=metadata.get("message_id"), group=metadata.get("group_name"))
+
+
+def _dead_letter(image_base64: Optional[str], metadata: Dict[str, Any], timer: StageTimer, status: str):
+    """Keep a failed receipt (image, metadata, failed stage) for replay; see app/utils/deadletter.py."""
+    try:
+        image_bytes = base64.b64decode(image_base64) if image_base64 else None
+    except Exception:
+        image_bytes = None
+    message_id = metadata.get("message_id")
+    idem_key = message_id if message_id and message_id != "N/A" else (image_bytes and content_hash(image_bytes))
+    if not idem_key:
+        return
+    resume = dict(timer.resume)
+    capture_dead_letter(idem_key, resume.pop("stage"), status, error=timer.error, metadata=metadata,
+                        image_bytes=image_bytes, payload=resume or None)
+
+
+def _process_receipt(image_base64: str, metadata: Dict[str, Any], timer: StageTimer) -> Dict[str, Any]:
 
 
     # # ----------------------------------------------------------------------
@@ -199,624 +331,206 @@ def process_receipt(image_base64: str, metadata: Dict[str, Any]) -> Dict[str, An
     # Ensure image_base64 is present for the rest of the OCR logic
     if not image_base64:
         logger.error("❌ Task called without image data and skip_ocr is False.")
+        timer.failure = "no_image"
         return {}
     
     # New logic for pdf
     
-    ocr_engine=get_ocr_engine()
-    if ocr_engine is None:
+    # Dead-letter replay after OCR succeeded: use the stored OCR result instead of running it again
+    stored_ocr = None
+    if metadata.get("resume_from") == "extract" and metadata.get("ocr_file"):
+        stored_ocr = load_stored_ocr(metadata["ocr_file"])
+        if stored_ocr:
+            logger.info(f"♻️ Resuming from stored OCR {metadata['ocr_file']}")
+
+    ocr_engine = get_ocr_engine() if stored_ocr is None else None
+    if stored_ocr is None and ocr_engine is None:
         logger.error("❌ OCR Engine is None. Initialization failed globally.")
+        timer.failure = "ocr_engine_unavailable"
         return {}
     
     # Create a temp file to store the decoded image
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-        image_path = tmp.name
-        tmp.write(base64.b64decode(image_base64))
-    
-    logger.info(f"✅ Temporary image created: {image_path}")
-        
-    if not os.path.exists(image_path):
-        logger.error(f"File not found: {image_path}")
-        return {}
-
-    logger.info(f"Processing {image_path}...")
+    with timer.stage("decode"):
+        image_bytes = base64.b64decode(image_base64)
+        image_sha256 = content_hash(image_bytes)
+        # Dimensions from the header only: nothing is decoded before the size check
+        probed = probe(image_bytes)
+        too_large = rejection(len(image_bytes), probed)
+        if too_large:
+            logger.error(f"❌ Rejected: {too_large}")
+            timer.failure = "image_too_large"
+            return {}
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
+            image_path = tmp.name
+            tmp.write(image_bytes)
     
-    # 2. Preprocess image
-    preprocessed_img = preprocess_image_for_ocr(image_path)
-    if preprocessed_img is None:
-        logger.error(f"Failed to load or preprocess image: {image_path}")
-        return {}
-
-    # 3. OCR extraction
-    result = []
+    # The temp image (or its downscaled copy) is removed however processing ends
     try:
-        logger.info("Running OCR on image...")
-        result = ocr_engine.ocr(image_path)
-    except Exception as e:
-        logger.error(f"OCR failed for {image_path}: {str(e)}", exc_info=True)
-        return {}
-        
-    # 4. Extract and Clean Text
-    text_lines = []
-    if isinstance(result, list):
-    # New format (dict-based)
-        if len(result) > 0 and isinstance(result[0], dict) and "rec_texts" in result[0]:
-            text_lines = result[0]["rec_texts"]
+        logger.info(f"✅ Temporary image created: {image_path}")
+
+        if not os.path.exists(image_path):
+            logger.error(f"File not found: {image_path}")
+            timer.failure = "temp_file_missing"
+            return {}
+
+        logger.info(f"Processing {image_path}...")
+
+        if stored_ocr is None:
+            # 2. Preprocess image
+            reduce = reduce_factor(probed)
+            if reduce > 1:
+                logger.info(f"Downscaling {probed[1]}x{probed[2]} image by {reduce} for OCR")
+            preprocessed_img = preprocess_image_for_ocr(image_path, reduce)
+            if preprocessed_img is None:
+                logger.error(f"Failed to load or preprocess image: {image_path}")
+                timer.failure = "image_unreadable"
+                return {}
+
+            # 3. OCR extraction
+            result = []
+            try:
+                logger.info("Running OCR on image...")
+                with timer.stage("ocr"):
+                    result = ocr_engine.ocr(image_path)
+            except SoftTimeLimitExceeded:
+                logger.error(f"OCR exceeded {TASK_SOFT_TIME_LIMIT_S}s for {image_path}")
+                timer.failure = "ocr_timeout"
+                timer.error = f"OCR exceeded {TASK_SOFT_TIME_LIMIT_S}s"
+                return {}
+            except Exception as e:
+                logger.error(f"OCR failed for {image_path}: {str(e)}", exc_info=True)
+                timer.failure = "ocr_error"
+                timer.error = f"{type(e).__name__}: {e}"
+                return {}
+
+        # 4. Extract and Clean Text
+        ocr_result = stored_ocr or parse_paddle_result(result)
+        text_lines = ocr_result["lines"]
+        text_scores = ocr_result["scores"]
+
+        # This is the "purest data" you requested: all lines of text separated by newlines
+        full_text = "\n".join(text_lines) 
+        cleaned_text = clean_ocr_text(text_lines)
+
+        logger.info(f"OCR text extracted ({len(text_lines)} lines): {full_text[:300]}...")
+
+        # 5. Persist the OCR result (lines, boxes, scores) for replays without re-running OCR
+        receipt_id = os.path.splitext(metadata.get("image_filename") or "")[0] or image_sha256[:32]
+        if stored_ocr:
+            timer.resume = {"stage": "extract", "ocr_file": stored_ocr["path"]}
         else:
-        # Fallback for older list-based format
-            for page_result in result:
-                text_lines.extend(extract_text_from_result(page_result))
-    
-    # This is the "purest data" you requested: all lines of text separated by newlines
-    full_text = "\n".join(text_lines) 
-    cleaned_text = re.sub(r'\s+', ' ', full_text).strip() 
-    
-    logger.info(f"OCR text extracted ({len(text_lines)} lines): {full_text[:300]}...")
-    
-    # 5. Save the "purest data" (plain text)
-    try:
-        text_file = image_path.rsplit(".", 1)[0] + ".txt"
-        with open(text_file, "w", encoding="utf-8") as f:
-            f.write(full_text)
-        logger.info(f"Saved OCR text (purest data) to {text_file}")
-    except Exception as e:
-        logger.warning(f"Failed to save text file: {e}")
-
-    # --- Detect supplier ---
-    supplier = detect_supplier(cleaned_text)
-    logger.info(f"Detected supplier: {supplier}")
-
-    # --- Upload to Drive ---
-    DRIVE_PARENT_FOLDER_ID = os.environ.get("DRIVE_FOLDER_ID")
-    try:
-        drive_service = get_drive_service()
+            try:
+                ocr_file = save_ocr_result(ocr_result, receipt_id, image_sha256, OCR_ENGINE_INFO)
+                logger.info(f"Saved OCR result to {ocr_file} ({os.path.getsize(ocr_file)} bytes)")
+                timer.resume = {"stage": "extract", "ocr_file": ocr_file}
+            except Exception as e:
+                logger.warning(f"Failed to save OCR result: {e}")
+
+        # --- Detect supplier ---
+        supplier = detect_supplier(cleaned_text)
+        logger.info(f"Detected supplier: {supplier}")
+
+        message_id = metadata.get("message_id")
+        idem_key = message_id if message_id and message_id != "N/A" else image_sha256
+
+        # --- Archival copy: re-encoded for Drive and incoming/ (OCR above used the original) ---
+        with timer.stage("archive"):
+            archive_bytes, archive_ext, archive_mimetype = transcode_for_archive(image_bytes)
+        if archive_ext and ARCHIVE_INCOMING and metadata.get("image_filename"):
+            replace_incoming_copy(metadata["image_filename"], archive_bytes, archive_ext)
+
+        # --- Upload to Drive (background; see app/utils/uploader.py) ---
         folder_name = get_folder_for_supplier(supplier)
-        image_link = upload_file_and_get_link(
-            local_path=image_path,
-            dest_name=os.path.basename(image_path),
-            supplier_folder=folder_name  # now points to the correct folder group
-    )
-    except Exception as e:
-        logger.warning(f"Drive upload failed: {e}")
-        image_link = None
-
-    # 6. Data Extraction
-    extracted_data = {
-    'Receipt_Date': None,
-    'Amount': None,
-    'Sender_CUIT': None,
-    'Receiver_CUIT': None,
-    'Transaction_Number': None,
-    'Destination_Bank': None,
-    'Supplier': supplier,
-    'WhatsApp_Group': metadata.get('group_name', 'Direct Chat'),
-    'Receipt_Sent_Time': metadata.get('sent_at'),
-    'image_URL': metadata.get('image_url')
-    
-    }
-#    
-
-    # ---------- DESTINO / CBU / CVU BANK DETECTION ----------
-    extracted_data['Destination_Bank'] = None
-    cleaned_lower = cleaned_text.lower()
-
-    # mapping from detected code -> bank name
-    destino_map = {
-        "007": "Galicia",
-        "285": "Macro",
-        "191": "Credicoop Nueva",
-        "053": "Agil Pagos",        # normalize 0000053 -> take last 3 as '053'
-        "044": "Hipotecario",
-        "011": "Nacion",
-        "029": "Ciudad",
-        "072": "Santander",
-    }
-
-    def norm_code(code: str) -> str:
-        code = re.sub(r'\D', '', code or "")  # remove non-digits
-        # Agil Pagos special case (e.g., 0000053...)
-        if code.startswith("00000") and len(code) >= 7:
-            return code[5:8]  # take digits 6,7,8
-        # General case: take first 3 digits
-        if len(code) >= 3:
-            return code[:3]
-        # If code is shorter than 3 digits, pad with zeros
-        return code.zfill(3) 
-
-    # 1) Try explicit "destino" followed by short code (1–7 digits)
-    m = re.search(r'destino[:\s]*([0-9]{1,7})', cleaned_lower)
-    if m:
-        code_raw = m.group(1)
-        code = norm_code(code_raw)
-        extracted_data['Destination_Bank'] = destino_map.get(code)
-        logger.info(f"destino match -> raw:{code_raw} normalized:{code} bank:{extracted_data['Destination_Bank']}")
-
-    # 2) If not found, look for a 22-digit CBU/CVU and extract its first 3 digits (common case)
-    if not extracted_data['Destination_Bank']:
-        m = re.search(r'(?:CBU|CVU)[:\s]*([0-9]{22})', cleaned_lower)
-        if m:
-            cbu = m.group(1)
-            bank_code = cbu[:3]  # first 3 digits of CBU are the bank code
-            code = norm_code(bank_code)
-            extracted_data['Destination_Bank'] = destino_map.get(code)
-            logger.info(f"22-digit CBU found -> bank_code:{bank_code} normalized:{code} bank:{extracted_data['Destination_Bank']}")
-
-    # 3) If still not found, try cbu/cvu with any digits and take first 3 digits
-    if not extracted_data['Destination_Bank']:
-        m = re.search(r'(?:CBU|CVU)[:\s]*([0-9]{3,7})', cleaned_lower)
-        if m:
-            code_raw = m.group(1)
-            code = norm_code(code_raw)
-            extracted_data['Destination_Bank'] = destino_map.get(code)
-            logger.info(f"short cbu/cvu match -> raw:{code_raw} normalized:{code} bank:{extracted_data['Destination_Bank']}")
-    bank_name_patterns = ["Hipotecario", "Santander", "Galicia", "Provincia", "Macro",
-                                "BBVA", "ICBC", "Ciudad", "Credicoop", "Agil Pagos", "Nacion"]
-    # 4) Fallback: text-based bank detection (your existing list)
-    if not extracted_data['Destination_Bank']:
-                # SAFE:
-        before, sep, after_para = cleaned_lower.partition("para")
-        if sep:  # only proceed if 'para' exists
-            for b in bank_name_patterns:
-                if b.lower() in after_para:
-                    extracted_data['Destination_Bank'] = b
-                    logger.info(f"text match -> bank:{b}")
-                    break
-
-    # 5) Special rule you wanted: if supplier == "Cobro Express" and no 'para' use Agil Pagos
-    if not extracted_data['Destination_Bank']:
-        if extracted_data.get('Supplier', '').lower()=="cobro express buenos aires sa" or extracted_data.get('Supplier', '').lower()=="cobro express":
-            extracted_data['Destination_Bank'] = "Agil Pagos"
-            logger.info("No 'para' and supplier Cobro Express -> set Agil Pagos")
-
-    if not extracted_data['Destination_Bank']:
-        before, sep, after_para = cleaned_lower.partition("para")
-        if sep:
-
-            # 1️⃣ Try to find a 22-digit CBU/CVU in the "after para" text
-            m = re.search(r'(?:CVU|CBU)[:\s]*([0-9]{22})', after_para, re.IGNORECASE)
-            if m:
-                cbu = m.group(1)
-                bank_code = cbu[:3]
-                code = norm_code(bank_code)
-                extracted_data['Destination_Bank'] = destino_map.get(code)
-                logger.info(f"'para' section 22-digit CBU found -> bank_code:{bank_code} normalized:{code} bank:{extracted_data['Destination_Bank']}")
-
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="transgestiona" or extracted_data.get('Supplier', '').lower()=="transgestiona S A") and ("0110074720007400875197" in cleaned_text):
-            extracted_data['Destination_Bank'] = "Nacion"
-            logger.info("No 'para' and supplier transgestiona -> set Nacion")
-    
-    if not extracted_data['Destination_Bank']:
-        if extracted_data.get('Supplier', '').lower()=="transgestiona" or extracted_data.get('Supplier', '').lower()=="transgestiona S A":
-            extracted_data['Destination_Bank'] = "Ciudad"
-            logger.info("No 'para' and supplier transgestiona -> set Ciudad")
-
-    if not extracted_data['Destination_Bank']:
-        if extracted_data.get('Supplier', '').lower()=="cobro sur sa" or extracted_data.get('Supplier', '').lower()=="cobro sur":
-            extracted_data['Destination_Bank'] = "Hipotecario"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Hipotecario")
-
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="prestigio pagos")and "0440000430000010401791" in cleaned_text:
-            extracted_data['Destination_Bank'] = "Hipotecario"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Hipotecario")
-    
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="prestigio pagos")and "0000053600000033387693" in cleaned_text:
-            extracted_data['Destination_Bank'] = "Agil Pagos"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Agil Pagos")
-
-    if not extracted_data['Destination_Bank']:
-        if extracted_data.get('Supplier', '').lower()=="prestigio pagos" or extracted_data.get('Supplier', '').lower()=="prestigio pagos sa":
-            extracted_data['Destination_Bank'] = "Agil Pagos"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Agil Pagos")
-    
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="aurinegros sa" or extracted_data.get('Supplier', '').lower()=="aurinegros")and ("044000043" in cleaned_text or "0440000044" in cleaned_text):
-            extracted_data['Destination_Bank'] = "Hipotecario"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Agil Pagos")
-    
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="aurinegros sa" or extracted_data.get('Supplier', '').lower()=="aurinegros")and ("0110001320000100574191" in cleaned_text):
-            extracted_data['Destination_Bank'] = "Nacion"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Nacion")
-
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="aurinegros sa" or extracted_data.get('Supplier', '').lower()=="aurinegros")and ("0290031500000502572582" in cleaned_text):
-            extracted_data['Destination_Bank'] = "Ciudad"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Ciudad")
-
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="raz y cia sa" or extracted_data.get('Supplier', '').lower()=="raz y cia")and ("0070158320000001103504" in cleaned_text):
-            extracted_data['Destination_Bank'] = "Galicia"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Galicia")
-
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="clan srl" or extracted_data.get('Supplier', '').lower()=="clan")and ("0720039720000000390554" in cleaned_text):
-            extracted_data['Destination_Bank'] = "Santander"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Santander")
-
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="clan srl" or extracted_data.get('Supplier', '').lower()=="caln")and ("2850302630094201041381" in cleaned_text):
-            extracted_data['Destination_Bank'] = "Macro"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Macro")
-
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="clan srl" or extracted_data.get('Supplier', '').lower()=="clan")and ("1910233555023300527178" in cleaned_text):
-            extracted_data['Destination_Bank'] = "Credicoop nueva"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Credicoop nueva")
-
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="plataforma de" or extracted_data.get('Supplier', '').lower()=="plataforma de pago sa")and ("2850759230094207764521" in cleaned_text):
-            extracted_data['Destination_Bank'] = "Macro"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Macro")
-
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="plataforma de" or extracted_data.get('Supplier', '').lower()=="plataforma de pago sa")and ("0110074720007400875197" in cleaned_text):
-            extracted_data['Destination_Bank'] = "Nacion"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Nacion")
-
-    if not extracted_data['Destination_Bank']:
-        if (extracted_data.get('Supplier', '').lower()=="plataforma de" or extracted_data.get('Supplier', '').lower()=="plataforma de pago sa")and ("0290031500000502079632" in cleaned_text):
-            extracted_data['Destination_Bank'] = "Ciudad"
-            logger.info("No 'para' and supplier Cobro Sur Sa -> set Ciudad")
-
-    
-
-        # 2️⃣ Otherwise, search in full text
-    if not extracted_data['Destination_Bank']:
-        for b in bank_name_patterns:
-            if b.lower() in cleaned_lower:
-                extracted_data['Destination_Bank'] = b
-                break
-
-    logger.info(f"Final Destination_Bank: {extracted_data.get('Destination_Bank')}")
-
-    patterns = {
-    # Date: handles both numeric and Spanish text dates
-    # 'date': r'(\b\d{1,2}[-/]\d{1,2}[-/]\d{2,4}\b|\b(?:lunes|martes|miércoles|jueves|viernes|sábado|domingo)?[,]?\s*\d{1,2}\s*(?:de\s+)?(?:ene|feb|mar|abr|may|jun|jul|ago|sep|oct|nov|dic)\w*\s*(?:de\s+)?\d{4})',
-
-    'date': r'(\b\d{1,2}[-/]\d{1,2}[-/]\d{2,4}\b' # DD/MM/YYYY
-        r'|\b\d{1,2}[-/](?:ene|feb|mar|abr|may|jun|jul|ago|sep|oct|nov|dic)\w*[-/]\d{2,4}\b' # <-- NEW HYBRID FORMAT
-        r'|\b(?:lunes|martes|miércoles|jueves|viernes|sábado|domingo)?[,]?\s*\d{1,2}\s*(?:de\s+)?(?:ene|feb|mar|abr|may|jun|jul|ago|sep|oct|nov|dic)\w*\s*(?:de\s+)?\d{4})',
-
-    # 'amount': r'(?:\$|PESOS|IMPORTE|MONTO|TOTAL|PAGO)\s*[:$]?\s*(\d+(?:[.,]\d+)+)',
-    'amount': r'(?:(?:IMPORTE|PESOS|MONTO|TOTAL|PAGO)\s*[:$]?\s*|[\$])?\s*(\d+(?:[.,]\d+)+)(?:\s*[\$]|\s*|\s*\d+)?',
-
-    
-    # CUIT: same as before
-    #
-    
-    # 'cuit': r'(?:CUIT|CUIL|DNI|origen|ORIGEN|N[úu]m\s*Doc)?[:\s\n]*([\d\-]{11,15})',
-    'cuit': r'(?:CUIT|CUIL|DNI|origen|ORIGEN|N[úu]m\s*Doc)[:\s\n]*([0-9\-]{11,15})',
-
-    'operation': r'(?:operaci[oó]n|referencia|c[oó]digo|identificaci[oó]n|control|comprobante|transacci[oó]n|operation)'
-    r'(?:\s*(?:or|o)?\s*CTRL)?'
-    r'\s*(?:de\s+)?(?:Mercado\s*Pago)?\s*[:\-]?\s*([A-Za-z0-9\s\n]+)',
-
-    'numeric_op': r'(?:n°?\s+de\s+operaci[oó]n|n[uú]mero\s+de\s+operaci[oó]n\s+de\s+Mercado\s*Pago|nro\.|n°?\s*control|referencia|transacti[oó]n|n°?\s*c[oó]mprobante|Nro. de comprobante|comprobante|transacci[oó]n)\s*[:\-]?\s*([0-9]+)',
-    
-
-    'alphanumeric_op': r'(?:C[oó]digo\s+de\s+transacci[oó]n|C[oó]digo\s+de\s+identificaci[oó]n|referencia|control|id Op.|transacci[oó]n:|operation|operaci[oó]n:|C[oó]mprobante|transacci[oó]n|Ref.)\s*[:\-]?\s*' \
-                   r'(?=[A-Za-z0-9\s\n\-]*[A-Za-z])(?=[A-Za-z0-9\s\n\-]*[0-9])' \
-                   r'([A-Za-z0-9\s\n\-]{5,36})',
-    'referencia_op': r'referen[cñ]ia\s*[:\-]?\s*[\s\n]{0,10}\s*([A-Za-z0-9\s\n\-]+?)',
-
-    'nro_control': r'nro\s*control\s*[:\-]?[\s\n\xa0\-:]+([0-9]+)'
-
+        dest_name = os.path.basename(image_path)
+        if archive_ext:
+            dest_name = os.path.splitext(dest_name)[0] + archive_ext
+        try:
+            with timer.stage("upload_submit"):
+                image_link = submit_upload(
+                    archive_bytes,
+                    dest_name=dest_name,
+                    supplier_folder=folder_name,  # now points to the correct folder group
+                    idem_key=idem_key,
+                    mimetype=archive_mimetype,
+                    trace=timer.trace.context() if timer.trace else None
+                )
+        except Exception as e:
+            logger.warning(f"Drive upload could not be queued: {e}")
+            image_link = None
+            capture_dead_letter(idem_key, "upload", "upload_not_queued", error=f"{type(e).__name__}: {e}",
+                                metadata=metadata, image_bytes=archive_bytes,
+                                payload={"dest_name": dest_name, "supplier_folder": folder_name,
+                                         "mimetype": archive_mimetype})
+
+        # 6. Data Extraction (see app/utils/parser.py)
+        with timer.stage("extract"):
+            extracted_data = extract_fields(
+                cleaned_text, supplier,
+                confidence=build_confidence_index(text_lines, text_scores)
+            )
+        extracted_data.update({
+            'WhatsApp_Group': metadata.get('group_name', 'Direct Chat'),
+            'Receipt_Sent_Time': metadata.get('sent_at'),
+            'image_URL': image_link
+        })
 
+        # Add WhatsApp metadata placeholders (filled by main.py)
+        extracted_data['WhatsApp_Group'] = metadata.get('group_name')#, 'Direct Chat')
+        extracted_data['Receipt_Sent_Time'] = metadata.get('sent_at')
+        # extracted_data['image_URL'] = metadata.get('image_url')
 
-    # 'operation': r'(?:operaci[oó]n|referencia|c[oó]digo|identificaci[oó]n|comprobante)\s*(?:de\s+)?(?:Mercado\s*Pago)?\s*[:\-]?\s*([0-9]+)'
-    }
-#    
+        logger.info("Extraction complete")
+        logger.info(json.dumps(extracted_data, indent=4))
 
-    if date_match := re.search(patterns['date'], cleaned_text, re.I):
-        date_str = date_match.group(1).strip().lower()
-        # Convert Spanish month names to numbers
-        months = {
-            "enero": "01", "febrero": "02", "marzo": "03", "abril": "04",
-            "mayo": "05", "junio": "06", "julio": "07", "agosto": "08",
-            "septiembre": "09", "setiembre": "09", "octubre": "10",
-            "noviembre": "11", "diciembre": "12",
-            "ene": "01", "feb": "02", "mar": "03", "abr": "04", "may": "05",
-            "jun": "06", "jul": "07", "ago": "08", "sep": "09", "oct": "10",
-            "nov": "11", "dic": "12"
-        }
 
-        # Try to normalize date
+        # --- Duplicate payment check (same transaction number, amount and date) ---
+        pay_key = payment_key(extracted_data)
+        original = None
         try:
-            # Example: "06 de noviembre de 2025"
-            parts = re.findall(r"(\d{1,2})\D+(ene|feb|mar|abr|may|jun|jul|ago|sep|oct|nov|dic)\w*\D+(\d{4})", date_str)
-            if parts:
-                day, month_abbr, year = parts[0]
-                month = months.get(month_abbr, "01")
-                formatted_date = f"{year}-{month}-{int(day):02d}"
+            with timer.stage("dedup"):
+                original = claim_payment(pay_key, idem_key, extracted_data, metadata)
+        except Exception as e:
+            logger.warning(f"Duplicate check failed: {e}")
+        if original:
+            extracted_data['Duplicate_Of'] = describe_original(original)
+            logger.info(f"⚠️ Duplicate payment {pay_key}, original: {extracted_data['Duplicate_Of']}")
+
+        # --- Build final data row for Sheets ---
+        sheet_row = build_sheet_row(extracted_data, metadata)
+
+        # Commit the row to the local outbox; the flusher delivers it to Google Sheets.
+        # Use environment variable SPREADSHEET_ID in container
+        SPREADSHEET_ID = os.environ.get('SPREADSHEET_ID', '1u3M6OKKg08A0SA_Sz-hhDn4aVmbbG27Rl8msOKFFxpI')
+        spreadsheet_id, sheet_tab = route_row(extracted_data, metadata, SPREADSHEET_ID)
+        try:
+            if original and DUPLICATE_POLICY == "skip":
+                logger.info("Duplicate not written to Google Sheets (DUPLICATE_POLICY=skip).")
             else:
-                # fallback for numeric formats like 06/11/2025 or 6-11-25
-                d = re.findall(r"\d{1,2}", date_str)
-                y = re.findall(r"\d{2,4}", date_str)
-                if len(d) >= 2 and y:
-                    day = d[0]
-                    month = d[1]
-                    year = y[-1]
-                    if len(year) == 2:
-                        year = f"20{year}"
-                    formatted_date = f"{year}-{int(month):02d}-{int(day):02d}"
+                with timer.stage("commit"):
+                    committed = enqueue_row(idem_key, spreadsheet_id, sheet_row, sheet_base_name=sheet_tab, max_rows=1000,
+                                            trace=timer.trace.context() if timer.trace else None)
+                if committed:
+                    logger.info("✅ Row committed to outbox.")
                 else:
-                    formatted_date = date_str
-
-            extracted_data['Receipt_Date'] = formatted_date
+                    logger.info(f"Row for {idem_key} already in outbox, skipped.")
         except Exception as e:
-            logger.warning(f"Date parsing failed: {e}")
-            extracted_data['Receipt_Date'] = date_str
-    else:
-        argentina_tz = pytz.timezone("America/Argentina/Buenos_Aires")
-        current_date = datetime.now(argentina_tz).strftime("%Y-%m-%d")
-        extracted_data['Receipt_Date'] = current_date
-        logger.info(f"No date found — using current Argentina date: {current_date}")
-    
-
-    # def format_to_argentine_locale(raw_value: str) -> str:
-    #     """
-    #     Converts a raw numeric string from various formats (US, AR, OCR errors)
-    #     into the standard Argentine format (e.g., '784.569,27').
-    #     """
-    #     if not raw_value:
-    #         return "0,00"
-
-    #     # 1. Clean up spacing and symbols
-    #     clean_value = raw_value.strip().replace(' ', '').replace('$', '').replace('€', '')
-        
-    #     # --- 2. Determine the clean US float string (float_str) ---
-        
-    #     # Case A: Mixed separators (e.g., 1.234,56 or 1,234.56)
-    #     if '.' in clean_value and ',' in clean_value:
-    #         # Rightmost separator is the decimal separator
-    #         if clean_value.rfind(',') > clean_value.rfind('.'):
-    #             # Format is 1.234,56 (AR format) -> remove dots, keep comma
-    #             float_str = clean_value.replace('.', '')
-    #         else:
-    #             # Format is 1,234.56 (US format) -> remove commas, keep dot
-    #             float_str = clean_value.replace(',', '')
-        
-    #     # Case B: Multiple periods (OCR error: 203.456.21)
-    #     elif clean_value.count('.') > 1:
-    #         # Assume all but the LAST period are thousands separators (to be removed)
-    #         last_dot_index = clean_value.rfind('.')
-    #         integer_part_to_clean = clean_value[:last_dot_index]
-    #         decimal_part_with_dot = clean_value[last_dot_index:]
-    #         float_str = integer_part_to_clean.replace('.', '') + decimal_part_with_dot
-            
-    #     # Case C (FIX): Single separator or none (e.g., 784569.27 or 784569,27)
-    #     else:
-    #         # CRITICAL FIX: If it contains a comma, assume it's the decimal and convert to dot for float()
-    #         if ',' in clean_value:
-    #             float_str = clean_value.replace(',', '.') # Converts '784569,27' to '784569.27'
-    #         else:
-    #             # Assume it's already US format (e.g., 784569.27) or an integer
-    #             float_str = clean_value 
-
-    #     # --- 3. Convert to float to normalize and extract parts ---
-    #     try:
-    #         # The float_str is now clean and uses only the dot as the decimal separator.
-    #         num_value = float(float_str) 
-            
-    #         # Get standardized integer and decimal parts (e.g., '784569' and '27')
-    #         integer_part, decimal_part = "{:.2f}".format(num_value).split('.')
-            
-    #     except ValueError:
-    #         return raw_value # Conversion failed
-
-    #     # --- 4. Insert periods as thousands separators into the integer part ---
-    #     formatted_integer = ""
-    #     for i, digit in enumerate(reversed(integer_part)):
-    #         if i > 0 and i % 3 == 0:
-    #             formatted_integer += "."
-    #         formatted_integer += digit
-        
-    #     # Reverse back
-    #     formatted_integer = formatted_integer[::-1]
-        
-    #     # --- 5. Combine with the Argentine decimal comma ---
-    #     return f"{formatted_integer},{decimal_part}"
-
-    def normalize_amount(text, force_two_decimals=False):
-        """
-        Normaliza importes detectados por OCR:
-        - Detecta coma o punto final + 2 dígitos como parte decimal.
-        - Devuelve número con coma decimal y puntos de miles.
-        Ejemplo: "$ 754528.27" -> "754.528,27"
-        """
-        if text is None:
-            return None
-
-        s = str(text).strip()
-        s = re.sub(r'[^\d\.,\s]', '', s)   # dejar solo dígitos, puntos, comas y espacios
-        s = s.strip()
-
-        # Buscar si termina con . o , y exactamente 2 dígitos
-        m = re.search(r'([.,])(\d{2})\s*$', s)
-        if m:
-            decimals = m.group(2)
-            prefix = s[:m.start(1)]
-            integer_digits = re.sub(r'[^0-9]', '', prefix)  # eliminar separadores
-            if integer_digits == '':
-                integer_digits = '0'
-            # Formatear con puntos de miles
-            integer_with_dots = f"{int(integer_digits):,}".replace(",", ".")
-            return f"{integer_with_dots},{decimals}"
-        else:
-            # No hay parte decimal válida
-            digits = re.sub(r'[^0-9]', '', s)
-            if digits == '':
-                return ''
-            if force_two_decimals:
-                formatted = f"{int(digits):,}".replace(",", ".")
-                return f"{formatted},00"
-            return f"{int(digits):,}".replace(",", ".")
-        
-
-    if amount_match := re.search(patterns['amount'], cleaned_text, re.I):
-        # extracted_data['Amount'] = amount_match.group(1).strip()
-        raw_amount = amount_match.group(1).strip()
-        extracted_data['Amount'] = normalize_amount(raw_amount)
-    else:
-    # Fallback: try to find a standalone numeric pattern like 400,000.00 or 1.234,56
-        amount_match = re.search(r'(\d{1,3}(?:[.,]\d{3})+[.,]\d{2})', cleaned_text)
-        if amount_match:
-            raw_amount = amount_match.group(1).strip()
-            # APPLY FORMATTING HERE:
-            extracted_data['Amount'] = normalize_amount(raw_amount)
-        else:
-            extracted_data['Amount'] = None
-
-
-
-    # # --- Sender CUIT ---
-    # if 'De' in cleaned_text:
-    #     sender_area = cleaned_text.split('De', 1)[-1]
-    #     if 'Para' in sender_area:
-    #         sender_area = sender_area.split('Para', 1)[0]
-    # else:
-    #     sender_area = cleaned_text
-
-    # sender_area = re.sub(r'\s+', ' ', sender_area)
-    # if sender_match := re.search(patterns['cuit'], sender_area, re.I):
-    #     extracted_data['Sender_CUIT'] = re.sub(r'\D', '', sender_match.group(1))
-    # else:
-    #     extracted_data['Sender_CUIT'] = None
-
-    # --- Sender CUIT Extraction ---9
-    sender_area = cleaned_text
-    if 'De' in cleaned_text:
-        sender_area = cleaned_text.split('De', 1)[-1]
-        if 'Para' in sender_area:
-            sender_area = sender_area.split('Para', 1)[0]
-    # sender_area = re.sub(r'\s+', ' ', cleaned_text.split('De', 1)[-1].split('Para', 1)[0] if 'De' in cleaned_text else cleaned_text)
-    sender_area = re.sub(r'\s+', ' ', sender_area)
-    # if sender_match := re.search(patterns['cuit'], sender_area, re.I):
-    if sender_match := re.search(patterns['cuit'], sender_area, re.I | re.S):
-        cuit_digits = re.sub(r'\D', '', sender_match.group(1))
-        # validate length = 11
-        if len(cuit_digits) == 11:
-            if ('De' in cleaned_text and not "BNA" in cleaned_text) or cuit_digits.startswith('2'):
-                extracted_data['Sender_CUIT'] = cuit_digits
-            else:
-                extracted_data['Sender_CUIT'] = None   
-        else:
-            extracted_data['Sender_CUIT'] = None
-    else:
-        extracted_data['Sender_CUIT'] = None
-
-    # receiver_area = re.sub(r'\s+', ' ', cleaned_text.split('Para', 1)[-1] if 'Para' in cleaned_text else cleaned_text)
-    # if receiver_match := re.search(patterns['cuit'], receiver_area, re.I):
-    #     cuit_digits = re.sub(r'\D', '', sender_match.group(1))
-    #     # validate length = 11
-    #     if len(cuit_digits) == 11:
-    #         extracted_data['Sender_CUIT'] = cuit_digits
-    #     else:
-    #         extracted_data['Sender_CUIT'] = None
-
-
-
-
-    # else:
-    #     extracted_data['Sender_CUIT'] = None
-    #     r_id = re.sub(r'\D', '', receiver_match.group(1))
-    #     if r_id and r_id != extracted_data.get('Sender_CUIT'):
-    #         extracted_data['Receiver_CUIT'] = r_id
-    #     else:
-    #         extracted_data['Receiver_CUIT'] = None
-    # else:
-    #     extracted_data['Receiver_CUIT'] = None
-    
-
-    # --- Transaction / Operation Number ---
-    if op_match := re.search(patterns['numeric_op'], cleaned_text, re.I | re.S):
-        op_value = op_match.group(1).strip()
-        if op_value:
-            extracted_data['Transaction_Number'] = op_value[-6:].lower() if len(op_value) >= 6 else op_value.lower()
-    elif op_match := re.search(patterns['alphanumeric_op'], cleaned_text, re.I | re.S):
-        op_value = op_match.group(1).strip().replace('-', '').replace(' ', '')
-        if op_value:
-            extracted_data['Transaction_Number'] = op_value[-6:].lower() if len(op_value) >= 6 else op_value.lower()
-    
-    elif "Nro Control:" in cleaned_text:
-        if op_match := re.search(patterns['nro_control'], cleaned_text, re.I | re.S):
-            op_value = op_match.group(1).strip().replace('-', '').replace(' ', '')
-            if op_value:
-                extracted_data['Transaction_Number'] = op_value[-6:].lower() if len(op_value) >= 6 else op_value.lower()
-
-    elif op_match := re.search(patterns['referencia_op'], cleaned_text, re.I | re.S):
-    # Tier 2: Referencia (Requires cleanup for spaces/hyphens since it can be mixed)
-        op_value = op_match.group(1).strip().replace('-', '').replace(' ', '')
-        if op_value:
-            extracted_data['Transaction_Number'] = op_value[-6:].lower() if len(op_value) >= 6 else op_value.lower()
-    else:
-        extracted_data['Transaction_Number'] = None
-
-    # Add WhatsApp metadata placeholders (filled by main.py)
-    extracted_data['WhatsApp_Group'] = metadata.get('group_name')#, 'Direct Chat')
-    extracted_data['Receipt_Sent_Time'] = metadata.get('sent_at')
-    # extracted_data['image_URL'] = metadata.get('image_url')
-
-    logger.info("Extraction complete")
-    logger.info(json.dumps(extracted_data, indent=4))
-    
+            logger.error(f"Failed to commit row to outbox: {e}")
+            capture_dead_letter(idem_key, "commit", "outbox_commit", error=f"{type(e).__name__}: {e}",
+                                metadata=metadata,
+                                payload={"spreadsheet_id": spreadsheet_id, "sheet_base_name": sheet_tab, "max_rows": 1000,
+                                         "row": sheet_row, "trace": timer.trace.context() if timer.trace else None})
 
-# --- Upload image to Drive and get link ---
-    try:
-        # image_link = upload_file_and_get_link(local_path=image_path, dest_name=os.path.basename(image_path), supplier_folder=folder_name)
-        extracted_data['image_URL'] = image_link
-    except Exception as e:
-        logger.warning(f"Drive upload failed: {e}")
-        extracted_data['image_URL'] = None
-    # image_link = metadata.get('image_url') or ''
-    # --- Build final data row for Sheets ---
-    row = {
-        'Receipt_Date': extracted_data.get('Date') or extracted_data.get('Receipt_Date') or None,
-        'Amount': extracted_data.get('Amount'),
-        # 'Sender_Name': extracted_data.get('Sender_Name'),
-        'Sender_CUIT': extracted_data.get('Sender_ID') or extracted_data.get('Sender_CUIT'),
-        # 'Receiver_CUIT': extracted_data.get('Receiver_ID') or extracted_data.get('Receiver_CUIT'),
-        'Transaction_Number': extracted_data.get('Operation_Number') or extracted_data.get('Transaction_Number'),
-        'Supplier': extracted_data.get('Supplier'),
-        'Destination_Bank': extracted_data.get('Destination_Bank'),
-        'WhatsApp_Group': metadata.get('group_name') or metadata.get('from_group') or 'Unknown Group',
-        'Receipt_Sent_Time': metadata.get('sent_at') or metadata.get('timestamp') or time.time(),
-        'Image_Link': extracted_data.get('image_URL') or ''
-    }
-
-    # Map to sheet order (adjust columns / order to match sheet)
-    sheet_row = [
-        row['Receipt_Date'],
-        row['Amount'],
-        row['Sender_CUIT'],
-        # row['Receiver_CUIT'],
-        row['Transaction_Number'],
-        row['Supplier'],
-        row['Destination_Bank'],
-        row['WhatsApp_Group'],
-        row['Receipt_Sent_Time'],
-        row['Image_Link']
-    ]
-
-    # Call sheet writer. Use environment variable SPREADSHEET_ID in container
-    SPREADSHEET_ID = os.environ.get('SPREADSHEET_ID', '1u3M6OKKg08A0SA_Sz-hhDn4aVmbbG27Rl8msOKFFxpI')
-    try:
-        # write_row(SPREADSHEET_ID, sheet_row, sheet_range="botnogal!A1")
-        write_row(spreadsheet_id=SPREADSHEET_ID,row_values=sheet_row,sheet_base_name="botnogal",max_rows=1000  # Optional: change limit per sheet
-)
-        logger.info("✅ Wrote row to Google Sheets.")
-    except Exception as e:
-        logger.error(f"Failed to write to Google Sheets: {e}")
-
-
-    try:
-        os.remove(image_path)
-        os.remove(text_file)
-        logger.info(f"🗑️ Deleted temporary files: {image_path}, {text_file}")
-    except Exception as e:
-        logger.warning(f"Failed to delete temp files: {e}")
-    return extracted_data
+        # Local indexed copy of the row for fast lookups (see app/utils/receipt_store.py)
+        try:
+            record_receipt(idem_key, extracted_data, metadata, payment_key=pay_key,
+                           duplicate_of=original["idem_key"] if original else None)
+        except Exception as e:
+            logger.warning(f"Failed to record receipt in local store: {e}")
+        return extracted_data
+    finally:
+        try:
+            os.remove(image_path)
+            logger.info(f"🗑️ Deleted temporary file: {image_path}")
+        except Exception as e:
+            logger.warning(f"Failed to delete temp files: {e}")
     
\ No newline at end of file
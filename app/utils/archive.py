@@ -0,0 +1,152 @@
+
+# app/utils/archive.py
+#
+# Archival re-encoding of receipt images. WhatsApp originals (often large
+# screenshots) are downscaled and re-encoded to a size-bounded WebP/JPEG
+# before they are uploaded to Drive. Only the archived copy changes: OCR
+# always runs on the original bytes.
+
+import io
+import os
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from app.utils import incoming_store
+from app.utils.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMAT = os.getenv("ARCHIVE_FORMAT", "webp").lower()      # webp | jpeg | original
+ARCHIVE_QUALITY = int(os.getenv("ARCHIVE_QUALITY", "75"))
+ARCHIVE_MIN_QUALITY = int(os.getenv("ARCHIVE_MIN_QUALITY", "45"))
+ARCHIVE_MAX_SIDE = int(os.getenv("ARCHIVE_MAX_SIDE", "1800"))      # px, longest side
+ARCHIVE_MAX_BYTES = int(os.getenv("ARCHIVE_MAX_BYTES", str(200 * 1024)))
+# Also swap the original in incoming/ for the archive copy. Off by default:
+# bench_corpus.py uses incoming/ as its OCR corpus and needs the originals.
+ARCHIVE_INCOMING = os.getenv("ARCHIVE_INCOMING", "0") == "1"
+INCOMING_DIR = os.getenv(
+    "INCOMING_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "incoming")
+)
+
+FORMATS = {
+    "webp": ("WEBP", ".webp", "image/webp"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+}
+STATS_KEY = "archive_stats"
+
+_stats = {"images": 0, "bytes_in": 0, "bytes_out": 0}
+_stats_lock = threading.Lock()
+
+
+def _record(bytes_in: int, bytes_out: int):
+    with _stats_lock:
+        _stats["images"] += 1
+        _stats["bytes_in"] += bytes_in
+        _stats["bytes_out"] += bytes_out
+    client = get_redis()
+    if client is not None:
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.hincrby(STATS_KEY, "images", 1)
+            pipe.hincrby(STATS_KEY, "bytes_in", bytes_in)
+            pipe.hincrby(STATS_KEY, "bytes_out", bytes_out)
+            pipe.execute()
+        except Exception:
+            pass
+
+
+def archive_stats() -> Dict[str, Any]:
+    """Images re-encoded by this process and the bytes saved."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["bytes_saved"] = stats["bytes_in"] - stats["bytes_out"]
+    return stats
+
+
+def transcode_for_archive(image_bytes: bytes, fmt: Optional[str] = None) -> Tuple[bytes, str, Optional[str]]:
+    """
+    Re-encode an image for archival. Returns (bytes, extension, mimetype).
+    Quality steps down from ARCHIVE_QUALITY until the result fits in
+    ARCHIVE_MAX_BYTES (or ARCHIVE_MIN_QUALITY is reached). The original is
+    returned unchanged (extension "", mimetype None) when re-encoding does not make it smaller.
+    """
+    fmt = (fmt or ARCHIVE_FORMAT).lower()
+    if fmt not in FORMATS:
+        return image_bytes, "", None
+    pil_format, ext, mimetype = FORMATS[fmt]
+
+    try:
+        from PIL import Image, ImageOps
+
+        img = Image.open(io.BytesIO(image_bytes))
+        # JPEGs are decoded at the smallest DCT scale still above the archive size
+        img.draft("RGB", (ARCHIVE_MAX_SIDE, ARCHIVE_MAX_SIDE))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        if max(img.size) > ARCHIVE_MAX_SIDE:
+            img.thumbnail((ARCHIVE_MAX_SIDE, ARCHIVE_MAX_SIDE), Image.LANCZOS)
+
+        quality = ARCHIVE_QUALITY
+        while True:
+            buf = io.BytesIO()
+            options = {"optimize": True} if pil_format == "JPEG" else {"method": 4}
+            img.save(buf, pil_format, quality=quality, **options)
+            out = buf.getvalue()
+            if len(out) <= ARCHIVE_MAX_BYTES or quality <= ARCHIVE_MIN_QUALITY:
+                break
+            quality = max(ARCHIVE_MIN_QUALITY, quality - 10)
+    except Exception as e:
+        logger.warning(f"Archival re-encode failed, keeping original: {e}")
+        return image_bytes, "", None
+
+    if len(out) >= len(image_bytes):
+        _record(len(image_bytes), len(image_bytes))
+        return image_bytes, "", None
+
+    _record(len(image_bytes), len(out))
+    logger.info(f"Archive copy: {len(image_bytes) / 1024:.0f} KB -> {len(out) / 1024:.0f} KB "
+                f"({fmt}, q{quality}, {img.size[0]}x{img.size[1]}), saved {(len(image_bytes) - len(out)) / 1024:.0f} KB")
+    return out, ext, mimetype
+
+
+def replace_incoming_copy(image_filename: str, archive_bytes: bytes, ext: str) -> bool:
+    """
+    Swap the stored original for the archive copy: in the incoming store the
+    name keeps its /files/ link; a flat incoming/<image_filename> is replaced
+    by incoming/<stem><ext>.
+    """
+    if incoming_store.replace(image_filename, archive_bytes, ext):
+        return True
+    original = os.path.join(INCOMING_DIR, os.path.basename(image_filename))
+    if not os.path.exists(original):
+        return False
+    target = os.path.splitext(original)[0] + ext
+    tmp = target + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(archive_bytes)
+    os.replace(tmp, target)
+    if target != original:
+        os.remove(original)
+    return True
+
+
+if __name__ == "__main__":
+    # Dry run over a directory of images: python -m app.utils.archive [dir] [webp|jpeg]
+    import sys
+    import time
+
+    logging.basicConfig(level=logging.WARNING)
+    directory = sys.argv[1] if len(sys.argv) > 1 else INCOMING_DIR
+    fmt = sys.argv[2] if len(sys.argv) > 2 else None
+    start = time.perf_counter()
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
+            with open(os.path.join(directory, name), "rb") as f:
+                transcode_for_archive(f.read(), fmt)
+    stats = archive_stats()
+    ratio = stats["bytes_out"] / stats["bytes_in"] if stats["bytes_in"] else 1.0
+    print(f"{stats['images']} images: {stats['bytes_in'] / 1e6:.1f} MB -> {stats['bytes_out'] / 1e6:.1f} MB "
+          f"({ratio:.0%}), saved {stats['bytes_saved'] / 1e6:.1f} MB in {time.perf_counter() - start:.1f}s")
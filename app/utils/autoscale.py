@@ -0,0 +1,265 @@
+
+# app/utils/autoscale.py
+#
+# Autoscaling controller for the OCR workers. Every AUTOSCALE_INTERVAL_S it
+# reads the backlog (Celery queue plus the fair queue, fairqueue.py), the
+# number of receipts being processed and the recent per-task service time,
+# and sizes the workers so the backlog drains within AUTOSCALE_TARGET_DRAIN_S:
+#
+#   wanted = busy + ceil(backlog * service_s / target_drain_s), within [MIN, MAX]
+#
+# New capacity costs a model warm-up (the OCR engine's load time, reported by
+# the workers), so the controller only scales up when the backlog would last
+# longer than that warm-up, waits a warm-up between scale-ups, and steps down
+# one unit at a time after demand has stayed low for AUTOSCALE_DOWN_DELAY_S.
+#
+#   AUTOSCALE_MODE=pool       grow/shrink the prefork pools (Celery pool_grow /
+#                             pool_shrink), one process per unit
+#   AUTOSCALE_MODE=command    run AUTOSCALE_SCALE_CMD with {n} = worker containers,
+#                             e.g. "docker compose up -d --no-recreate --scale worker={n}"
+#
+#   python -m app.utils.autoscale run      # controller loop
+#   python -m app.utils.autoscale status   # inputs and last decision
+#
+# Do not combine with `celery worker --autoscale`: Celery's autoscaler only
+# sees the tasks a worker has reserved, not the backlog waiting in Redis.
+
+import os
+import sys
+import json
+import math
+import time
+import shlex
+import logging
+import subprocess
+from typing import Any, Dict, Optional, Tuple
+
+from app.utils.redis_client import get_redis, REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+MODE = os.getenv("AUTOSCALE_MODE", "pool")          # pool | command
+MIN_UNITS = int(os.getenv("AUTOSCALE_MIN", "1"))
+MAX_UNITS = int(os.getenv("AUTOSCALE_MAX", "4"))
+INTERVAL_S = float(os.getenv("AUTOSCALE_INTERVAL_S", "15"))
+TARGET_DRAIN_S = float(os.getenv("AUTOSCALE_TARGET_DRAIN_S", "120"))
+DOWN_DELAY_S = float(os.getenv("AUTOSCALE_DOWN_DELAY_S", "600"))
+DEFAULT_SERVICE_S = float(os.getenv("AUTOSCALE_DEFAULT_SERVICE_S", "8"))
+DEFAULT_WARMUP_S = float(os.getenv("AUTOSCALE_DEFAULT_WARMUP_S", "30"))
+SCALE_CMD = os.getenv("AUTOSCALE_SCALE_CMD", "")
+PROCESSES_PER_WORKER = int(os.getenv("AUTOSCALE_PROCESSES_PER_WORKER", "1"))   # command mode
+CELERY_QUEUE = os.getenv("CELERY_QUEUE", "celery")
+
+KEY_PREFIX = "autoscale"
+SERVICE_KEY = f"{KEY_PREFIX}:service_s"   # recent task durations, newest first
+WARMUP_KEY = f"{KEY_PREFIX}:warmup_s"
+STATE_KEY = f"{KEY_PREFIX}:state"
+SERVICE_SAMPLES = 200
+
+
+# ------------------- Worker side -------------------
+
+def note_service_time(seconds: float):
+    """Record one task's duration (called by process_receipt)."""
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.lpush(SERVICE_KEY, round(seconds, 3))
+        pipe.ltrim(SERVICE_KEY, 0, SERVICE_SAMPLES - 1)
+        pipe.execute()
+    except Exception as e:
+        logger.debug(f"Could not record service time: {e}")
+
+
+def note_warmup(seconds: Optional[float]):
+    """Record how long this worker took to load the OCR engine."""
+    client = get_redis()
+    if client is None or seconds is None:
+        return
+    try:
+        client.set(WARMUP_KEY, round(seconds, 3))
+    except Exception as e:
+        logger.debug(f"Could not record warm-up time: {e}")
+
+
+# ------------------- Inputs -------------------
+
+def service_time(client) -> float:
+    """Median of the recent task durations (robust to the odd 60 s OCR)."""
+    samples = sorted(float(v) for v in client.lrange(SERVICE_KEY, 0, -1))
+    return samples[len(samples) // 2] if samples else DEFAULT_SERVICE_S
+
+
+def warmup_time(client) -> float:
+    value = client.get(WARMUP_KEY)
+    return float(value) if value else DEFAULT_WARMUP_S
+
+
+def backlog(client) -> int:
+    from app.utils.fairqueue import backlog as fair_backlog
+    waiting = fair_backlog(client, limit=1000)
+    return client.llen(CELERY_QUEUE) + waiting["priority"] + sum(waiting["groups"].values())
+
+
+def wanted_processes(backlog_n: int, busy: int, service_s: float, target_drain_s: float = TARGET_DRAIN_S) -> int:
+    """Processes needed to finish what is running and drain the backlog within the target."""
+    return busy + math.ceil(backlog_n * service_s / max(target_drain_s, 1.0))
+
+
+# ------------------- Scalers -------------------
+
+class PoolScaler:
+    """Prefork pool size of every running worker, changed through Celery's remote control."""
+
+    unit = "process"
+
+    def __init__(self):
+        from celery import Celery
+        self.control = Celery("autoscale", broker=os.environ.get("CELERY_BROKER_URL", REDIS_URL)).control
+
+    def _stats(self) -> Dict[str, Any]:
+        return self.control.inspect(timeout=2).stats() or {}
+
+    def busy(self) -> int:
+        active = self.control.inspect(timeout=2).active() or {}
+        return sum(len(tasks) for tasks in active.values())
+
+    def current(self) -> int:
+        return sum(len(s.get("pool", {}).get("processes", [])) for s in self._stats().values())
+
+    def units_for(self, processes: int) -> int:
+        return processes
+
+    def apply(self, target: int):
+        sizes = {name: len(s.get("pool", {}).get("processes", [])) for name, s in self._stats().items()}
+        if not sizes:
+            logger.warning("No workers replied, nothing to scale")
+            return
+        # Spread the target evenly, extra processes on the first workers
+        names = sorted(sizes)
+        base, extra = divmod(target, len(names))
+        for i, name in enumerate(names):
+            delta = base + (1 if i < extra else 0) - sizes[name]
+            if delta > 0:
+                self.control.pool_grow(delta, destination=[name])
+            elif delta < 0:
+                # Only idle processes are removed; busy ones finish their receipt first
+                self.control.pool_shrink(-delta, destination=[name])
+
+
+class CommandScaler(PoolScaler):
+    """Number of worker containers, changed by running AUTOSCALE_SCALE_CMD."""
+
+    unit = "worker"
+
+    def current(self) -> int:
+        return len(self._stats())
+
+    def units_for(self, processes: int) -> int:
+        return math.ceil(processes / max(PROCESSES_PER_WORKER, 1))
+
+    def apply(self, target: int):
+        if not SCALE_CMD:
+            logger.error("AUTOSCALE_MODE=command needs AUTOSCALE_SCALE_CMD")
+            return
+        cmd = shlex.split(SCALE_CMD.format(n=target))
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        if result.returncode != 0:
+            logger.error(f"Scale command failed ({result.returncode}): {result.stderr.strip()[:500]}")
+
+
+# ------------------- Controller -------------------
+
+class Controller:
+    """Decides the target size from the backlog; holds back while a warm-up is pending or demand is recent."""
+
+    def __init__(self, scaler, min_units: int = MIN_UNITS, max_units: int = MAX_UNITS):
+        self.scaler = scaler
+        self.min_units, self.max_units = min_units, max_units
+        self.last_up = 0.0
+        self.low_since: Optional[float] = None
+
+    def decide(self, current: int, backlog_n: int, busy: int, service_s: float, warmup_s: float,
+               now: float) -> Tuple[int, str]:
+        wanted = self.scaler.units_for(wanted_processes(backlog_n, busy, service_s))
+        wanted = max(self.min_units, min(self.max_units, wanted))
+        if wanted > current:
+            self.low_since = None
+            # At the current size, would the backlog outlast the time new capacity needs to load?
+            drain_s = backlog_n * service_s / max(current, 1)
+            if current >= self.min_units and drain_s <= warmup_s:
+                return current, f"backlog drains in {drain_s:.0f}s, under the {warmup_s:.0f}s warm-up"
+            if now - self.last_up < warmup_s:
+                return current, "previous scale-up still warming up"
+            self.last_up = now
+            return wanted, f"backlog {backlog_n}, {service_s:.1f}s per receipt"
+        if wanted < current:
+            self.low_since = self.low_since or now
+            if now - self.low_since < DOWN_DELAY_S:
+                return current, f"demand low for {now - self.low_since:.0f}s of {DOWN_DELAY_S:.0f}s"
+            self.low_since = now   # one unit per DOWN_DELAY_S
+            return current - 1, "demand stayed low"
+        self.low_since = None
+        return current, "steady"
+
+    def step(self, now: Optional[float] = None) -> Dict[str, Any]:
+        now = now or time.time()
+        client = get_redis()
+        if client is None:
+            raise RuntimeError("Redis is not reachable")
+        state = {
+            "current": self.scaler.current(),
+            "busy": self.scaler.busy(),
+            "backlog": backlog(client),
+            "service_s": service_time(client),
+            "warmup_s": warmup_time(client),
+        }
+        target, reason = self.decide(state["current"], state["backlog"], state["busy"],
+                                     state["service_s"], state["warmup_s"], now)
+        if state["current"] == 0 and target == 0:
+            target = self.min_units
+        if target != state["current"]:
+            logger.info(f"📏 Scaling {state['current']} -> {target} {self.scaler.unit}(s): {reason}")
+            self.scaler.apply(target)
+        state.update({"target": target, "reason": reason, "unit": self.scaler.unit, "at": now})
+        client.set(STATE_KEY, json.dumps(state))
+        return state
+
+
+def make_scaler():
+    return CommandScaler() if MODE == "command" else PoolScaler()
+
+
+def run():
+    controller = Controller(make_scaler())
+    logger.info(f"📏 Autoscaler started ({MODE}, {MIN_UNITS}-{MAX_UNITS}, drain target {TARGET_DRAIN_S:.0f}s)")
+    while True:
+        try:
+            controller.step()
+        except Exception as e:
+            logger.error(f"Autoscaler step failed: {e}")
+        time.sleep(INTERVAL_S)
+
+
+def status() -> Dict[str, Any]:
+    client = get_redis()
+    if client is None:
+        raise RuntimeError("Redis is not reachable")
+    last = client.get(STATE_KEY)
+    return {
+        "backlog": backlog(client),
+        "service_s": service_time(client),
+        "warmup_s": warmup_time(client),
+        "last_decision": json.loads(last) if last else None,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if command == "run":
+        run()
+    else:
+        print(json.dumps(status(), indent=2))
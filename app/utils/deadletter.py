@@ -0,0 +1,331 @@
+
+# app/utils/deadletter.py
+#
+# Dead-letter store for receipts that could not be processed. Each failure is
+# kept with the stage it failed in, the error, the receipt metadata and a
+# reference to its image (a copy under data/deadletter/, or the upload spool
+# file), so nothing is lost when OCR, Drive or the outbox fail.
+#
+# Replays resume from the failed stage:
+#   ocr      image queued again, full processing
+#   extract  image queued again with the stored OCR result, OCR is skipped
+#   upload   Drive upload re-submitted, the row's link patched when it lands
+#   commit   stored sheet row committed to the outbox again
+#
+#   python -m app.utils.deadletter stats
+#   python -m app.utils.deadletter list [--stage ocr] [--reason ocr_error]
+#   python -m app.utils.deadletter replay [--stage extract] [--limit 200] [--concurrency 4]
+#   python -m app.utils.deadletter prune [--days 30]
+#
+# Same over HTTP: GET /dead-letters, POST /dead-letters/replay (main.py).
+
+import os
+import json
+import time
+import base64
+import sqlite3
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+DEADLETTER_PATH = os.getenv("DEADLETTER_PATH", os.path.join(DATA_DIR, "deadletter.sqlite3"))
+BLOB_DIR = os.getenv("DEADLETTER_BLOB_DIR", os.path.join(DATA_DIR, "deadletter"))
+KEEP_RESOLVED_DAYS = float(os.getenv("DEADLETTER_KEEP_RESOLVED_DAYS", "30"))
+REPLAY_TIMEOUT_S = float(os.getenv("DEADLETTER_REPLAY_TIMEOUT_S", "600"))
+
+STAGES = ("ocr", "extract", "upload", "commit")
+QUEUED_STAGES = ("ocr", "extract")       # replayed through the OCR queue
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    idem_key      TEXT NOT NULL,
+    stage         TEXT NOT NULL,     -- ocr | extract | upload | commit
+    reason        TEXT NOT NULL,
+    error         TEXT,
+    blob          TEXT,              -- path of the image to replay from
+    metadata_json TEXT,
+    payload_json  TEXT,              -- what the stage needs to resume (OCR file, sheet row, spool job)
+    state         TEXT NOT NULL DEFAULT 'dead',   -- dead | replaying | resolved
+    attempts      INTEGER NOT NULL DEFAULT 1,
+    created_at    REAL NOT NULL,
+    updated_at    REAL NOT NULL,
+    resolved_at   REAL,
+    UNIQUE (idem_key, stage)
+);
+CREATE INDEX IF NOT EXISTS dead_letters_state ON dead_letters (state, stage, id);
+"""
+
+_local = threading.local()
+
+
+def _connect(path: Optional[str] = None) -> sqlite3.Connection:
+    """One connection per thread (and per forked worker process)."""
+    path = path or DEADLETTER_PATH
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid() and _local.path == path:
+        return conn
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    _local.conn, _local.pid, _local.path = conn, os.getpid(), path
+    return conn
+
+
+def _blob_path(idem_key: str, stage: str) -> str:
+    safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in idem_key)
+    return os.path.join(BLOB_DIR, f"{safe}.{stage}.img")
+
+
+def capture(idem_key: str, stage: str, reason: str, error: Optional[str] = None,
+            metadata: Optional[Dict[str, Any]] = None, image_bytes: Optional[bytes] = None,
+            blob: Optional[str] = None, payload: Optional[Dict[str, Any]] = None):
+    """
+    Record a failed receipt (or bump the attempt count of one already recorded
+    for this stage). The image is copied to BLOB_DIR unless `blob` points at a
+    file that is kept anyway. Never raises: a failing dead-letter write is logged.
+    """
+    try:
+        if blob is None and image_bytes:
+            blob = _blob_path(idem_key, stage)
+            if not os.path.exists(blob):
+                os.makedirs(BLOB_DIR, exist_ok=True)
+                with open(blob + ".tmp", "wb") as f:
+                    f.write(image_bytes)
+                os.replace(blob + ".tmp", blob)
+        now = time.time()
+        _connect().execute(
+            "INSERT INTO dead_letters (idem_key, stage, reason, error, blob, metadata_json, payload_json, "
+            "                          created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (idem_key, stage) DO UPDATE SET reason=excluded.reason, error=excluded.error, "
+            "    blob=COALESCE(excluded.blob, blob), metadata_json=COALESCE(excluded.metadata_json, metadata_json), "
+            "    payload_json=COALESCE(excluded.payload_json, payload_json), state='dead', "
+            "    attempts=attempts+1, updated_at=excluded.updated_at, resolved_at=NULL",
+            (idem_key, stage, reason, (error or "")[:2000] or None, blob,
+             json.dumps(metadata, default=str) if metadata else None,
+             json.dumps(payload, default=str) if payload else None, now, now)
+        )
+        logger.warning(f"☠️ Dead letter {idem_key} at {stage}: {reason}")
+    except Exception as e:
+        logger.error(f"Could not record dead letter for {idem_key} ({stage}, {reason}): {e}")
+
+
+def resolve(idem_key: str, stages=STAGES) -> int:
+    """Mark a receipt's dead letters in `stages` as resolved. Returns the number changed."""
+    if not os.path.exists(DEADLETTER_PATH):
+        return 0
+    marks = ",".join("?" * len(stages))
+    cur = _connect().execute(
+        f"UPDATE dead_letters SET state='resolved', resolved_at=? "
+        f"WHERE idem_key=? AND stage IN ({marks}) AND state != 'resolved'",
+        (time.time(), idem_key, *stages)
+    )
+    return cur.rowcount
+
+
+def _as_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    item = dict(row)
+    item["metadata"] = json.loads(item.pop("metadata_json") or "{}")
+    item["payload"] = json.loads(item.pop("payload_json") or "{}")
+    return item
+
+
+def list_letters(stage: Optional[str] = None, reason: Optional[str] = None, state: str = "dead",
+                 ids: Optional[List[int]] = None, limit: int = 100) -> List[Dict[str, Any]]:
+    sql, params = "SELECT * FROM dead_letters WHERE state=?", [state]
+    if stage:
+        sql, params = sql + " AND stage=?", params + [stage]
+    if reason:
+        sql, params = sql + " AND reason=?", params + [reason]
+    if ids:
+        sql, params = sql + f" AND id IN ({','.join('?' * len(ids))})", params + list(ids)
+    conn = _connect()
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(sql + " ORDER BY id LIMIT ?", params + [limit]).fetchall()
+    finally:
+        conn.row_factory = None
+    return [_as_dict(r) for r in rows]
+
+
+def stats() -> Dict[str, Any]:
+    conn = _connect()
+    by_state = dict(conn.execute("SELECT state, COUNT(*) FROM dead_letters GROUP BY state").fetchall())
+    dead = conn.execute("SELECT stage, reason, COUNT(*) FROM dead_letters WHERE state='dead' "
+                        "GROUP BY stage, reason ORDER BY 3 DESC").fetchall()
+    return {
+        "dead": by_state.get("dead", 0),
+        "replaying": by_state.get("replaying", 0),
+        "resolved": by_state.get("resolved", 0),
+        "dead_by_stage": [{"stage": s, "reason": r, "count": n} for s, r, n in dead],
+    }
+
+
+def prune_resolved(days: float = KEEP_RESOLVED_DAYS) -> int:
+    """Drop resolved dead letters older than `days`, with their image copies."""
+    conn = _connect()
+    cutoff = time.time() - days * 86400
+    rows = conn.execute("SELECT id, blob FROM dead_letters WHERE state='resolved' AND resolved_at < ?",
+                        (cutoff,)).fetchall()
+    for _, blob in rows:
+        if blob and os.path.dirname(blob) == BLOB_DIR:
+            try:
+                os.remove(blob)
+            except FileNotFoundError:
+                pass
+    conn.execute("DELETE FROM dead_letters WHERE state='resolved' AND resolved_at < ?", (cutoff,))
+    return len(rows)
+
+
+def _set_state(letter_id: int, state: str):
+    _connect().execute("UPDATE dead_letters SET state=?, updated_at=? WHERE id=?", (state, time.time(), letter_id))
+
+
+# ------------------- Replay -------------------
+
+def _submit_fair(image_base64: str, metadata: Dict[str, Any]):
+    from app.utils.fairqueue import submit
+    if not submit(image_base64, metadata):
+        raise RuntimeError("fair queue unavailable (FAIR_QUEUE=0 or Redis down)")
+
+
+def _requeue(letter: Dict[str, Any], send: Callable[[str, Dict[str, Any]], Any]) -> Optional[str]:
+    """Queue an ocr/extract dead letter again. Returns the message id to watch."""
+    from app.utils import results
+
+    blob = letter["blob"]
+    if not blob or not os.path.exists(blob):
+        logger.error(f"Dead letter {letter['id']}: image {blob} is gone, cannot replay")
+        return None
+    with open(blob, "rb") as f:
+        image_base64 = base64.b64encode(f.read()).decode("utf-8")
+    metadata = dict(letter["metadata"])
+    message_id = metadata.get("message_id")
+    if not message_id or message_id == "N/A":
+        metadata["message_id"] = letter["idem_key"]
+    metadata.update({"replay": True, "priority": False, "received_at": time.time(), "queued_at": time.time()})
+    for key in ("trace_id", "trace_parent"):
+        metadata.pop(key, None)     # a replay is a new trace
+    if letter["stage"] == "extract" and letter["payload"].get("ocr_file"):
+        metadata["resume_from"] = "extract"
+        metadata["ocr_file"] = letter["payload"]["ocr_file"]
+    results.mark_queued(metadata)
+    send(image_base64, metadata)
+    _set_state(letter["id"], "replaying")
+    return metadata["message_id"]
+
+
+def _replay_local(letter: Dict[str, Any]) -> bool:
+    """Replay an upload/commit dead letter in this process."""
+    idem_key, payload = letter["idem_key"], letter["payload"]
+    try:
+        if letter["stage"] == "commit":
+            from app.utils.outbox import enqueue_row
+            enqueue_row(idem_key, payload["spreadsheet_id"], payload["row"],
+                        sheet_base_name=payload["sheet_base_name"], max_rows=payload.get("max_rows", 1000),
+                        trace=payload.get("trace"))
+            resolve(idem_key, ("commit",))
+            return True
+        from app.utils.uploader import retry_spooled, submit_upload
+        if payload.get("job_path") and os.path.exists(payload["job_path"]):
+            retry_spooled(payload["job_path"])
+        elif letter["blob"] and os.path.exists(letter["blob"]):
+            with open(letter["blob"], "rb") as f:
+                image_bytes = f.read()
+            link = submit_upload(image_bytes, dest_name=payload["dest_name"], supplier_folder=payload.get("supplier_folder"),
+                                 idem_key=idem_key, mimetype=payload.get("mimetype"))
+            if link:
+                # The row went out without a link when the upload could not be queued
+                from app.utils.outbox import set_cell
+                from app.utils.receipt_store import set_image_link
+                set_cell(idem_key, "Image_Link", link)
+                set_image_link(idem_key, link)
+        else:
+            logger.error(f"Dead letter {letter['id']}: nothing left to upload")
+            return False
+        _set_state(letter["id"], "replaying")   # resolved by the uploader once the file is in Drive
+        return True
+    except Exception as e:
+        logger.error(f"Replay of dead letter {letter['id']} ({letter['stage']}) failed: {e}")
+        return False
+
+
+def replay(stage: Optional[str] = None, reason: Optional[str] = None, ids: Optional[List[int]] = None,
+           limit: int = 100, concurrency: int = 4,
+           send: Optional[Callable[[str, Dict[str, Any]], Any]] = None) -> Dict[str, int]:
+    """
+    Replay up to `limit` dead letters, at most `concurrency` at a time.
+    ocr/extract letters go back through the OCR queue (`send`, default: the
+    fair queue) and are waited for; upload/commit letters run here.
+    """
+    from app.utils import results
+
+    send = send or _submit_fair
+    letters = list_letters(stage=stage, reason=reason, ids=ids, limit=limit)
+    summary = {"selected": len(letters), "replayed": 0, "ok": 0, "failed": 0, "unreplayable": 0}
+
+    local = [l for l in letters if l["stage"] not in QUEUED_STAGES]
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for ok in pool.map(_replay_local, local):
+            summary["replayed" if ok else "unreplayable"] += 1
+
+    waiting = [l for l in letters if l["stage"] in QUEUED_STAGES]
+    in_flight: Dict[str, tuple] = {}      # message_id -> (queued at, dead letter id)
+    while waiting or in_flight:
+        while waiting and len(in_flight) < concurrency:
+            letter = waiting.pop(0)
+            try:
+                message_id = _requeue(letter, send)
+            except Exception as e:
+                logger.error(f"Replay of dead letter {letter['id']} could not be queued: {e}")
+                message_id = None
+            if message_id is None:
+                summary["unreplayable"] += 1
+                continue
+            summary["replayed"] += 1
+            in_flight[message_id] = (time.time(), letter["id"])
+        if not in_flight:
+            continue
+        time.sleep(1)
+        for message_id, stored in results.fetch(list(in_flight)).items():
+            queued_at, letter_id = in_flight[message_id]
+            if results.is_done(stored) and stored.get("status") == "ok":
+                in_flight.pop(message_id)
+                summary["ok"] += 1   # resolved by the task itself
+            elif results.is_done(stored) or time.time() - queued_at > REPLAY_TIMEOUT_S:
+                in_flight.pop(message_id)
+                _set_state(letter_id, "dead")   # picked up again by the next replay
+                summary["failed"] += 1
+    logger.info(f"Dead-letter replay: {summary}")
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ap = argparse.ArgumentParser(description="Dead-letter store: inspect and replay failed receipts.")
+    ap.add_argument("command", choices=["stats", "list", "replay", "prune"], nargs="?", default="stats")
+    ap.add_argument("--stage", choices=STAGES)
+    ap.add_argument("--reason")
+    ap.add_argument("--id", type=int, action="append", dest="ids", help="only these dead letters (repeatable)")
+    ap.add_argument("--limit", type=int, default=100)
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--days", type=float, default=KEEP_RESOLVED_DAYS)
+    args = ap.parse_args()
+    if args.command == "list":
+        for letter in list_letters(args.stage, args.reason, ids=args.ids, limit=args.limit):
+            print(f"{letter['id']:>6}  {letter['stage']:<8} {letter['reason']:<24} {letter['idem_key']}  "
+                  f"x{letter['attempts']}  {(letter['error'] or '')[:80]}")
+    elif args.command == "replay":
+        print(json.dumps(replay(args.stage, args.reason, ids=args.ids, limit=args.limit,
+                                concurrency=args.concurrency), indent=2))
+    elif args.command == "prune":
+        print(f"pruned {prune_resolved(args.days)} resolved dead letter(s)")
+    else:
+        print(json.dumps(stats(), indent=2))
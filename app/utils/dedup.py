@@ -0,0 +1,105 @@
+
+# app/utils/dedup.py
+#
+# Duplicate-payment detection. The same transfer is often posted by different
+# people in different groups; each receipt gets a payment key made of its
+# normalized Transaction_Number + Amount + Receipt_Date, and one O(1) probe
+# against a Redis hash tells whether that payment was already seen. The local
+# receipt store (receipt_store.py) is the persistent copy: it answers when
+# Redis is down and refills the hash after Redis loses its data.
+
+import os
+import json
+import logging
+from typing import Any, Dict, Optional
+
+from app.utils.redis_client import get_redis
+from app.utils import receipt_store
+
+logger = logging.getLogger(__name__)
+
+DEDUP_KEY = "receipt_dedup"
+# "mark": write duplicates with Duplicate_Of filled in; "skip": keep them out of the sheet
+DUPLICATE_POLICY = os.getenv("DUPLICATE_POLICY", "mark")
+
+_warmed = False
+
+
+def payment_key(extracted_data: Dict[str, Any]) -> Optional[str]:
+    """'<transaction>|<amount>|<date>', or None if there is no transaction number or amount."""
+    tx = receipt_store.norm_transaction(extracted_data.get("Transaction_Number"))
+    amount = receipt_store.norm_amount(extracted_data.get("Amount"))
+    if not tx or not amount:
+        return None
+    date = receipt_store.norm_date(extracted_data.get("Receipt_Date")) or ""
+    return f"{tx}|{amount:.2f}|{date}"
+
+
+def _reference(idem_key: str, extracted_data: Dict[str, Any], metadata: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "idem_key": idem_key,
+        "whatsapp_group": metadata.get("group_name"),
+        "sent_at": str(metadata.get("sent_at") or ""),
+        "image_link": extracted_data.get("image_URL") or "",
+    }
+
+
+def describe(original: Dict[str, Any]) -> str:
+    """Sheet text pointing at the original receipt."""
+    where = f"{original.get('whatsapp_group') or '?'} @ {original.get('sent_at') or '?'}"
+    link = original.get("image_link")
+    return f"{where} {link}" if link else where
+
+
+def warm_index(client=None) -> int:
+    """Load every stored payment key into Redis (only when the hash is empty)."""
+    global _warmed
+    client = client or get_redis()
+    if client is None:
+        return 0
+    _warmed = True
+    if client.exists(DEDUP_KEY):
+        return 0
+    loaded = 0
+    pipe = client.pipeline(transaction=False)
+    for key, row in receipt_store.iter_payment_keys():
+        pipe.hsetnx(DEDUP_KEY, key, json.dumps({
+            "idem_key": row["idem_key"], "whatsapp_group": row["whatsapp_group"],
+            "sent_at": row["sent_at"], "image_link": row["image_link"],
+        }))
+        loaded += 1
+        if loaded % 1000 == 0:
+            pipe.execute()
+    pipe.execute()
+    if loaded:
+        logger.info(f"Dedup index warmed with {loaded} payment keys from the local store")
+    return loaded
+
+
+def claim(key: Optional[str], idem_key: str, extracted_data: Dict[str, Any],
+          metadata: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Register this receipt as the owner of `key`, or return the original
+    receipt's reference if another receipt already owns it. Reprocessing the
+    same receipt (same idem_key) is not a duplicate.
+    """
+    if not key:
+        return None
+    ref = _reference(idem_key, extracted_data, metadata)
+
+    client = get_redis()
+    if client is not None:
+        try:
+            if not _warmed:
+                warm_index(client)
+            if client.hsetnx(DEDUP_KEY, key, json.dumps(ref)):
+                return None
+            original = json.loads(client.hget(DEDUP_KEY, key) or "{}")
+            return original if original.get("idem_key") != idem_key else None
+        except Exception as e:
+            logger.warning(f"Dedup probe via Redis failed ({e}), using the local store")
+
+    original = receipt_store.find_original_payment(key)
+    if original is None or original["idem_key"] == idem_key:
+        return None
+    return {k: original.get(k) for k in ("idem_key", "whatsapp_group", "sent_at", "image_link")}
@@ -2,11 +2,20 @@
 # app/utils/drive.py
 
 import os
+import time
+import mimetypes
 import logging
-from typing import Optional
+import threading
+from typing import Dict, List, Optional
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload
+from app.utils.ratelimit import execute
+from app.utils.outbound import google_http
+from app.utils import fakes
+from app.utils.redis_client import get_redis
+from app.utils.metrics import count_failure
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -14,11 +23,41 @@ logging.basicConfig(level=logging.INFO)
 # The scope for uploading files to your own Drive
 SCOPES = ['https://www.googleapis.com/auth/drive']  # Only allows access to files created by the app
 
+# Pre-generated file IDs (see allocate_file_id)
+FILE_ID_POOL_KEY = "drive_file_ids"
+FILE_ID_BATCH = int(os.getenv("DRIVE_FILE_ID_BATCH", "100"))
+_local_file_ids = []
+
+# Files up to this size go up in one multipart request instead of a resumable session
+SIMPLE_UPLOAD_MAX_BYTES = int(os.getenv("DRIVE_SIMPLE_UPLOAD_MAX_BYTES", str(5 * 1024 * 1024)))
+# "folder": share each supplier folder once, files inherit "anyone with the link".
+# "file": one permission per file, sent in batches.
+DRIVE_SHARING = os.getenv("DRIVE_SHARING", "folder")
+PERMISSION_BATCH = int(os.getenv("DRIVE_PERMISSION_BATCH", "100"))   # Drive batch limit is 100
+PERMISSION_FLUSH_S = float(os.getenv("DRIVE_PERMISSION_FLUSH_S", "1"))
+PERMISSION_MAX_ATTEMPTS = int(os.getenv("DRIVE_PERMISSION_MAX_ATTEMPTS", "5"))
+# Queued file IDs live in Redis, so a worker child that exits leaves them to the others
+PERMISSION_QUEUE_KEY = "drive_pending_permissions"
+PERMISSION_ATTEMPTS_KEY = "drive_permission_attempts"
+PERMISSION_LOCK_KEY = "drive_permissions_lock"
+
+FOLDER_CACHE_KEY = "drive_folders"
+SHARED_FOLDERS_KEY = "drive_shared_folders"
+_folder_cache: Dict[str, str] = {}
+_shared_folders = set()
+_pending_permissions: List[str] = []        # without Redis
+_permission_attempts: Dict[str, int] = {}   # without Redis
+_permission_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_permission_thread: Optional[threading.Thread] = None
+
 # Environment variables expected:
 # GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_TOKEN, GOOGLE_REFRESH_TOKEN, DRIVE_FOLDER_ID (optional)
 
 def get_drive_service():
     """Create Google Drive service using personal OAuth credentials."""
+    if fakes.FAKE_GOOGLE:
+        return fakes.drive_service()
     token_info = {
         "token": os.getenv("GOOGLE_TOKEN"),
         "refresh_token": os.getenv("GOOGLE_REFRESH_TOKEN"),
@@ -31,66 +70,295 @@ def get_drive_service():
         raise ValueError("Missing one or more OAuth credentials in environment variables")
 
     creds = Credentials.from_authorized_user_info(token_info, SCOPES)
-    service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+    # Timeout-bound transport: a hung Drive call fails into the retry path
+    service = build('drive', 'v3', http=google_http(creds, "drive"), cache_discovery=False)
     return service
 
 def get_or_create_folder(service, parent_folder_id: str, folder_name: str) -> str:
     """
     Get the folder ID for a given folder name under the parent folder.
-    If it doesn't exist, create it.
+    If it doesn't exist, create it. IDs are cached (process and Redis), so
+    only the first upload to a folder pays for the lookup.
     """
+    cache_key = f"{parent_folder_id}/{folder_name}"
+    if cache_key in _folder_cache:
+        return _folder_cache[cache_key]
+    client = get_redis()
+    if client is not None:
+        try:
+            cached = client.hget(FOLDER_CACHE_KEY, cache_key)
+            if cached:
+                _folder_cache[cache_key] = cached.decode() if isinstance(cached, bytes) else cached
+                return _folder_cache[cache_key]
+        except Exception:
+            pass
+
     query = f"mimeType='application/vnd.google-apps.folder' and trashed=false and name='{folder_name}' and '{parent_folder_id}' in parents"
-    results = service.files().list(q=query, fields="files(id, name)").execute()
+    results = execute(service.files().list(q=query, fields="files(id, name)"), "drive")
     files = results.get("files", [])
 
     if files:
         folder_id = files[0]["id"]
         logger.info(f"✅ Folder already exists: {folder_name} ({folder_id})")
-        return folder_id
+    else:
+        # Folder not found, create it
+        file_metadata = {
+            'name': folder_name,
+            'mimeType': 'application/vnd.google-apps.folder',
+            'parents': [parent_folder_id]
+        }
+        folder = execute(service.files().create(body=file_metadata, fields='id'), "drive")
+        folder_id = folder.get("id")
+        logger.info(f"✅ Created new folder: {folder_name} ({folder_id})")
 
-    # Folder not found, create it
-    file_metadata = {
-        'name': folder_name,
-        'mimeType': 'application/vnd.google-apps.folder',
-        'parents': [parent_folder_id]
-    }
-    folder = service.files().create(body=file_metadata, fields='id').execute()
-    folder_id = folder.get("id")
-    logger.info(f"✅ Created new folder: {folder_name} ({folder_id})")
+    _folder_cache[cache_key] = folder_id
+    if client is not None:
+        try:
+            client.hset(FOLDER_CACHE_KEY, cache_key, folder_id)
+        except Exception:
+            pass
     return folder_id
 
-def upload_file_and_get_link(local_path: str, dest_name: Optional[str] = None, supplier_folder: Optional[str] = None) -> str:
+def ensure_folder_shared(service, folder_id: str):
+    """Give a folder "anyone with the link can view" once; files created in it inherit it."""
+    if folder_id in _shared_folders:
+        return
+    client = get_redis()
+    try:
+        if client is not None and client.sismember(SHARED_FOLDERS_KEY, folder_id):
+            _shared_folders.add(folder_id)
+            return
+    except Exception:
+        client = None
+
+    permissions = execute(service.permissions().list(
+        fileId=folder_id, fields="permissions(type, role)"), "drive").get("permissions", [])
+    if not any(p.get("type") == "anyone" for p in permissions):
+        execute(service.permissions().create(
+            fileId=folder_id,
+            body={'role': 'reader', 'type': 'anyone'}
+        ), "drive")
+        logger.info(f"✅ Shared folder {folder_id} with anyone with the link")
+
+    _shared_folders.add(folder_id)
+    if client is not None:
+        try:
+            client.sadd(SHARED_FOLDERS_KEY, folder_id)
+        except Exception:
+            pass
+
+def _decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+def _queued_permissions(client) -> List[str]:
+    """The next PERMISSION_BATCH queued file IDs (left in the queue until they are settled)."""
+    if client is None:
+        with _permission_lock:
+            return _pending_permissions[:PERMISSION_BATCH]
+    return [_decode(f) for f in client.lrange(PERMISSION_QUEUE_KEY, 0, PERMISSION_BATCH - 1)]
+
+def _pending_count() -> int:
+    client = get_redis()
+    return len(_pending_permissions) + (client.llen(PERMISSION_QUEUE_KEY) if client is not None else 0)
+
+def _settle_permissions(client, shared: List[str], failed: List[str]) -> List[str]:
+    """
+    Drop shared IDs from the queue and move failed ones to its end, up to
+    PERMISSION_MAX_ATTEMPTS times. Returns the IDs given up on.
+    """
+    given_up = []
+    if client is None:
+        with _permission_lock:
+            for file_id in shared + failed:
+                if file_id in _pending_permissions:
+                    _pending_permissions.remove(file_id)
+            for file_id in shared:
+                _permission_attempts.pop(file_id, None)
+            for file_id in failed:
+                _permission_attempts[file_id] = _permission_attempts.get(file_id, 0) + 1
+                if _permission_attempts[file_id] < PERMISSION_MAX_ATTEMPTS:
+                    _pending_permissions.append(file_id)
+                else:
+                    _permission_attempts.pop(file_id)
+                    given_up.append(file_id)
+        return given_up
+
+    attempts = {}
+    if failed:
+        pipe = client.pipeline()
+        for file_id in failed:
+            pipe.hincrby(PERMISSION_ATTEMPTS_KEY, file_id, 1)
+        attempts = dict(zip(failed, pipe.execute()))
+    pipe = client.pipeline()
+    for file_id in shared + failed:
+        pipe.lrem(PERMISSION_QUEUE_KEY, 1, file_id)
+    for file_id in failed:
+        if attempts[file_id] < PERMISSION_MAX_ATTEMPTS:
+            pipe.rpush(PERMISSION_QUEUE_KEY, file_id)
+        else:
+            given_up.append(file_id)
+    if shared or given_up:
+        pipe.hdel(PERMISSION_ATTEMPTS_KEY, *(shared + given_up))
+    pipe.execute()
+    return given_up
+
+def _flush_permissions():
+    """Send queued per-file permissions, up to PERMISSION_BATCH per batch request."""
+    client = get_redis()
+    with _flush_lock:
+        if _pending_permissions:
+            _send_permissions(None)   # queued in this process while Redis was unavailable
+        # One flusher at a time across processes; otherwise another one is already sending this batch
+        if client is None or not client.set(PERMISSION_LOCK_KEY, os.getpid(), nx=True, ex=120):
+            return
+        try:
+            _send_permissions(client)
+        finally:
+            client.delete(PERMISSION_LOCK_KEY)
+
+def _send_permissions(client):
+    file_ids = _queued_permissions(client)
+    if not file_ids:
+        return
+
+    failed = {}
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            failed[request_id] = exception
+
+    service = get_drive_service()
+    batch = service.new_batch_http_request(callback=on_response)
+    for file_id in dict.fromkeys(file_ids):
+        batch.add(service.permissions().create(
+            fileId=file_id,
+            body={'role': 'reader', 'type': 'anyone'}
+        ), request_id=file_id)
+    # If the whole batch fails the IDs stay queued for the next round
+    execute(batch, "drive", tokens=len(file_ids))
+
+    shared = [f for f in file_ids if f not in failed]
+    given_up = _settle_permissions(client, shared, list(failed))
+    for file_id, exception in failed.items():
+        if file_id in given_up:
+            logger.error(f"Failed to share {file_id} {PERMISSION_MAX_ATTEMPTS} times, giving up: {exception}")
+        else:
+            logger.warning(f"Failed to share {file_id}, re-queued: {exception}")
+    if given_up:
+        count_failure("drive_permission", len(given_up))
+    logger.info(f"✅ Shared {len(shared)} file(s) in one batch request")
+
+def _permission_loop():
+    while True:
+        time.sleep(PERMISSION_FLUSH_S)
+        try:
+            while _pending_count():
+                _flush_permissions()
+                time.sleep(PERMISSION_FLUSH_S)
+        except Exception as e:
+            logger.error(f"Batch permission request failed: {e}")
+
+def queue_file_permission(file_id: str):
+    """Share one file with anyone with the link, batched with other files."""
+    global _permission_thread
+    client = get_redis()
+    try:
+        full = client is not None and client.rpush(PERMISSION_QUEUE_KEY, file_id) >= PERMISSION_BATCH
+    except Exception as e:
+        logger.warning(f"Permission queue unavailable, keeping {file_id} in this process: {e}")
+        client = None
+    with _permission_lock:
+        if client is None:
+            _pending_permissions.append(file_id)
+            full = len(_pending_permissions) >= PERMISSION_BATCH
+        if _permission_thread is None or not _permission_thread.is_alive():
+            _permission_thread = threading.Thread(target=_permission_loop, name="drive-permissions", daemon=True)
+            _permission_thread.start()
+    if full:
+        _flush_permissions()
+
+def file_link(file_id: str) -> str:
+    """Shareable view link of a Drive file (same form as webViewLink)."""
+    return f"https://drive.google.com/file/d/{file_id}/view?usp=drivesdk"
+
+def allocate_file_id(service=None) -> Optional[str]:
+    """
+    Take one pre-generated Drive file ID, so the file's link is known before it is uploaded.
+    IDs are generated FILE_ID_BATCH at a time and shared between workers through Redis.
+    Returns None if no ID could be obtained.
+    """
+    client = get_redis()
+    try:
+        if client is not None:
+            file_id = client.lpop(FILE_ID_POOL_KEY)
+            if file_id:
+                return file_id.decode() if isinstance(file_id, bytes) else file_id
+        elif _local_file_ids:
+            return _local_file_ids.pop()
+
+        service = service or get_drive_service()
+        ids = execute(service.files().generateIds(count=FILE_ID_BATCH, space='drive'), "drive").get("ids", [])
+        if not ids:
+            return None
+        file_id, rest = ids[0], ids[1:]
+        if rest:
+            if client is not None:
+                client.rpush(FILE_ID_POOL_KEY, *rest)
+            else:
+                _local_file_ids.extend(rest)
+        return file_id
+    except Exception as e:
+        logger.warning(f"Could not allocate a Drive file ID: {e}")
+        return None
+
+def upload_file_and_get_link(local_path: str, dest_name: Optional[str] = None, supplier_folder: Optional[str] = None,
+                             file_id: Optional[str] = None, mimetype: Optional[str] = None) -> str:
     """
     Upload a local file to Google Drive.
     - supplier_folder: name of supplier folder; creates if not exist.
+    - file_id: pre-allocated ID (see allocate_file_id); re-uploading the same ID is a no-op.
+    - mimetype: defaults to a guess from dest_name.
     Returns shareable link.
     """
-    service = get_drive_service()
-    parent_folder_id = os.getenv("DRIVE_FOLDER_ID")  # Root parent folder
-    folder_id = parent_folder_id
+    try:
+        # Folder lookup and sharing fail like the upload itself (HttpError, CircuitOpenError)
+        service = get_drive_service()
+        parent_folder_id = os.getenv("DRIVE_FOLDER_ID")  # Root parent folder
+        folder_id = parent_folder_id
 
-    if supplier_folder:
-        folder_id = get_or_create_folder(service, parent_folder_id, supplier_folder)
+        if supplier_folder:
+            folder_id = get_or_create_folder(service, parent_folder_id, supplier_folder)
 
-    file_metadata = {'name': dest_name or os.path.basename(local_path)}
-    if folder_id:
-        file_metadata['parents'] = [folder_id]
+        file_metadata = {'name': dest_name or os.path.basename(local_path)}
+        if folder_id:
+            file_metadata['parents'] = [folder_id]
+        if file_id:
+            file_metadata['id'] = file_id
 
-    media = MediaFileUpload(local_path, resumable=True)
+        if DRIVE_SHARING == "folder" and folder_id:
+            ensure_folder_shared(service, folder_id)
 
-    try:
-        created_file = service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id, webViewLink'
-        ).execute()
+        # Receipts are small: one multipart request, no resumable session to open first
+        mimetype = mimetype or mimetypes.guess_type(file_metadata['name'])[0] or 'application/octet-stream'
+        media = MediaFileUpload(local_path, mimetype=mimetype,
+                                resumable=os.path.getsize(local_path) > SIMPLE_UPLOAD_MAX_BYTES)
+
+        try:
+            created_file = execute(service.files().create(
+                body=file_metadata,
+                media_body=media,
+                fields='id, webViewLink'
+            ), "drive")
+        except HttpError as e:
+            # 409: a previous attempt already created this pre-allocated file
+            if not file_id or getattr(e.resp, "status", None) != 409:
+                raise
+            created_file = {'id': file_id, 'webViewLink': file_link(file_id)}
         file_id = created_file.get('id')
 
-        # Make file accessible by anyone with the link
-        service.permissions().create(
-            fileId=file_id,
-            body={'role': 'reader', 'type': 'anyone'}
-        ).execute()
+        # Make file accessible by anyone with the link (inherited when its folder is shared)
+        if DRIVE_SHARING != "folder" or not folder_id:
+            queue_file_permission(file_id)
 
         link = created_file.get('webViewLink')
         logger.info(f"Uploaded file to Drive: {link}")
@@ -101,7 +369,6 @@ def upload_file_and_get_link(local_path: str, dest_name: Optional[str] = None, s
         return ""
 
 
-
 # def upload_file_and_get_link(local_path: str, dest_name: Optional[str] = None) -> str:
 #     """
 #     Upload a local file to the client's personal Google Drive and return a shareable link.
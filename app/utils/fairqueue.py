@@ -0,0 +1,249 @@
+
+# app/utils/fairqueue.py
+#
+# Per-group fair scheduling in front of the Celery queue. The webhook does not
+# queue process_receipt directly: it pushes the job onto its WhatsApp group's
+# own Redis list, and a dispatcher in the worker's main process moves jobs to
+# Celery in weighted round-robin over the groups (deficit round-robin: a group
+# with weight 3 gets up to 3 jobs per turn). Only a few jobs are kept in the
+# Celery queue itself, so a group that posts 200 receipts at once waits behind
+# its own backlog while a quiet group's receipt is at most one turn away.
+#
+# Jobs posted with "priority": true go to a priority lane that is served
+# first, but never more than FAIRQ_PRIORITY_STREAK times in a row while
+# groups are waiting. The lane is itself split per group and served
+# round-robin, so one group's flagged burst cannot hold back another's.
+# FAIRQ_PRIORITY_MAX_BYTES (off by default) also sends tiny images there;
+# keep it well below a typical receipt or it turns the lane back into FIFO.
+#
+#   GROUP_WEIGHTS='{"Pagos Ortega": 3, "Tarjeta": 2}'   # others weigh 1
+#   python -m app.utils.fairqueue status                 # backlog per group
+#
+# FAIR_QUEUE=0 (or Redis down) queues straight to Celery, FIFO, as before.
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.utils.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+FAIR_QUEUE = os.getenv("FAIR_QUEUE", "1") != "0"
+CELERY_QUEUE = os.getenv("CELERY_QUEUE", "celery")
+PREFETCH = int(os.getenv("FAIRQ_PREFETCH", "4"))   # jobs kept waiting in the Celery queue
+POLL_S = float(os.getenv("FAIRQ_POLL_S", "0.2"))
+PRIORITY_MAX_BYTES = int(os.getenv("FAIRQ_PRIORITY_MAX_BYTES", "0"))
+PRIORITY_STREAK = int(os.getenv("FAIRQ_PRIORITY_STREAK", "4"))
+
+KEY_PREFIX = "fairq"
+PRIORITY_RING_KEY = f"{KEY_PREFIX}:pring"   # groups with priority jobs, in turn order
+PRIORITY_PREFIX = f"{KEY_PREFIX}:p:"
+RING_KEY = f"{KEY_PREFIX}:ring"           # groups with queued jobs, in turn order
+CREDIT_KEY = f"{KEY_PREFIX}:credit"       # jobs a group may still take this turn
+WEIGHT_KEY = f"{KEY_PREFIX}:weight"
+GROUP_PREFIX = f"{KEY_PREFIX}:q:"
+
+
+def _load_weights() -> Dict[str, int]:
+    raw = os.getenv("GROUP_WEIGHTS", "").strip()
+    if not raw:
+        return {}
+    try:
+        return {str(k).strip().lower(): max(1, int(v)) for k, v in json.loads(raw).items()}
+    except Exception as e:
+        logger.error(f"Invalid GROUP_WEIGHTS, all groups weigh 1: {e}")
+        return {}
+
+
+GROUP_WEIGHTS = _load_weights()
+
+# A group is in a ring exactly when its list is not empty: the push that
+# makes the list non-empty adds it, the pop that empties it drops it.
+# Used for both lanes (group queue + ring, or priority queue + priority ring).
+_PUSH_SCRIPT = """
+redis.call('HSET', KEYS[3], ARGV[2], ARGV[3])
+local n = redis.call('RPUSH', KEYS[1], ARGV[1])
+if n == 1 then redis.call('RPUSH', KEYS[2], ARGV[2]) end
+return n
+"""
+
+# Priority lane: one job per group per turn. Group lane: weighted turns.
+# Returns {lane, group, job} with lane 'p' or 'g'.
+_POP_SCRIPT = """
+local function pop_priority()
+  local group = redis.call('LPOP', KEYS[1])
+  if not group then return false end
+  local qkey = ARGV[3] .. group
+  local job = redis.call('LPOP', qkey)
+  if redis.call('LLEN', qkey) > 0 then redis.call('RPUSH', KEYS[1], group) end
+  if not job then return false end
+  return {'p', group, job}
+end
+if ARGV[2] == '1' then
+  local item = pop_priority()
+  if item then return item end
+end
+local group = redis.call('LPOP', KEYS[2])
+if not group then
+  return pop_priority()
+end
+local qkey = ARGV[1] .. group
+local job = redis.call('LPOP', qkey)
+local credit = tonumber(redis.call('HGET', KEYS[3], group) or '0')
+if credit <= 0 then credit = tonumber(redis.call('HGET', KEYS[4], group) or '1') end
+credit = credit - 1
+if redis.call('LLEN', qkey) == 0 then
+  redis.call('HDEL', KEYS[3], group)
+elseif credit > 0 then
+  redis.call('HSET', KEYS[3], group, credit)
+  redis.call('LPUSH', KEYS[2], group)
+else
+  redis.call('HDEL', KEYS[3], group)
+  redis.call('RPUSH', KEYS[2], group)
+end
+if not job then return false end
+return {'g', group, job}
+"""
+
+_scripts: Dict[str, Any] = {}
+
+
+def _script(client, name: str):
+    if name not in _scripts:
+        _scripts[name] = client.register_script(_PUSH_SCRIPT if name == "push" else _POP_SCRIPT)
+    return _scripts[name]
+
+
+def weight(group: str) -> int:
+    return GROUP_WEIGHTS.get(group.strip().lower(), 1)
+
+
+def is_priority(metadata: Dict[str, Any]) -> bool:
+    if metadata.get("priority"):
+        return True
+    size = metadata.get("file_size")
+    return PRIORITY_MAX_BYTES > 0 and isinstance(size, int) and 0 < size <= PRIORITY_MAX_BYTES
+
+
+def submit(image_base64: Optional[str], metadata: Dict[str, Any]) -> bool:
+    """
+    Queue a receipt on its group's fair queue (or the priority lane).
+    False if fair queuing is off or Redis is unreachable: the caller then
+    queues the task directly.
+    """
+    client = get_redis()
+    if not FAIR_QUEUE or client is None:
+        return False
+    group = str(metadata.get("group_name") or "Unknown Group")
+    job = json.dumps({"image": image_base64, "metadata": metadata}, ensure_ascii=False, default=str)
+    try:
+        queue, ring = (PRIORITY_PREFIX, PRIORITY_RING_KEY) if is_priority(metadata) else (GROUP_PREFIX, RING_KEY)
+        _script(client, "push")(keys=[queue + group, ring, WEIGHT_KEY], args=[job, group, weight(group)])
+        return True
+    except Exception as e:
+        logger.warning(f"Fair queue unavailable, queueing directly: {e}")
+        return False
+
+
+def _pop(client, allow_priority: bool) -> Optional[Tuple[bool, Dict[str, Any]]]:
+    """(from the priority lane, job) of the next job to run, or None."""
+    item = _script(client, "pop")(keys=[PRIORITY_RING_KEY, RING_KEY, CREDIT_KEY, WEIGHT_KEY],
+                                  args=[GROUP_PREFIX, "1" if allow_priority else "0", PRIORITY_PREFIX])
+    if not item:
+        return None
+    lane, _, job = item
+    return lane in (b"p", "p"), json.loads(job)
+
+
+def dispatch_once(send: Callable[[Optional[str], Dict[str, Any]], Any], streak: int = 0) -> Tuple[int, int]:
+    """
+    Move jobs to Celery until PREFETCH are waiting there. Returns (jobs moved,
+    priority streak) so the caller can carry the streak to the next call.
+    """
+    client = get_redis()
+    if client is None:
+        return 0, streak
+    moved = 0
+    room = PREFETCH - client.llen(CELERY_QUEUE)
+    while moved < room:
+        item = _pop(client, allow_priority=streak < PRIORITY_STREAK)
+        if item is None:
+            break
+        priority, job = item
+        streak = streak + 1 if priority else 0
+        try:
+            send(job["image"], job["metadata"])
+        except Exception as e:
+            # Back to the end of its queue rather than lost
+            logger.error(f"Dispatch failed for {job['metadata'].get('message_id')}: {e}")
+            submit(job["image"], job["metadata"])
+            break
+        moved += 1
+    return moved, streak
+
+
+def run_dispatcher(send: Callable[[Optional[str], Dict[str, Any]], Any], stop: Optional[threading.Event] = None):
+    stop = stop or threading.Event()
+    logger.info(f"⚖️ Fair-queue dispatcher started (prefetch {PREFETCH}, weights {GROUP_WEIGHTS or 'all 1'})")
+    streak = 0
+    while not stop.is_set():
+        try:
+            moved, streak = dispatch_once(send, streak)
+        except Exception as e:
+            logger.error(f"Fair-queue dispatch error: {e}")
+            moved = 0
+        if not moved:
+            stop.wait(POLL_S)
+
+
+def start_dispatcher_thread(send: Callable[[Optional[str], Dict[str, Any]], Any]) -> threading.Event:
+    """Run the dispatcher in a daemon thread; set the returned event to stop it."""
+    stop = threading.Event()
+    threading.Thread(target=run_dispatcher, args=(send, stop), name="fairq-dispatcher", daemon=True).start()
+    return stop
+
+
+def _decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def backlog(client=None, limit: int = 50) -> Dict[str, Any]:
+    """Jobs waiting in the priority lane and per group (largest `limit` groups)."""
+    client = client or get_redis()
+    if client is None:
+        return {"priority": 0, "groups": {}}
+    groups = [_decode(g) for g in client.lrange(RING_KEY, 0, -1)]
+    priority_groups = [_decode(g) for g in client.lrange(PRIORITY_RING_KEY, 0, -1)]
+    pipe = client.pipeline(transaction=False)
+    for group in priority_groups:
+        pipe.llen(PRIORITY_PREFIX + group)
+    for group in groups:
+        pipe.llen(GROUP_PREFIX + group)
+    counts = pipe.execute()
+    per_group = sorted(zip(groups, counts[len(priority_groups):]), key=lambda gc: -gc[1])[:limit]
+    return {"priority": sum(counts[:len(priority_groups)]), "groups": dict(per_group)}
+
+
+def stats() -> Dict[str, Any]:
+    client = get_redis()
+    if client is None:
+        raise RuntimeError("Redis is not reachable")
+    out = backlog(client, limit=1000)
+    out["celery"] = client.llen(CELERY_QUEUE)
+    out["waiting"] = out["priority"] + sum(out["groups"].values())
+    out["checked_at"] = time.time()
+    return out
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if command == "status":
+        print(json.dumps(stats(), indent=2, ensure_ascii=False))
+    else:
+        sys.exit(f"unknown command: {command}")
@@ -0,0 +1,579 @@
+
+# app/utils/fakes.py
+#
+# Offline stand-ins for the external services, for load tests on a laptop.
+#
+#   FAKE_GOOGLE=1     gsheet.get_sheets_service() / drive.get_drive_service()
+#                     return in-process fakes of the Sheets and Drive calls the
+#                     bot makes (no credentials, no network). They go through
+#                     ratelimit.execute like the real clients, so quota and
+#                     backoff behave as in production.
+#
+#   python -m app.utils.fakes whatsapp [port]
+#                     fake WhatsApp Graph media API (GET /<version>/<media_id>
+#                     and the media download), serving images from
+#                     FAKE_WHATSAPP_MEDIA_DIR. Point main.py at it with
+#                     WHATSAPP_GRAPH_URL=http://127.0.0.1:<port>.
+#
+# Each service has a latency / error / quota model set from the environment
+# (<API> is SHEETS, DRIVE or WHATSAPP):
+#
+#   FAKE_<API>_LATENCY_MS    mean latency per call (uniform +-50%)
+#   FAKE_<API>_ERROR_RATE    fraction of calls failing with 503
+#   FAKE_<API>_QUOTA_PER_MIN calls per minute before 429s (0 = unlimited);
+#                            counted in Redis when available, so the quota
+#                            is shared by all workers like Google's
+#   FAKE_<API>_RETRY_AFTER   Retry-After seconds sent with 429s (0 = none)
+#   FAKE_DRIVE_MS_PER_MB     extra upload time per MB of media
+#
+# Fake sheet and Drive contents live in process memory.
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import hashlib
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.utils.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+FAKE_GOOGLE = os.getenv("FAKE_GOOGLE", "0") == "1"
+FAKE_WHATSAPP_MEDIA_DIR = os.getenv(
+    "FAKE_WHATSAPP_MEDIA_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "incoming")
+)
+
+_DEFAULTS = {
+    # latency ms, error rate, quota per minute
+    "sheets": (120.0, 0.0, 60),
+    "drive": (200.0, 0.0, 12000),
+    "whatsapp": (150.0, 0.0, 0),
+}
+QUOTA_KEY_PREFIX = "fake_quota"
+
+
+class FaultModel:
+    """Latency, random failures and a per-minute quota for one fake API."""
+
+    def __init__(self, api: str):
+        latency_ms, error_rate, quota = _DEFAULTS[api]
+        prefix = f"FAKE_{api.upper()}_"
+        self.api = api
+        self.latency_s = float(os.getenv(prefix + "LATENCY_MS", str(latency_ms))) / 1000
+        self.error_rate = float(os.getenv(prefix + "ERROR_RATE", str(error_rate)))
+        self.quota_per_min = int(os.getenv(prefix + "QUOTA_PER_MIN", str(quota)))
+        self.retry_after = float(os.getenv(prefix + "RETRY_AFTER", "0"))
+        self.stats = {"calls": 0, "errors": 0, "throttled": 0}
+        self._window = (0, 0)   # (minute, calls) when Redis is not available
+        self._lock = threading.Lock()
+
+    def _over_quota(self, calls: int) -> bool:
+        if self.quota_per_min <= 0:
+            return False
+        minute = int(time.time() // 60)
+        client = get_redis()
+        if client is not None:
+            try:
+                key = f"{QUOTA_KEY_PREFIX}:{self.api}:{minute}"
+                pipe = client.pipeline(transaction=False)
+                pipe.incrby(key, calls)
+                pipe.expire(key, 120)
+                used = pipe.execute()[0]
+                return used > self.quota_per_min
+            except Exception:
+                pass
+        with self._lock:
+            if self._window[0] != minute:
+                self._window = (minute, 0)
+            self._window = (minute, self._window[1] + calls)
+            return self._window[1] > self.quota_per_min
+
+    def check(self, calls: int = 1, extra_s: float = 0.0) -> Optional[Tuple[int, str]]:
+        """
+        Sleep for one call's latency. Returns (status, message) if the call
+        fails, None if it succeeds.
+        """
+        time.sleep(max(0.0, self.latency_s * random.uniform(0.5, 1.5) + extra_s))
+        with self._lock:
+            self.stats["calls"] += 1
+        if self._over_quota(calls):
+            with self._lock:
+                self.stats["throttled"] += 1
+            return 429, "Quota exceeded for quota metric 'Requests' (rateLimitExceeded)"
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.stats["errors"] += 1
+            return 503, "The service is currently unavailable."
+        return None
+
+
+_models: Dict[str, FaultModel] = {}
+_models_lock = threading.Lock()
+
+
+def fault_model(api: str) -> FaultModel:
+    with _models_lock:
+        if api not in _models:
+            _models[api] = FaultModel(api)
+        return _models[api]
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """Calls, injected errors and 429s per fake API in this process."""
+    with _models_lock:
+        return {api: dict(model.stats) for api, model in _models.items()}
+
+
+def _http_error(status: int, message: str, uri: str, retry_after: float = 0.0):
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    headers = {"status": str(status), "content-type": "application/json"}
+    if status == 429 and retry_after:
+        headers["retry-after"] = str(int(retry_after))
+    content = json.dumps({"error": {"code": status, "message": message}}).encode()
+    return HttpError(httplib2.Response(headers), content, uri=uri)
+
+
+class FakeRequest:
+    """Stands in for googleapiclient's HttpRequest: .execute() runs the call."""
+
+    def __init__(self, api: str, uri: str, run: Callable[[], Any], calls: int = 1, extra_s: float = 0.0):
+        self.api = api
+        self.uri = uri
+        self._run = run
+        self._calls = calls
+        self._extra_s = extra_s
+
+    def execute(self, num_retries: int = 0):
+        model = fault_model(self.api)
+        failure = model.check(self._calls, self._extra_s)
+        if failure:
+            raise _http_error(*failure, uri=self.uri, retry_after=model.retry_after)
+        return self._run()
+
+
+class _Failure(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _call(api: str, uri: str, fn: Callable[[], Any], **kwargs) -> FakeRequest:
+    def run():
+        try:
+            return fn()
+        except _Failure as e:
+            raise _http_error(e.status, str(e), uri=uri)
+    return FakeRequest(api, uri, run, **kwargs)
+
+
+# ------------------- Sheets -------------------
+
+def _column_index(letters: str) -> int:
+    n = 0
+    for c in letters:
+        n = n * 26 + ord(c) - ord("A") + 1
+    return n - 1
+
+
+def _column_letters(index: int) -> str:
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+
+def _parse_range(a1: str) -> Tuple[str, int, Optional[int], int, Optional[int]]:
+    """'tab!B2:D' -> (tab, first_row, last_row, first_col, last_col), 0-based, None = open."""
+    title, _, cells = a1.partition("!")
+    title = title.strip("'")
+    match = re.fullmatch(r"([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?", cells or "")
+    if not match:
+        raise _Failure(400, f"Unable to parse range: {a1}")
+    c1, r1, c2, r2 = match.groups()
+    first_col = _column_index(c1) if c1 else 0
+    first_row = int(r1) - 1 if r1 else 0
+    if match.group(3) is None and match.group(4) is None:
+        # Single cell ('A1') or whole column without ':' is not used by the bot
+        last_col = first_col if (c1 and r1) else None
+        last_row = first_row if (c1 and r1) else None
+    else:
+        last_col = _column_index(c2) if c2 else None
+        last_row = int(r2) - 1 if r2 else None
+    return title, first_row, last_row, first_col, last_col
+
+
+def _entered(value: Any) -> Any:
+    """A cell as USER_ENTERED stores it: a leading apostrophe only marks the value as text."""
+    if value is None:
+        return ""
+    return value[1:] if isinstance(value, str) and value.startswith("'") else value
+
+
+class FakeSheets:
+    """In-memory spreadsheets: {spreadsheet_id: {tab: [[cell, ...], ...]}}."""
+
+    def __init__(self):
+        self.spreadsheets_data: Dict[str, Dict[str, List[List[Any]]]] = {}
+        self.lock = threading.Lock()
+
+    def _tabs(self, spreadsheet_id: str) -> Dict[str, List[List[Any]]]:
+        return self.spreadsheets_data.setdefault(spreadsheet_id, {})
+
+    def _tab(self, spreadsheet_id: str, title: str, a1: str) -> List[List[Any]]:
+        tabs = self._tabs(spreadsheet_id)
+        if title not in tabs:
+            raise _Failure(400, f"Unable to parse range: {a1}")
+        return tabs[title]
+
+    def get(self, spreadsheet_id: str) -> Dict[str, Any]:
+        with self.lock:
+            titles = list(self._tabs(spreadsheet_id))
+        return {
+            "spreadsheetId": spreadsheet_id,
+            "sheets": [{"properties": {"sheetId": i, "title": t, "index": i}} for i, t in enumerate(titles)],
+        }
+
+    def batch_update(self, spreadsheet_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        replies = []
+        with self.lock:
+            tabs = self._tabs(spreadsheet_id)
+            for request in body.get("requests", []):
+                if "updateDimensionProperties" in request:
+                    replies.append({})   # column visibility is not modelled
+                    continue
+                if "addSheet" not in request:
+                    raise _Failure(400, f"Unsupported request in fake: {list(request)}")
+                title = request["addSheet"]["properties"]["title"]
+                if title in tabs:
+                    raise _Failure(400, f'Invalid requests[0].addSheet: A sheet with the name "{title}" already exists. '
+                                        f'Please enter another name.')
+                tabs[title] = []
+                replies.append({"addSheet": {"properties": {"title": title, "sheetId": len(tabs) - 1}}})
+        return {"spreadsheetId": spreadsheet_id, "replies": replies}
+
+    def values_get(self, spreadsheet_id: str, a1: str) -> Dict[str, Any]:
+        title, first_row, last_row, first_col, last_col = _parse_range(a1)
+        with self.lock:
+            rows = self._tab(spreadsheet_id, title, a1)
+            selected = rows[first_row:None if last_row is None else last_row + 1]
+            values = [[("" if v is None else v) for v in row[first_col:None if last_col is None else last_col + 1]]
+                      for row in selected]
+        # Like Sheets: trailing empty cells and rows are left out
+        values = [row[:max([i + 1 for i, v in enumerate(row) if v != ""] or [0])] for row in values]
+        while values and not values[-1]:
+            values.pop()
+        return {"range": a1, "majorDimension": "ROWS", "values": values} if values else {"range": a1}
+
+    def values_update(self, spreadsheet_id: str, a1: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        title, first_row, _, first_col, _ = _parse_range(a1)
+        values = body.get("values", [])
+        with self.lock:
+            rows = self._tab(spreadsheet_id, title, a1)
+            for offset, new_row in enumerate(values):
+                r = first_row + offset
+                while len(rows) <= r:
+                    rows.append([])
+                row = rows[r]
+                while len(row) < first_col + len(new_row):
+                    row.append("")
+                row[first_col:first_col + len(new_row)] = [_entered(v) for v in new_row]
+        return {"spreadsheetId": spreadsheet_id, "updatedRange": a1, "updatedRows": len(values)}
+
+    def values_append(self, spreadsheet_id: str, a1: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        title, first_row, _, first_col, _ = _parse_range(a1)
+        values = body.get("values", [])
+        with self.lock:
+            rows = self._tab(spreadsheet_id, title, a1)
+            while len(rows) < first_row:
+                rows.append([])
+            start = len(rows) + 1
+            rows.extend([[_entered(v) for v in row] for row in values])
+            end = len(rows)
+        width = max([len(r) for r in values] or [1])
+        updated = f"{title}!{_column_letters(first_col)}{start}:{_column_letters(first_col + width - 1)}{end}"
+        return {
+            "spreadsheetId": spreadsheet_id,
+            "tableRange": f"{title}!A1:{_column_letters(first_col + width - 1)}{start - 1}",
+            "updates": {"spreadsheetId": spreadsheet_id, "updatedRange": updated,
+                        "updatedRows": len(values), "updatedCells": sum(len(r) for r in values)},
+        }
+
+
+class _SheetsValues:
+    def __init__(self, store: FakeSheets):
+        self._store = store
+
+    def get(self, spreadsheetId, range, **kwargs):
+        return _call("sheets", f"sheets.values.get {range}", lambda: self._store.values_get(spreadsheetId, range))
+
+    def update(self, spreadsheetId, range, body, **kwargs):
+        return _call("sheets", f"sheets.values.update {range}",
+                     lambda: self._store.values_update(spreadsheetId, range, body))
+
+    def append(self, spreadsheetId, range, body, **kwargs):
+        return _call("sheets", f"sheets.values.append {range}",
+                     lambda: self._store.values_append(spreadsheetId, range, body))
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        def run():
+            for data in body.get("data", []):
+                self._store.values_update(spreadsheetId, data["range"], data)
+            return {"spreadsheetId": spreadsheetId, "totalUpdatedCells": len(body.get("data", []))}
+        return _call("sheets", "sheets.values.batchUpdate", run)
+
+
+class _Spreadsheets:
+    def __init__(self, store: FakeSheets):
+        self._store = store
+
+    def get(self, spreadsheetId, **kwargs):
+        return _call("sheets", "sheets.get", lambda: self._store.get(spreadsheetId))
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        return _call("sheets", "sheets.batchUpdate", lambda: self._store.batch_update(spreadsheetId, body))
+
+    def values(self):
+        return _SheetsValues(self._store)
+
+
+class FakeSheetsService:
+    def __init__(self, store: FakeSheets):
+        self._store = store
+
+    def spreadsheets(self):
+        return _Spreadsheets(self._store)
+
+
+# ------------------- Drive -------------------
+
+def _drive_id() -> str:
+    return "1" + base64.urlsafe_b64encode(uuid.uuid4().bytes + os.urandom(8)).decode().rstrip("=")[:32]
+
+
+class FakeDrive:
+    """In-memory Drive: files {id: metadata} and permissions {id: [permission]}."""
+
+    FOLDER_QUERY = re.compile(r"name='(?P<name>[^']*)' and '(?P<parent>[^']*)' in parents")
+
+    def __init__(self):
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.permissions: Dict[str, List[Dict[str, Any]]] = {}
+        self.lock = threading.Lock()
+
+    def list(self, q: str) -> Dict[str, Any]:
+        match = self.FOLDER_QUERY.search(q or "")
+        with self.lock:
+            found = [
+                {"id": fid, "name": f["name"]} for fid, f in self.files.items()
+                if not f.get("trashed")
+                and (match is None or (f["name"] == match["name"] and match["parent"] in f.get("parents", [])))
+                and ("mimeType='application/vnd.google-apps.folder'" not in (q or "")
+                     or f.get("mimeType") == "application/vnd.google-apps.folder")
+            ]
+        return {"files": found}
+
+    def create(self, body: Dict[str, Any], size: int) -> Dict[str, Any]:
+        file_id = body.get("id") or _drive_id()
+        with self.lock:
+            if file_id in self.files:
+                raise _Failure(409, f"A file already exists with the provided ID: {file_id}.")
+            self.files[file_id] = dict(body, id=file_id, size=size, createdTime=time.time())
+        return {"id": file_id, "webViewLink": f"https://drive.google.com/file/d/{file_id}/view?usp=drivesdk"}
+
+    def list_permissions(self, file_id: str) -> Dict[str, Any]:
+        with self.lock:
+            return {"permissions": list(self.permissions.get(file_id, []))}
+
+    def create_permission(self, file_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        permission = dict(body, id=_drive_id()[:20])
+        with self.lock:
+            self.permissions.setdefault(file_id, []).append(permission)
+        return permission
+
+
+class _DriveFiles:
+    def __init__(self, store: FakeDrive):
+        self._store = store
+
+    def list(self, q=None, **kwargs):
+        return _call("drive", "drive.files.list", lambda: self._store.list(q))
+
+    def create(self, body, media_body=None, **kwargs):
+        size = media_body.size() if media_body is not None else 0
+        extra_s = size / 1e6 * float(os.getenv("FAKE_DRIVE_MS_PER_MB", "400")) / 1000
+        return _call("drive", "drive.files.create", lambda: self._store.create(body, size), extra_s=extra_s)
+
+    def generateIds(self, count=10, **kwargs):
+        return _call("drive", "drive.files.generateIds", lambda: {"ids": [_drive_id() for _ in range(count)]})
+
+
+class _DrivePermissions:
+    def __init__(self, store: FakeDrive):
+        self._store = store
+
+    def list(self, fileId, **kwargs):
+        return _call("drive", "drive.permissions.list", lambda: self._store.list_permissions(fileId))
+
+    def create(self, fileId, body, **kwargs):
+        return _call("drive", "drive.permissions.create", lambda: self._store.create_permission(fileId, body))
+
+
+class FakeBatch:
+    """new_batch_http_request(): one round trip, each inner call counted against the quota."""
+
+    def __init__(self, callback: Optional[Callable] = None):
+        self._callback = callback
+        self._requests: List[Tuple[str, FakeRequest]] = []
+
+    def add(self, request: FakeRequest, callback: Optional[Callable] = None, request_id: Optional[str] = None):
+        self._requests.append((request_id or str(len(self._requests) + 1), request))
+
+    def execute(self):
+        model = fault_model("drive")
+        failure = model.check(calls=len(self._requests))
+        if failure:
+            raise _http_error(*failure, uri="drive.batch", retry_after=model.retry_after)
+        for request_id, request in self._requests:
+            response, exception = None, None
+            try:
+                response = request._run()
+            except Exception as e:
+                exception = e
+            if self._callback:
+                self._callback(request_id, response, exception)
+
+
+class FakeDriveService:
+    def __init__(self, store: FakeDrive):
+        self._store = store
+
+    def files(self):
+        return _DriveFiles(self._store)
+
+    def permissions(self):
+        return _DrivePermissions(self._store)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(callback)
+
+
+_sheets = FakeSheets()
+_drive = FakeDrive()
+
+
+def sheets_service() -> FakeSheetsService:
+    return FakeSheetsService(_sheets)
+
+
+def drive_service() -> FakeDriveService:
+    return FakeDriveService(_drive)
+
+
+def sheet_rows(spreadsheet_id: str) -> Dict[str, int]:
+    """Rows per tab of a fake spreadsheet (headers included)."""
+    with _sheets.lock:
+        return {title: len(rows) for title, rows in _sheets.spreadsheets_data.get(spreadsheet_id, {}).items()}
+
+
+# ------------------- WhatsApp -------------------
+
+def listener_payload(image_bytes: bytes, message_id: Optional[str] = None, group_name: str = "Load Test",
+                     sender_jid: str = "5491100000000@s.whatsapp.net") -> Dict[str, Any]:
+    """The JSON body listener/index.js posts to /webhook for one group image."""
+    message_id = message_id or uuid.uuid4().hex[:20].upper()
+    timestamp = int(time.time())
+    return {
+        "image_base64": base64.b64encode(image_bytes).decode("utf-8"),
+        "image_filename": f"{timestamp}_{message_id}.jpg",
+        "sender_jid": sender_jid,
+        "message_id": message_id,
+        "group_name": group_name,
+        "sent_at": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(timestamp)),
+    }
+
+
+def media_files(directory: str = FAKE_WHATSAPP_MEDIA_DIR) -> List[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, n) for n in os.listdir(directory)
+        if n.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))
+    )
+
+
+def serve_whatsapp(port: int = 8090, host: str = "127.0.0.1", media_dir: str = FAKE_WHATSAPP_MEDIA_DIR):
+    """Fake Graph media API: GET /<version>/<media_id> -> {"url": ...}, GET /media/<media_id> -> bytes."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    images = media_files(media_dir)
+    if not images:
+        raise SystemExit(f"No images in {media_dir}")
+    model = fault_model("whatsapp")
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            failure = model.check()
+            if failure:
+                status, message = failure
+                headers = {"Retry-After": str(int(model.retry_after))} if status == 429 and model.retry_after else None
+                body = json.dumps({"error": {"message": message, "code": status}}).encode()
+                return self._send(status, body, "application/json", headers)
+
+            parts = [p for p in self.path.split("?")[0].split("/") if p]
+            if len(parts) == 2 and parts[0] == "media":
+                # The same media_id always maps to the same image
+                index = int(hashlib.sha256(parts[1].encode()).hexdigest(), 16) % len(images)
+                with open(images[index], "rb") as f:
+                    return self._send(200, f.read(), "image/jpeg")
+            if len(parts) == 2:
+                media_id = parts[1]
+                host_header = self.headers.get("Host") or f"{host}:{port}"
+                body = json.dumps({
+                    "id": media_id,
+                    "url": f"http://{host_header}/media/{media_id}",
+                    "mime_type": "image/jpeg",
+                    "messaging_product": "whatsapp",
+                }).encode()
+                return self._send(200, body, "application/json")
+            self._send(404, b'{"error": {"message": "Unknown path"}}', "application/json")
+
+        def log_message(self, fmt, *args):
+            logger.debug(fmt % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    logger.info(f"Fake WhatsApp Graph API on http://{host}:{port} serving {len(images)} image(s) from {media_dir}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    command, args = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else ("help", [])
+    if command == "whatsapp":
+        serve_whatsapp(int(args[0]) if args else 8090)
+    else:
+        print("usage: python -m app.utils.fakes whatsapp [port]")
+        sys.exit(1)
@@ -169,16 +169,30 @@
 
 import logging
 import os
+import re
 import json
+import time
+import threading
+from app.utils import fakes
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from typing import List
+from typing import List, Dict, Any
+from app.utils.ratelimit import execute
+from app.utils.outbound import google_http
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
+# Headers
+SHEET_HEADERS = [
+    "Receipt_Date", "Amount", "Sender_CUIT", "Transaction_Number",'Supplier', "Destination_Bank",
+    "WhatsApp_Group", "Receipt_Sent_Time", "Image_Link", "Duplicate_Of"
+]
+# Hidden, unlabelled column after the headers: the outbox idempotency key of each row
+ROW_KEY_COLUMN = chr(ord("A") + len(SHEET_HEADERS))
+
 def get_credentials():
     google_creds_json = os.getenv("GOOGLE_SERVICE_ACCOUNT")
     if not google_creds_json:
@@ -190,17 +204,72 @@ def get_credentials():
     )
     return creds
 
-def write_row(spreadsheet_id: str, row_values: List[str], sheet_base_name: str = "botnogal", max_rows: int = 1000):
+def get_sheets_service():
+    """Create Google Sheets service from the service account credentials."""
+    if fakes.FAKE_GOOGLE:
+        return fakes.sheets_service()
+    creds = get_credentials()
+    return build('sheets', 'v4', http=google_http(creds, "sheets"), cache_discovery=False)
+
+def build_sheet_row(extracted_data: Dict[str, Any], metadata: Dict[str, Any]) -> List[Any]:
+    """Map extracted fields + WhatsApp metadata to the SHEET_HEADERS column order."""
+    row = {
+        'Receipt_Date': extracted_data.get('Date') or extracted_data.get('Receipt_Date') or None,
+        'Amount': extracted_data.get('Amount'),
+        # 'Sender_Name': extracted_data.get('Sender_Name'),
+        'Sender_CUIT': extracted_data.get('Sender_ID') or extracted_data.get('Sender_CUIT'),
+        # 'Receiver_CUIT': extracted_data.get('Receiver_ID') or extracted_data.get('Receiver_CUIT'),
+        'Transaction_Number': extracted_data.get('Operation_Number') or extracted_data.get('Transaction_Number'),
+        'Supplier': extracted_data.get('Supplier'),
+        'Destination_Bank': extracted_data.get('Destination_Bank'),
+        'WhatsApp_Group': metadata.get('group_name') or metadata.get('from_group') or 'Unknown Group',
+        'Receipt_Sent_Time': metadata.get('sent_at') or metadata.get('timestamp') or time.time(),
+        'Image_Link': extracted_data.get('image_URL') or '',
+        'Duplicate_Of': extracted_data.get('Duplicate_Of') or ''
+    }
+    return [row[h] for h in SHEET_HEADERS]
+
+def append_rows(spreadsheet_id: str, rows: List[List[Any]], sheet_name: str, batch_size: int = 500) -> int:
     """
-    Append a row to a Google Sheet.
-    If the current sheet exceeds max_rows, create a new sheet with incremented index.
-    Always ensures headers exist in the first row.
+    Append many rows to one tab, batch_size rows per API call.
+    Creates the tab (with headers) if it does not exist. Returns the number of rows sent.
     """
-    creds = get_credentials()
-    service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
-
-    # List all sheets
-    spreadsheet = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+    if not rows:
+        return 0
+    service = get_sheets_service()
+
+    spreadsheet = execute(service.spreadsheets().get(spreadsheetId=spreadsheet_id), "sheets")
+    titles = {s["properties"]["title"] for s in spreadsheet.get("sheets", [])}
+    if sheet_name not in titles:
+        execute(service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"requests": [{"addSheet": {"properties": {"title": sheet_name}}}]}
+        ), "sheets")
+        execute(service.spreadsheets().values().update(
+            spreadsheetId=spreadsheet_id,
+            range=f"{sheet_name}!A1",
+            valueInputOption="USER_ENTERED",
+            body={"values": [SHEET_HEADERS]}
+        ), "sheets")
+        logger.info(f"✅ Created sheet with headers: {sheet_name}")
+
+    sent = 0
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        execute(service.spreadsheets().values().append(
+            spreadsheetId=spreadsheet_id,
+            range=f"{sheet_name}!A2",
+            valueInputOption="USER_ENTERED",
+            insertDataOption="INSERT_ROWS",
+            body={"values": batch}
+        ), "sheets")
+        sent += len(batch)
+        logger.info(f"✅ Appended {len(batch)} rows to sheet {sheet_name} ({sent}/{len(rows)})")
+    return sent
+
+def _latest_sheet(service, spreadsheet_id: str, sheet_base_name: str):
+    """Return (title, index) of the newest '<base>' / '<base>_<n>' tab."""
+    spreadsheet = execute(service.spreadsheets().get(spreadsheetId=spreadsheet_id), "sheets")
     sheets = spreadsheet.get("sheets", [])
 
     # Find latest sheet with base name
@@ -218,68 +287,228 @@ def write_row(spreadsheet_id: str, row_values: List[str], sheet_base_name: str =
                     latest_sheet_name = title
             except ValueError:
                 continue
+    return latest_sheet_name, index
 
-    # Headers
-    headers = [
-        "Receipt_Date", "Amount", "Sender_CUIT", "Transaction_Number",'Supplier', "Destination_Bank",
-        "WhatsApp_Group", "Receipt_Sent_Time", "Image_Link"
-    ]
+def _sheet_exists(service, spreadsheet_id: str, sheet_name: str) -> bool:
+    spreadsheet = execute(service.spreadsheets().get(spreadsheetId=spreadsheet_id), "sheets")
+    return any(s["properties"]["title"] == sheet_name for s in spreadsheet.get("sheets", []))
 
+def _ensure_headers(service, spreadsheet_id: str, sheet_name: str):
     # Check if sheet is empty or missing headers
     try:
-        result = service.spreadsheets().values().get(
+        result = execute(service.spreadsheets().values().get(
             spreadsheetId=spreadsheet_id,
-            range=f"{latest_sheet_name}!A1:Z1"
-        ).execute()
+            range=f"{sheet_name}!A1:Z1"
+        ), "sheets")
         first_row = result.get("values", [])
     except Exception:
         first_row = []
 
-    if not first_row or first_row[0] != headers:
+    if not first_row or first_row[0] != SHEET_HEADERS:
         # Write headers
-        service.spreadsheets().values().update(
+        execute(service.spreadsheets().values().update(
             spreadsheetId=spreadsheet_id,
-            range=f"{latest_sheet_name}!A1",
+            range=f"{sheet_name}!A1",
             valueInputOption="USER_ENTERED",
-            body={"values": [headers]}
-        ).execute()
-        logger.info(f"✅ Headers added to sheet: {latest_sheet_name}")
+            body={"values": [SHEET_HEADERS]}
+        ), "sheets")
+        logger.info(f"✅ Headers added to sheet: {sheet_name}")
 
-    # Check number of rows to see if new sheet is needed
-    result = service.spreadsheets().values().get(
+def _add_sheet(service, spreadsheet_id: str, sheet_name: str):
+    reply = execute(service.spreadsheets().batchUpdate(
         spreadsheetId=spreadsheet_id,
-        range=f"{latest_sheet_name}!A:A"
-    ).execute()
-    num_rows = len(result.get("values", []))
-
-    if num_rows >= max_rows:
-        # Create a new sheet with incremented index
-        index += 1
-        latest_sheet_name = f"{sheet_base_name}_{index}"
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=spreadsheet_id,
-            body={"requests": [{"addSheet": {"properties": {"title": latest_sheet_name}}}]}
-        ).execute()
-        logger.info(f"✅ Created new sheet: {latest_sheet_name}")
+        body={"requests": [{"addSheet": {"properties": {"title": sheet_name}}}]}
+    ), "sheets")
+    logger.info(f"✅ Created new sheet: {sheet_name}")
+
+    # Hide the row key column
+    sheet_id = reply["replies"][0]["addSheet"]["properties"]["sheetId"]
+    key_index = len(SHEET_HEADERS)
+    execute(service.spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={"requests": [{"updateDimensionProperties": {
+            "range": {"sheetId": sheet_id, "dimension": "COLUMNS", "startIndex": key_index, "endIndex": key_index + 1},
+            "properties": {"hiddenByUser": True},
+            "fields": "hiddenByUser",
+        }}]}
+    ), "sheets")
+
+    # Write headers in the new sheet
+    execute(service.spreadsheets().values().update(
+        spreadsheetId=spreadsheet_id,
+        range=f"{sheet_name}!A1",
+        valueInputOption="USER_ENTERED",
+        body={"values": [SHEET_HEADERS]}
+    ), "sheets")
+    logger.info(f"✅ Headers added to new sheet: {sheet_name}")
 
-        # Write headers in the new sheet
-        service.spreadsheets().values().update(
-            spreadsheetId=spreadsheet_id,
-            range=f"{latest_sheet_name}!A1",
-            valueInputOption="USER_ENTERED",
-            body={"values": [headers]}
-        ).execute()
-        logger.info(f"✅ Headers added to new sheet: {latest_sheet_name}")
+def _row_count(service, spreadsheet_id: str, sheet_name: str) -> int:
+    result = execute(service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id,
+        range=f"{sheet_name}!A:A"
+    ), "sheets")
+    return len(result.get("values", []))
+
+class SheetWriter:
+    """
+    Appends to one '<base>' / '<base>_<n>' tab family, keeping the current tab
+    and its row count in memory so a batch costs one append call instead of
+    three metadata reads plus the append. The row count is taken from each
+    append response, so writers in other processes cannot make it drift far.
+    """
+
+    def __init__(self, spreadsheet_id: str, sheet_base_name: str, max_rows: int):
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_base_name = sheet_base_name
+        self.max_rows = max_rows
+        self.sheet_name = None
+        self.index = 0
+        self.num_rows = 0
+        self.lock = threading.Lock()
+
+    def _refresh(self, service):
+        self.sheet_name, self.index = _latest_sheet(service, self.spreadsheet_id, self.sheet_base_name)
+        if self.index == 0 and not _sheet_exists(service, self.spreadsheet_id, self.sheet_name):
+            # First row of a new shard (e.g. an auto tab from sheet_routing.py)
+            _add_sheet(service, self.spreadsheet_id, self.sheet_name)
+            self.num_rows = 1
+            return
+        _ensure_headers(service, self.spreadsheet_id, self.sheet_name)
+        self.num_rows = _row_count(service, self.spreadsheet_id, self.sheet_name)
+
+    def _roll_over(self, service):
+        # Create a new sheet with incremented index (another writer may have done it already)
+        self.index += 1
+        self.sheet_name = f"{self.sheet_base_name}_{self.index}"
+        try:
+            _add_sheet(service, self.spreadsheet_id, self.sheet_name)
+            self.num_rows = 1
+        except Exception as e:
+            if "already exists" not in str(e):
+                raise
+            logger.info(f"{self.sheet_name} was created by another writer, re-reading tabs")
+            self._refresh(service)
+
+    def append(self, rows: List[List[Any]]) -> List[Dict[str, Any]]:
+        with self.lock:
+            service = get_sheets_service()
+            if self.sheet_name is None:
+                self._refresh(service)
+            try:
+                return self._append(service, rows)
+            except Exception:
+                self.sheet_name = None  # state may be stale; re-read on the next batch
+                raise
+
+    def _append(self, service, rows: List[List[Any]]) -> List[Dict[str, Any]]:
+        results = []
+        pending = list(rows)
+        while pending:
+            if self.num_rows >= self.max_rows:
+                self._roll_over(service)
+                continue
 
-    # Append data starting from row 2
-    body = {"values": [row_values]}
-    result = service.spreadsheets().values().append(
+            room = self.max_rows - self.num_rows
+            chunk, pending = pending[:room], pending[room:]
+            # Append data starting from row 2
+            result = execute(service.spreadsheets().values().append(
+                spreadsheetId=self.spreadsheet_id,
+                range=f"{self.sheet_name}!A2",
+                valueInputOption="USER_ENTERED",
+                insertDataOption="INSERT_ROWS",
+                body={"values": chunk}
+            ), "sheets")
+            last_row = re.search(r"(\d+)$", result.get("updates", {}).get("updatedRange", ""))
+            self.num_rows = int(last_row.group(1)) if last_row else self.num_rows + len(chunk)
+            results.append(result)
+            logger.info(f"✅ {len(chunk)} row(s) appended to sheet {self.sheet_name}: {result.get('updates', {})}")
+        return results
+
+
+_writers: Dict[tuple, SheetWriter] = {}
+_writers_lock = threading.Lock()
+
+def get_writer(spreadsheet_id: str, sheet_base_name: str = "botnogal", max_rows: int = 1000) -> SheetWriter:
+    """Cached writer per (spreadsheet, tab family): one shard, one rollover state."""
+    key = (spreadsheet_id, sheet_base_name, max_rows)
+    with _writers_lock:
+        if key not in _writers:
+            _writers[key] = SheetWriter(spreadsheet_id, sheet_base_name, max_rows)
+        return _writers[key]
+
+def write_rows(spreadsheet_id: str, rows: List[List[Any]], sheet_base_name: str = "botnogal", max_rows: int = 1000):
+    """
+    Append rows to the newest '<base>_<n>' tab in as few calls as possible.
+    When a tab reaches max_rows, the rest go to a new tab with incremented index.
+    Always ensures headers exist in the first row. Returns the append results.
+    """
+    if not rows:
+        return []
+    return get_writer(spreadsheet_id, sheet_base_name, max_rows).append(rows)
+
+def write_row(spreadsheet_id: str, row_values: List[str], sheet_base_name: str = "botnogal", max_rows: int = 1000):
+    """
+    Append a row to a Google Sheet.
+    If the current sheet exceeds max_rows, create a new sheet with incremented index.
+    Always ensures headers exist in the first row.
+    """
+    return write_rows(spreadsheet_id, [row_values], sheet_base_name, max_rows)[-1]
+
+def update_cell(spreadsheet_id: str, cell_range: str, value: Any):
+    """Overwrite one cell, e.g. 'botnogal_2!I14'."""
+    return execute(get_sheets_service().spreadsheets().values().update(
         spreadsheetId=spreadsheet_id,
-        range=f"{latest_sheet_name}!A2",
+        range=cell_range,
         valueInputOption="USER_ENTERED",
-        insertDataOption="INSERT_ROWS",
-        body=body
-    ).execute()
+        body={"values": [[value]]}
+    ), "sheets")
+
+def _row_keys(service, spreadsheet_id: str, tab: str, last_n: int = 0) -> Dict[str, str]:
+    """{row key: '<tab>!<row number>'} from the row key column of one tab (the last last_n rows if > 0)."""
+    result = execute(service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id,
+        range=f"{tab}!{ROW_KEY_COLUMN}:{ROW_KEY_COLUMN}"
+    ), "sheets")
+    values = result.get("values", [])
+    start = max(0, len(values) - last_n) if last_n > 0 else 0
+    return {row[0]: f"{tab}!{n}" for n, row in enumerate(values[start:], start=start + 1) if row and row[0]}
 
-    logger.info(f"✅ Row appended to sheet {latest_sheet_name}: {result.get('updates', {})}")
-    return result
+def recent_row_keys(spreadsheet_id: str, sheet_base_name: str = "botnogal", last_n: int = 500) -> Dict[str, str]:
+    """
+    {row key: '<tab>!<row number>'} for the last rows of the two newest tabs
+    (a batch may have been split by a rollover). Used to avoid re-sending rows.
+    """
+    service = get_sheets_service()
+    latest_sheet_name, index = _latest_sheet(service, spreadsheet_id, sheet_base_name)
+    keys = {}
+    if index >= 1:
+        previous = sheet_base_name if index == 1 else f"{sheet_base_name}_{index - 1}"
+        try:
+            keys.update(_row_keys(service, spreadsheet_id, previous, last_n))
+        except Exception as e:
+            logger.debug(f"Could not read row keys of {previous}: {e}")
+    keys.update(_row_keys(service, spreadsheet_id, latest_sheet_name, last_n))
+    return keys
+
+def row_keys(spreadsheet_id: str, sheet_base_name: str = "botnogal") -> Dict[str, str]:
+    """{row key: '<tab>!<row number>'} over every '<base>' / '<base>_<n>' tab (one read per tab)."""
+    service = get_sheets_service()
+    spreadsheet = execute(service.spreadsheets().get(spreadsheetId=spreadsheet_id), "sheets")
+    keys = {}
+    for s in spreadsheet.get("sheets", []):
+        title = s["properties"]["title"]
+        if title == sheet_base_name or re.fullmatch(re.escape(sheet_base_name) + r"_\d+", title):
+            keys.update(_row_keys(service, spreadsheet_id, title))
+    return keys
+
+def update_cells(spreadsheet_id: str, cells: Dict[str, Any], batch_size: int = 500) -> int:
+    """Overwrite many single cells ({'botnogal_2!I14': value, ...}), batch_size per call. Returns cells sent."""
+    service = get_sheets_service()
+    items = list(cells.items())
+    for i in range(0, len(items), batch_size):
+        execute(service.spreadsheets().values().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"valueInputOption": "USER_ENTERED",
+                  "data": [{"range": r, "values": [[v]]} for r, v in items[i:i + batch_size]]}
+        ), "sheets")
+    return len(items)
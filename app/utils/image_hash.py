@@ -0,0 +1,18 @@
+
+# app/utils/image_hash.py
+
+import hashlib
+
+
+def content_hash(data: bytes) -> str:
+    """SHA-256 hex digest of the raw image bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 hex digest of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,100 @@
+
+# app/utils/imageprobe.py
+#
+# Image dimensions from the file header only (JPEG SOF, PNG IHDR, WebP, GIF,
+# BMP), without decoding any pixels. The webhook uses it to reject oversized
+# uploads before they are stored or queued, and the worker to pick a reduced
+# decode scale before the image reaches OpenCV/Paddle, so a 50-megapixel
+# photo is never held at full resolution.
+
+import os
+import struct
+from typing import Optional, Tuple
+
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(100_000_000)))   # rejected above this
+OCR_MAX_PIXELS = int(os.getenv("OCR_MAX_PIXELS", str(8_000_000)))         # downscaled above this
+
+# JPEG start-of-frame markers (C4, C8 and CC are DHT, JPG and DAC)
+_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _jpeg(data: bytes) -> Optional[Tuple[int, int]]:
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:          # fill byte
+            i += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        if marker in (0xD9, 0xDA):  # end of image / start of scan before any frame header
+            return None
+        length = struct.unpack(">H", data[i + 2:i + 4])[0]
+        if marker in _SOF:
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height
+        i += 2 + length
+    return None
+
+
+def _webp(data: bytes) -> Optional[Tuple[int, int]]:
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        bits = int.from_bytes(data[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(data) >= 30:
+        return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+    return None
+
+
+def probe(data: bytes) -> Optional[Tuple[str, int, int]]:
+    """(format, width, height) read from the header, or None if the format is not recognised."""
+    size = None
+    fmt = None
+    if data[:3] == b"\xff\xd8\xff":
+        fmt, size = "jpeg", _jpeg(data)
+    elif data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        fmt, size = "png", struct.unpack(">II", data[16:24])
+    elif data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        fmt, size = "webp", _webp(data)
+    elif data[:4] == b"GIF8" and len(data) >= 10:
+        fmt, size = "gif", struct.unpack("<HH", data[6:10])
+    elif data[:2] == b"BM" and len(data) >= 26:
+        width, height = struct.unpack("<ii", data[18:26])
+        fmt, size = "bmp", (width, abs(height))
+    if not size:
+        return None
+    return fmt, size[0], size[1]
+
+
+def probe_file(path: str, header_bytes: int = 512 * 1024) -> Optional[Tuple[str, int, int]]:
+    """probe() on the start of a file (JPEG frame headers can sit behind a large EXIF block)."""
+    with open(path, "rb") as f:
+        return probe(f.read(header_bytes))
+
+
+def rejection(data_size: int, probed: Optional[Tuple[str, int, int]]) -> Optional[str]:
+    """Why an image must not be processed at all, or None if it may."""
+    if data_size > IMAGE_MAX_BYTES:
+        return f"image is {data_size / 1048576:.1f} MB, limit {IMAGE_MAX_BYTES / 1048576:.0f} MB"
+    if probed and probed[1] * probed[2] > IMAGE_MAX_PIXELS:
+        return f"image is {probed[1]}x{probed[2]}, limit {IMAGE_MAX_PIXELS / 1e6:.0f} megapixels"
+    return None
+
+
+def reduce_factor(probed: Optional[Tuple[str, int, int]], max_pixels: int = OCR_MAX_PIXELS) -> int:
+    """Smallest of 1, 2, 4, 8 that brings the image under max_pixels (OpenCV's reduced decode scales)."""
+    if not probed:
+        return 1
+    pixels = probed[1] * probed[2]
+    for factor in (1, 2, 4):
+        if pixels / (factor * factor) <= max_pixels:
+            return factor
+    return 8
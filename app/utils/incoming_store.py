@@ -0,0 +1,402 @@
+
+# app/utils/incoming_store.py
+#
+# Content-addressed store for incoming receipt images. Each image is kept
+# once, under its SHA-256, sharded by hash prefix so no directory grows past
+# a few hundred entries:
+#
+#   incoming/objects/ab/cd/abcd...ef.jpg
+#
+# A SQLite manifest next to it (incoming/manifest.sqlite3, shared by the API
+# and the worker through the incoming/ volume) maps each hash to its
+# message_id, group, size and creation time, and each name the image was
+# received under (<timestamp>_<message_id>.jpg, used in the /files/ links
+# written to the sheet) to its hash. Serving /files/<name> and deleting an
+# image are then a primary-key lookup, whatever the number of receipts.
+#
+# Retention: the worker's main process sweeps every INCOMING_SWEEP_INTERVAL_S,
+# deleting images older than INCOMING_RETENTION_DAYS, then the oldest ones
+# while the store is above INCOMING_MAX_BYTES (0 disables either limit).
+# The store's total size is kept by manifest triggers, not by listing files.
+#
+#   python -m app.utils.incoming_store stats
+#   python -m app.utils.incoming_store sweep
+#   python -m app.utils.incoming_store migrate [--copy]   # flat incoming/*.jpg into the store
+#   python -m app.utils.incoming_store resolve <name>
+#
+# Files derived from an image (the worker's .ocr.npz OCR results, ocr.py) are
+# kept next to it as artifacts, <sha256><suffix>, listed in the manifest and
+# counted in the store's size. They go with their image, and are swept by age
+# like images. Older flat OCR dumps (.txt, .ocr_raw.json) stay where they are.
+# bench_corpus.py and load_webhook.py read flat images from incoming/: migrate
+# with --copy (or point their --dir elsewhere) to keep a corpus for them.
+
+import os
+import re
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+from typing import Any, Dict, List, Optional
+
+from app.utils.imageprobe import probe
+
+logger = logging.getLogger(__name__)
+
+INCOMING_DIR = os.getenv(
+    "INCOMING_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "incoming")
+)
+OBJECTS_DIR = os.path.join(INCOMING_DIR, "objects")
+STAGING_DIR = os.path.join(INCOMING_DIR, "staging")
+MANIFEST_PATH = os.getenv("INCOMING_MANIFEST", os.path.join(INCOMING_DIR, "manifest.sqlite3"))
+RETENTION_DAYS = float(os.getenv("INCOMING_RETENTION_DAYS", "90"))
+MAX_BYTES = int(os.getenv("INCOMING_MAX_BYTES", str(10 * 1024 ** 3)))
+SWEEP_INTERVAL_S = float(os.getenv("INCOMING_SWEEP_INTERVAL_S", "3600"))
+SWEEP_BATCH = 500
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp")
+_EXT_BY_FORMAT = {"jpeg": ".jpg", "png": ".png", "webp": ".webp", "gif": ".gif", "bmp": ".bmp"}
+_OBJECT_NAME = re.compile(r"^([0-9a-f]{64})(\.[a-z0-9]+)$")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    sha256        TEXT PRIMARY KEY,
+    ext           TEXT NOT NULL,
+    size          INTEGER NOT NULL,
+    message_id    TEXT,
+    group_name    TEXT,
+    created_at    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_created ON objects (created_at);
+CREATE TABLE IF NOT EXISTS names (
+    name          TEXT PRIMARY KEY,  -- name the image was received under
+    sha256        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS names_sha256 ON names (sha256);
+CREATE TABLE IF NOT EXISTS totals (
+    id            INTEGER PRIMARY KEY CHECK (id = 0),
+    objects       INTEGER NOT NULL,
+    bytes         INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals (id, objects, bytes) VALUES (0, 0, 0);
+CREATE TABLE IF NOT EXISTS artifacts (
+    name          TEXT PRIMARY KEY,  -- <sha256 it was made from><suffix>, e.g. abcd...ef.ocr.npz
+    sha256        TEXT NOT NULL,     -- image it belongs to (follows replace())
+    size          INTEGER NOT NULL,
+    created_at    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_sha256 ON artifacts (sha256);
+CREATE INDEX IF NOT EXISTS artifacts_created ON artifacts (created_at);
+CREATE TRIGGER IF NOT EXISTS artifacts_added AFTER INSERT ON artifacts BEGIN
+    UPDATE totals SET bytes = bytes + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS artifacts_removed AFTER DELETE ON artifacts BEGIN
+    UPDATE totals SET bytes = bytes - OLD.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS objects_added AFTER INSERT ON objects BEGIN
+    UPDATE totals SET objects = objects + 1, bytes = bytes + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS objects_removed AFTER DELETE ON objects BEGIN
+    UPDATE totals SET objects = objects - 1, bytes = bytes - OLD.size WHERE id = 0;
+    DELETE FROM names WHERE sha256 = OLD.sha256;
+END;
+"""
+
+_COLUMNS = "sha256, ext, size, message_id, group_name, created_at"
+
+_local = threading.local()
+
+
+def _connect(path: Optional[str] = None) -> sqlite3.Connection:
+    """One connection per thread (and per forked worker process)."""
+    path = path or MANIFEST_PATH
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid() and _local.path == path:
+        return conn
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    _local.conn, _local.pid, _local.path = conn, os.getpid(), path
+    return conn
+
+
+def object_path(sha256: str, ext: str) -> str:
+    return os.path.join(OBJECTS_DIR, sha256[:2], sha256[2:4], sha256 + ext)
+
+
+def _ext_for(name: Optional[str], header: bytes) -> str:
+    probed = probe(header)
+    if probed:
+        return _EXT_BY_FORMAT[probed[0]]
+    ext = os.path.splitext(name or "")[1].lower()
+    return ext if ext in IMAGE_EXTS else ".bin"
+
+
+def _register(sha256: str, ext: str, size: int, name: Optional[str], message_id: Optional[str],
+              group_name: Optional[str], created_at: Optional[float]) -> Dict[str, Any]:
+    conn = _connect()
+    conn.execute("INSERT OR IGNORE INTO objects (sha256, ext, size, message_id, group_name, created_at) "
+                 "VALUES (?, ?, ?, ?, ?, ?)",
+                 (sha256, ext, size, message_id, group_name, created_at or time.time()))
+    if name:
+        conn.execute("INSERT OR REPLACE INTO names (name, sha256) VALUES (?, ?)", (os.path.basename(name), sha256))
+    return {"sha256": sha256, "path": object_path(sha256, ext), "size": size,
+            "name": os.path.basename(name) if name else sha256 + ext}
+
+
+def put(data: bytes, name: Optional[str] = None, message_id: Optional[str] = None,
+        group_name: Optional[str] = None, ext: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Store an image (once per content) and record `name` as an alias for it.
+    Returns {"sha256", "path", "size", "name"}.
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    ext = ext or _ext_for(name, data[:512 * 1024])
+    path = object_path(sha256, ext)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return _register(sha256, ext, len(data), name, message_id, group_name, None)
+
+
+def put_file(src_path: str, name: Optional[str] = None, message_id: Optional[str] = None,
+             group_name: Optional[str] = None, move: bool = True,
+             created_at: Optional[float] = None) -> Dict[str, Any]:
+    """put() for a file on disk, hashed in chunks; moved into the store unless move=False."""
+    digest = hashlib.sha256()
+    with open(src_path, "rb") as f:
+        header = f.read(512 * 1024)
+        digest.update(header)
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+    ext = _ext_for(name or src_path, header)
+    path = object_path(sha256, ext)
+    size = os.path.getsize(src_path)
+    if os.path.exists(path):
+        if move:
+            os.remove(src_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if move:
+            shutil.move(src_path, path)
+        else:
+            tmp = f"{path}.{os.getpid()}.tmp"
+            shutil.copyfile(src_path, tmp)
+            os.replace(tmp, path)
+    return _register(sha256, ext, size, name or os.path.basename(src_path), message_id, group_name, created_at)
+
+
+def artifact_path(name: str) -> str:
+    return os.path.join(OBJECTS_DIR, name[:2], name[2:4], name)
+
+
+def put_artifact(sha256: str, suffix: str, data: bytes) -> str:
+    """Store a file derived from image `sha256` (e.g. '.ocr.npz'), replacing an older one. Returns its path."""
+    name = sha256 + suffix
+    path = artifact_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM artifacts WHERE name=?", (name,))
+        conn.execute("INSERT INTO artifacts (name, sha256, size, created_at) VALUES (?, ?, ?, ?)",
+                     (name, sha256, len(data), time.time()))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return path
+
+
+def staging_path(name: str) -> str:
+    """Where to write a download before put_file() moves it in (same filesystem as the store)."""
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    return os.path.join(STAGING_DIR, f"{os.getpid()}_{os.path.basename(name)}")
+
+
+def lookup(name: str) -> Optional[Dict[str, Any]]:
+    """Manifest entry for a received name or an object name (<sha256><ext>), or None."""
+    name = os.path.basename(name)
+    m = _OBJECT_NAME.match(name)
+    if m:
+        row = _connect().execute(f"SELECT {_COLUMNS} FROM objects WHERE sha256=?", (m.group(1),)).fetchone()
+    else:
+        row = _connect().execute(f"SELECT {_COLUMNS} FROM names JOIN objects USING (sha256) WHERE name=?",
+                                 (name,)).fetchone()
+    if row is None:
+        return None
+    entry = dict(zip(_COLUMNS.split(", "), row))
+    entry["path"] = object_path(entry["sha256"], entry["ext"])
+    return entry
+
+
+def resolve(name: str) -> Optional[str]:
+    """Path of the stored image for `name`, or None."""
+    entry = lookup(name)
+    if entry and os.path.exists(entry["path"]):
+        return entry["path"]
+    return None
+
+
+def replace(name: str, data: bytes, ext: Optional[str] = None) -> bool:
+    """
+    Point `name` (and every other name of the same image) at new content,
+    e.g. the archival re-encode, and drop the old copy. False if `name` is
+    not in the store.
+    """
+    old = lookup(name)
+    if old is None:
+        return False
+    new = put(data, message_id=old["message_id"], group_name=old["group_name"], ext=ext)
+    if new["sha256"] != old["sha256"]:
+        conn = _connect()
+        conn.execute("UPDATE names SET sha256=? WHERE sha256=?", (new["sha256"], old["sha256"]))
+        conn.execute("UPDATE artifacts SET sha256=? WHERE sha256=?", (new["sha256"], old["sha256"]))
+        _delete(conn, [(old["sha256"], old["ext"])])
+    return True
+
+
+# ------------------- Retention -------------------
+
+def _remove(path: str) -> int:
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def _delete_artifacts(conn: sqlite3.Connection, names) -> int:
+    freed = 0
+    for name in names:
+        freed += _remove(artifact_path(name))
+        conn.execute("DELETE FROM artifacts WHERE name=?", (name,))
+    return freed
+
+
+def _delete(conn: sqlite3.Connection, rows) -> int:
+    """Delete images and their artifacts."""
+    freed = 0
+    for sha256, ext in rows:
+        freed += _remove(object_path(sha256, ext))
+        artifacts = conn.execute("SELECT name FROM artifacts WHERE sha256=?", (sha256,)).fetchall()
+        freed += _delete_artifacts(conn, [name for (name,) in artifacts])
+        conn.execute("DELETE FROM objects WHERE sha256=?", (sha256,))
+    return freed
+
+
+def sweep(now: Optional[float] = None, retention_days: float = RETENTION_DAYS,
+          max_bytes: int = MAX_BYTES) -> Dict[str, int]:
+    """Delete images past the age limit, then the oldest ones while over the size limit."""
+    now = now or time.time()
+    conn = _connect()
+    deleted = freed = 0
+    if retention_days > 0:
+        cutoff = now - retention_days * 86400
+        while True:
+            rows = conn.execute("SELECT sha256, ext FROM objects WHERE created_at < ? ORDER BY created_at LIMIT ?",
+                                (cutoff, SWEEP_BATCH)).fetchall()
+            if not rows:
+                break
+            freed += _delete(conn, rows)
+            deleted += len(rows)
+        # Artifacts of images that were never stored here, or are kept longer
+        while True:
+            names = conn.execute("SELECT name FROM artifacts WHERE created_at < ? LIMIT ?",
+                                 (cutoff, SWEEP_BATCH)).fetchall()
+            if not names:
+                break
+            freed += _delete_artifacts(conn, [name for (name,) in names])
+    if max_bytes > 0:
+        while conn.execute("SELECT bytes FROM totals WHERE id=0").fetchone()[0] > max_bytes:
+            rows = conn.execute("SELECT sha256, ext FROM objects ORDER BY created_at LIMIT ?",
+                                (SWEEP_BATCH,)).fetchall()
+            if not rows:
+                break
+            freed += _delete(conn, rows)
+            deleted += len(rows)
+    if deleted:
+        logger.info(f"🧹 Incoming store: removed {deleted} image(s), freed {freed / 1048576:.1f} MB")
+    return {"deleted": deleted, "freed_bytes": freed}
+
+
+def run_sweeper(stop: Optional[threading.Event] = None):
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        try:
+            sweep()
+        except Exception as e:
+            logger.error(f"Incoming store sweep failed: {e}")
+        stop.wait(SWEEP_INTERVAL_S)
+
+
+def start_sweeper_thread() -> threading.Event:
+    """Run the sweeper in a daemon thread; set the returned event to stop it."""
+    stop = threading.Event()
+    threading.Thread(target=run_sweeper, args=(stop,), name="incoming-sweeper", daemon=True).start()
+    return stop
+
+
+# ------------------- Admin -------------------
+
+def stats() -> Dict[str, Any]:
+    conn = _connect()
+    objects, total = conn.execute("SELECT objects, bytes FROM totals WHERE id=0").fetchone()
+    oldest = conn.execute("SELECT MIN(created_at) FROM objects").fetchone()[0]
+    return {
+        "objects": objects,
+        "bytes": total,
+        "names": conn.execute("SELECT COUNT(*) FROM names").fetchone()[0],
+        "artifacts": conn.execute("SELECT COUNT(*) FROM artifacts").fetchone()[0],
+        "oldest_age_days": round((time.time() - oldest) / 86400, 1) if oldest else None,
+        "retention_days": RETENTION_DAYS,
+        "max_bytes": MAX_BYTES,
+    }
+
+
+def migrate(directory: str = INCOMING_DIR, move: bool = True) -> List[str]:
+    """Move (or copy) the flat images of `directory` into the store, keeping their names as aliases."""
+    migrated = []
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTS):
+            continue
+        stem = os.path.splitext(entry.name)[0]
+        message_id = stem.split("_", 1)[1] if "_" in stem else None   # <timestamp>_<message_id>
+        put_file(entry.path, name=entry.name, message_id=message_id, move=move,
+                 created_at=entry.stat().st_mtime)
+        migrated.append(entry.name)
+    return migrated
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Content-addressed incoming image store")
+    parser.add_argument("command", nargs="?", default="stats", choices=["stats", "sweep", "migrate", "resolve"])
+    parser.add_argument("name", nargs="?", help="name to resolve")
+    parser.add_argument("--dir", default=INCOMING_DIR, help="flat directory to migrate")
+    parser.add_argument("--copy", action="store_true", help="migrate without removing the originals")
+    args = parser.parse_args()
+    if args.command == "sweep":
+        print(json.dumps(sweep(), indent=2))
+    elif args.command == "migrate":
+        print(f"migrated {len(migrate(args.dir, move=not args.copy))} image(s)")
+    elif args.command == "resolve":
+        print(json.dumps(lookup(args.name or ""), indent=2))
+    else:
+        print(json.dumps(stats(), indent=2))
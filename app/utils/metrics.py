@@ -0,0 +1,273 @@
+
+# app/utils/metrics.py
+#
+# Prometheus metrics for the receipt pipeline. The FastAPI app serves them on
+# /metrics; the Celery worker runs its own exporter on WORKER_METRICS_PORT.
+#
+# Celery's prefork children each have their own memory, so for the worker
+# set PROMETHEUS_MULTIPROC_DIR (an empty, writable directory): every process
+# then writes its samples there and the exporter adds them up. Without it
+# only the worker's main process (outbox flusher, exporter) is visible.
+#
+# All helpers are no-ops when prometheus_client is not installed.
+
+import os
+import time
+import logging
+from typing import Optional, Tuple
+
+from app.utils.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9808"))
+CELERY_QUEUE = os.getenv("CELERY_QUEUE", "celery")
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROC_DIR:
+    # Unlabelled metrics open their sample files as soon as they are defined below
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+# OCR takes seconds, everything else milliseconds
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+try:
+    from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+                                   CONTENT_TYPE_LATEST, generate_latest, start_http_server)
+    from prometheus_client.core import GaugeMetricFamily
+    ENABLED = True
+except ImportError:
+    ENABLED = False
+
+if ENABLED:
+    WEBHOOK_SECONDS = Histogram(
+        "receipt_webhook_seconds", "Time to accept a /webhook request and queue the task",
+        ["outcome"], buckets=_BUCKETS)
+    QUEUE_WAIT_SECONDS = Histogram(
+        "receipt_queue_wait_seconds", "Time between queueing a receipt and a worker starting it",
+        buckets=_BUCKETS)
+    STAGE_SECONDS = Histogram(
+        "receipt_stage_seconds", "Time spent per pipeline stage (decode, ocr, extract, drive_upload, sheets_write, ...)",
+        ["stage"], buckets=_BUCKETS)
+    RECEIPTS = Counter(
+        "receipts_processed_total", "Receipts processed, by detected supplier and destination bank",
+        ["supplier", "bank"])
+    FAILURES = Counter(
+        "receipt_failures_total", "Receipts or deliveries that failed, by reason", ["reason"])
+    MODEL_LOADED = Gauge(
+        "ocr_model_loaded", "1 if the OCR engine is loaded in this worker",
+        multiprocess_mode="max")
+    MODEL_LOAD_SECONDS = Gauge(
+        "ocr_model_load_seconds", "Time the last OCR engine initialization took",
+        multiprocess_mode="max")
+    CHILD_RSS = Gauge(
+        "worker_child_rss_bytes", "Resident memory of each worker process after its last task",
+        multiprocess_mode="liveall")
+    CIRCUIT_STATE = Gauge(
+        "outbound_circuit_state", "Circuit breaker per external dependency: 0 closed, 1 half-open, 2 open",
+        ["dependency"], multiprocess_mode="livemax")
+    OUTBOUND_CALLS = Counter(
+        "outbound_calls_total", "Calls to external dependencies, by outcome (ok, timeout, outage, error, rejected)",
+        ["dependency", "outcome"])
+    RATELIMIT_WAIT_SECONDS = Histogram(
+        "ratelimit_wait_seconds", "Time a call waited for quota in the shared rate limiter, per API",
+        ["api"], buckets=_BUCKETS)
+
+
+def _label(value: Optional[str], limit: int = 40) -> str:
+    """Bounded label value: unknown values collapse to 'unknown'."""
+    value = str(value or "").strip()
+    return value[:limit] if value else "unknown"
+
+
+def observe_stage(stage: str, seconds: float):
+    if ENABLED:
+        STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def observe_webhook(seconds: float, outcome: str):
+    if ENABLED:
+        WEBHOOK_SECONDS.labels(outcome).observe(seconds)
+
+
+def observe_queue_wait(queued_at, started_at: float):
+    if ENABLED and isinstance(queued_at, (int, float)) and queued_at:
+        QUEUE_WAIT_SECONDS.observe(max(0.0, started_at - queued_at))
+
+
+def observe_ratelimit_wait(api: str, seconds: float):
+    if ENABLED:
+        RATELIMIT_WAIT_SECONDS.labels(api).observe(seconds)
+
+
+def count_receipt(supplier: Optional[str], bank: Optional[str]):
+    if ENABLED:
+        RECEIPTS.labels(_label(supplier), _label(bank)).inc()
+
+
+def count_failure(reason: str, n: int = 1):
+    if ENABLED:
+        FAILURES.labels(reason).inc(n)
+
+
+def set_model_loaded(loaded: bool, load_seconds: Optional[float] = None):
+    if ENABLED:
+        MODEL_LOADED.set(1 if loaded else 0)
+        if load_seconds is not None:
+            MODEL_LOAD_SECONDS.set(load_seconds)
+
+
+def set_circuit_state(dependency: str, value: int):
+    if ENABLED:
+        CIRCUIT_STATE.labels(dependency).set(value)
+
+
+def count_outbound(dependency: str, outcome: str):
+    if ENABLED:
+        OUTBOUND_CALLS.labels(dependency, outcome).inc()
+
+
+def rss_bytes() -> Optional[int]:
+    """Current resident set size of this process (Linux), or None."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def observe_child_rss() -> Optional[int]:
+    rss = rss_bytes()
+    if ENABLED and rss is not None:
+        CHILD_RSS.set(rss)
+    return rss
+
+
+class _BacklogCollector:
+    """
+    Queue depths read at scrape time: the Celery queue and the fair queue's
+    lanes and groups (fairqueue.py), plus (on the worker, where they live)
+    the sheet-row outbox and the Drive upload spool.
+    """
+
+    def __init__(self, include_local: bool):
+        self.include_local = include_local
+
+    def collect(self):
+        depth = GaugeMetricFamily("receipt_queue_depth", "Items waiting, by queue", labels=["queue"])
+        client = get_redis()
+        if client is not None:
+            try:
+                depth.add_metric(["celery"], client.llen(CELERY_QUEUE))
+            except Exception:
+                pass
+            try:
+                from app.utils.fairqueue import backlog
+                waiting = backlog(client)
+                depth.add_metric(["fair_priority"], waiting["priority"])
+                depth.add_metric(["fair_groups"], sum(waiting["groups"].values()))
+                per_group = GaugeMetricFamily("receipt_group_backlog", "Receipts waiting in the fair queue, by WhatsApp group",
+                                              labels=["group"])
+                for group, n in waiting["groups"].items():
+                    per_group.add_metric([_label(group)], n)
+                yield per_group
+            except Exception:
+                pass
+        oldest = GaugeMetricFamily("outbox_oldest_pending_seconds", "Age of the oldest undelivered sheet row")
+        if not self.include_local:
+            yield depth
+            return
+        try:
+            from app.utils.outbox import stats as outbox_stats
+            outbox = outbox_stats()
+            depth.add_metric(["outbox_pending"], outbox["pending"])
+            depth.add_metric(["outbox_sending"], outbox["sending"])
+            oldest.add_metric([], outbox["oldest_pending_age_s"])
+        except Exception:
+            pass
+        try:
+            from app.utils.uploader import SPOOL_DIR
+            if os.path.isdir(SPOOL_DIR):
+                depth.add_metric(["upload_spool"], sum(1 for n in os.listdir(SPOOL_DIR) if n.endswith(".json")))
+        except Exception:
+            pass
+        yield depth
+        yield oldest
+
+
+def _registry():
+    if MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+_backlog_registered = False
+
+
+def _with_backlog(registry, include_local: bool):
+    global _backlog_registered
+    if registry is REGISTRY:
+        if not _backlog_registered:
+            REGISTRY.register(_BacklogCollector(include_local))
+            _backlog_registered = True
+    else:
+        registry.register(_BacklogCollector(include_local))
+    return registry
+
+
+def metrics_payload() -> Tuple[bytes, str]:
+    """(body, content type) for a /metrics response."""
+    if not ENABLED:
+        return b"# prometheus_client is not installed\n", "text/plain; charset=utf-8"
+    return generate_latest(_with_backlog(_registry(), include_local=False)), CONTENT_TYPE_LATEST
+
+
+def clear_multiproc_dir():
+    """
+    Remove samples left by a previous run (call once, before worker processes
+    start). Files of this process, created when the metrics were defined, stay.
+    """
+    if not MULTIPROC_DIR:
+        return
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+    own = f"_{os.getpid()}.db"
+    for name in os.listdir(MULTIPROC_DIR):
+        if name.endswith(".db") and not name.endswith(own):
+            os.remove(os.path.join(MULTIPROC_DIR, name))
+
+
+def mark_process_dead(pid: int):
+    if ENABLED and MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
+
+
+def start_worker_exporter(port: int = WORKER_METRICS_PORT) -> bool:
+    """Serve the worker's metrics on :port (from the worker's main process)."""
+    if not ENABLED:
+        logger.warning("prometheus_client not installed, worker metrics disabled")
+        return False
+    try:
+        start_http_server(port, registry=_with_backlog(_registry(), include_local=True))
+    except OSError as e:
+        logger.warning(f"Worker metrics exporter not started on :{port}: {e}")
+        return False
+    logger.info(f"📈 Worker metrics on :{port}/metrics")
+    return True
+
+
+class timed:
+    """`with timed("sheets_write"):` observes the block's duration as a pipeline stage."""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe_stage(self.stage, time.perf_counter() - self.start)
+        return False
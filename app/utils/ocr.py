@@ -0,0 +1,254 @@
+
+# app/utils/ocr.py
+
+import os
+import re
+import ast
+import io
+import json
+import time
+import logging
+from typing import Dict, Any, Optional, List, Iterator
+
+logger = logging.getLogger(__name__)
+
+OCR_SCHEMA_VERSION = 1
+
+# Stored OCR formats, richest first. A receipt may have several; the first one found wins.
+OCR_SUFFIXES = [".ocr.npz", ".ocr_raw.json", ".txt"]
+
+
+def receipt_id_from_path(path: str) -> str:
+    """'incoming/1761917221806_AC35...E4.ocr_raw.json' -> '1761917221806_AC35...E4'"""
+    name = os.path.basename(path)
+    for suffix in OCR_SUFFIXES + [".jpg", ".jpeg", ".png"]:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return os.path.splitext(name)[0]
+
+
+def _as_boxes(value) -> Optional[List[List[float]]]:
+    """Keep boxes only if they are real nested numbers (numpy reprs in old dumps are truncated)."""
+    if not isinstance(value, list):
+        return None
+    try:
+        return [[float(v) for v in box] for box in value]
+    except (TypeError, ValueError):
+        return None
+
+
+def _from_paddle_dict(page: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "lines": list(page.get("rec_texts") or []),
+        "scores": [float(s) for s in page.get("rec_scores") or []] or None,
+        "boxes": _as_boxes(page.get("rec_boxes")),
+    }
+
+
+def _literal_list(text: str, key: str) -> Optional[list]:
+    """Pull "'key': [...]" out of a printed PaddleOCR result."""
+    m = re.search(r"'" + key + r"': (\[[^\]]*\])", text)
+    if not m:
+        return None
+    try:
+        return ast.literal_eval(m.group(1))
+    except (ValueError, SyntaxError):
+        return None
+
+
+def _box_from_poly(poly) -> Optional[List[float]]:
+    """4-point polygon -> [x_min, y_min, x_max, y_max]."""
+    try:
+        xs = [float(p[0]) for p in poly]
+        ys = [float(p[1]) for p in poly]
+        return [min(xs), min(ys), max(xs), max(ys)]
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def parse_paddle_result(result: Any) -> Dict[str, Any]:
+    """
+    Normalize a PaddleOCR result (3.x dict pages or 2.x [[poly, (text, score)], ...] pages)
+    to {"lines", "scores", "boxes", "model_settings"}.
+    """
+    lines, scores, boxes = [], [], []
+    model_settings = None
+    if not isinstance(result, list):
+        return {"lines": lines, "scores": None, "boxes": None, "model_settings": None}
+
+    # New format (dict-based)
+    if len(result) > 0 and isinstance(result[0], dict) and "rec_texts" in result[0]:
+        page = result[0]
+        lines = list(page["rec_texts"])
+        scores = [float(s) for s in page.get("rec_scores", [])]
+        rec_boxes = page.get("rec_boxes")
+        if rec_boxes is not None and len(rec_boxes) == len(lines):
+            boxes = [[float(v) for v in box] for box in rec_boxes]
+        model_settings = {k: page.get(k) for k in ("model_settings", "text_det_params", "text_type") if k in page}
+    else:
+        # Fallback for older list-based format
+        for page_result in result:
+            if not isinstance(page_result, list):
+                continue
+            for line_data in page_result:
+                try:
+                    if isinstance(line_data, (list, tuple)) and len(line_data) >= 2 and isinstance(line_data[1], (list, tuple)):
+                        text = line_data[1][0]
+                        if text and isinstance(text, str):
+                            lines.append(text.strip())
+                            scores.append(float(line_data[1][1]) if len(line_data[1]) > 1 else 0.0)
+                            boxes.append(_box_from_poly(line_data[0]) or [0.0, 0.0, 0.0, 0.0])
+                except Exception:
+                    continue
+
+    return {
+        "lines": lines,
+        "scores": scores if len(scores) == len(lines) else None,
+        "boxes": boxes if len(boxes) == len(lines) else None,
+        "model_settings": model_settings,
+    }
+
+
+def save_ocr_result(ocr_result: Dict[str, Any], receipt_id: str, image_sha256: str,
+                    engine: Dict[str, Any], store_dir: Optional[str] = None) -> str:
+    """
+    Persist one OCR result as an .ocr.npz: UTF-8 text, float16 scores,
+    float16 [x_min, y_min, x_max, y_max] boxes and a JSON meta record
+    (receipt id, image hash, engine and model version). A typical receipt is
+    ~1-2 KB. It goes into the incoming store as an artifact of its image,
+    <image_sha256>.ocr.npz, or to <store_dir>/<receipt_id>.ocr.npz if given.
+    """
+    import numpy as np
+
+    lines = [str(l).replace("\n", " ") for l in ocr_result.get("lines") or []]
+    meta = {
+        "schema": OCR_SCHEMA_VERSION,
+        "receipt_id": receipt_id,
+        "image_sha256": image_sha256,
+        "engine": engine,
+        "model_settings": ocr_result.get("model_settings"),
+        "created": time.time(),
+    }
+    arrays = {
+        "text": np.frombuffer("\n".join(lines).encode("utf-8"), dtype=np.uint8),
+        "meta": np.frombuffer(json.dumps(meta, default=str).encode("utf-8"), dtype=np.uint8),
+    }
+    if ocr_result.get("scores") is not None:
+        arrays["scores"] = np.asarray(ocr_result["scores"], dtype=np.float16)
+    if ocr_result.get("boxes") is not None:
+        arrays["boxes"] = np.asarray(ocr_result["boxes"], dtype=np.float16).reshape(-1, 4)
+
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **arrays)
+    if store_dir is None:
+        from app.utils import incoming_store
+        return incoming_store.put_artifact(image_sha256, ".ocr.npz", buf.getvalue())
+
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, f"{receipt_id}.ocr.npz")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(buf.getvalue())
+    os.replace(tmp_path, path)
+    return path
+
+
+def _load_npz(path: str) -> Dict[str, Any]:
+    import numpy as np
+
+    with np.load(path, allow_pickle=False) as data:
+        text = data["text"].tobytes().decode("utf-8")
+        meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+        scores = data["scores"].astype(float).tolist() if "scores" in data else None
+        boxes = data["boxes"].astype(float).tolist() if "boxes" in data else None
+    return {"lines": text.split("\n") if text else [], "scores": scores, "boxes": boxes, "meta": meta}
+
+
+def load_stored_ocr(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Load one stored OCR result as {"receipt_id", "path", "lines", "scores", "boxes"}
+    (plus "meta" for .ocr.npz files). Understands compact .ocr.npz results, raw
+    PaddleOCR JSON dumps, printed result dicts and plain line-per-row text.
+    Returns None for empty or unreadable files.
+    """
+    try:
+        if path.endswith(".npz"):
+            result = _load_npz(path)
+        elif path.endswith(".json"):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            page = data[0] if isinstance(data, list) and data else data
+            if not isinstance(page, dict):
+                return None
+            result = _from_paddle_dict(page)
+        else:
+            with open(path, encoding="utf-8", errors="ignore") as f:
+                text = f.read()
+            if not text.strip():
+                return None
+            if text.lstrip().startswith("{") and "'rec_texts'" in text:
+                result = {
+                    "lines": _literal_list(text, "rec_texts") or [],
+                    "scores": _literal_list(text, "rec_scores"),
+                    "boxes": None,
+                }
+            else:
+                result = {"lines": text.splitlines(), "scores": None, "boxes": None}
+    except Exception as e:
+        logger.warning(f"Failed to load stored OCR {path}: {e}")
+        return None
+
+    if not result["lines"]:
+        return None
+    # Results in the incoming store are named by image hash; the receipt id is in their meta
+    receipt_id = (result.get("meta") or {}).get("receipt_id") or receipt_id_from_path(path)
+    result.update({"receipt_id": receipt_id, "path": path})
+    return result
+
+
+def _npz_receipt_id(path: str) -> Optional[str]:
+    """Receipt id from an .ocr.npz's meta record (store artifacts are named by image hash)."""
+    import numpy as np
+
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            return json.loads(data["meta"].tobytes().decode("utf-8")).get("receipt_id")
+    except Exception as e:
+        logger.warning(f"Failed to read stored OCR meta {path}: {e}")
+        return None
+
+
+def stored_ocr_index(directory: str) -> Dict[str, str]:
+    """
+    {receipt_id: path of its richest stored OCR result} for directory: the
+    .ocr.npz artifacts of an incoming store under <directory>/objects/, plus
+    flat files in directory itself (older dumps, --store-dir output).
+    """
+    best: Dict[str, tuple] = {}
+
+    def offer(receipt_id: str, rank: int, path: str):
+        if receipt_id not in best or rank < best[receipt_id][0]:
+            best[receipt_id] = (rank, path)
+
+    for name in os.listdir(directory):
+        for rank, suffix in enumerate(OCR_SUFFIXES):
+            if name.endswith(suffix):
+                offer(name[:-len(suffix)], rank, os.path.join(directory, name))
+                break
+
+    objects_dir = os.path.join(directory, "objects")
+    for root, _, names in os.walk(objects_dir):
+        for name in names:
+            if name.endswith(".ocr.npz"):
+                path = os.path.join(root, name)
+                receipt_id = _npz_receipt_id(path)
+                if receipt_id:
+                    offer(receipt_id, 0, path)
+    return {receipt_id: path for receipt_id, (_, path) in best.items()}
+
+
+def iter_stored_ocr(directory: str) -> Iterator[str]:
+    """Yield the richest stored OCR file for each receipt in directory (and its store), sorted by receipt id."""
+    index = stored_ocr_index(directory)
+    for receipt_id in sorted(index):
+        yield index[receipt_id]
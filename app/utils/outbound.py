@@ -0,0 +1,247 @@
+
+# app/utils/outbound.py
+#
+# Shared layer for calls to external services (WhatsApp Graph API, Google
+# Drive, Google Sheets): every call has a connect and a read timeout, and goes
+# through a per-dependency circuit breaker. After BREAKER_FAILURES consecutive
+# outages (timeouts, connection errors, 5xx) the breaker opens and calls fail
+# at once with CircuitOpenError, so callers fall back to their retry path
+# (outbox, upload spool, dead letters) instead of each waiting for its own
+# timeout. After BREAKER_RESET_S one trial call is let through; its outcome
+# closes the breaker or opens it again.
+#
+# Breakers are per process. Their state is exported as outbound_circuit_state
+# (0 closed, 1 half-open, 2 open), calls as outbound_calls_total.
+#
+# Sync callers use request() (requests) or google_http() (googleapiclient);
+# the FastAPI event loop uses async_client() (httpx, pooled with keep-alive)
+# under circuit(...).acall().
+
+import os
+import time
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from app.utils.metrics import count_outbound, set_circuit_state
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT_S = float(os.getenv("OUTBOUND_CONNECT_TIMEOUT_S", "5"))
+READ_TIMEOUT_S = {
+    "graph": float(os.getenv("GRAPH_READ_TIMEOUT_S", "20")),
+    "drive": float(os.getenv("DRIVE_READ_TIMEOUT_S", "60")),    # uploads
+    "sheets": float(os.getenv("SHEETS_READ_TIMEOUT_S", "30")),
+}
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET_S = float(os.getenv("BREAKER_RESET_S", "30"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+    def __init__(self, dependency: str, retry_in_s: float):
+        super().__init__(f"{dependency} circuit open, next trial in {retry_in_s:.0f}s")
+        self.dependency = dependency
+        self.retry_in_s = retry_in_s
+
+
+def is_outage(error: Exception) -> bool:
+    """Errors that say the dependency is down or slow (not that the request was wrong)."""
+    status = getattr(getattr(error, "resp", None), "status", None)                 # googleapiclient
+    status = status or getattr(getattr(error, "response", None), "status_code", None)  # requests
+    if status:
+        return int(status) >= 500 or int(status) == 408
+    # socket timeouts, connection resets and requests' ConnectionError/Timeout are all OSErrors
+    if isinstance(error, OSError) or type(error).__name__ in ("ServerNotFoundError", "RedirectLimit"):
+        return True
+    try:
+        import httpx
+        return isinstance(error, httpx.TransportError)   # httpx's timeouts and connection errors
+    except ImportError:
+        return False
+
+
+def _outcome(error: Exception, outage: bool) -> str:
+    if isinstance(error, TimeoutError) or "Timeout" in type(error).__name__ or "timed out" in str(error):
+        return "timeout"
+    return "outage" if outage else "error"
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset_s: float = BREAKER_RESET_S):
+        self.name = name
+        self.failures_to_open = failures
+        self.reset_s = reset_s
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.lock = threading.Lock()
+        set_circuit_state(name, 0)
+
+    def _set(self, state: str):
+        if state != self.state:
+            logger.warning(f"🔌 {self.name} circuit {self.state} -> {state}")
+            self.state = state
+            set_circuit_state(self.name, _STATE_VALUES[state])
+
+    def is_open(self) -> bool:
+        """True while calls would be rejected (does not take the half-open trial)."""
+        with self.lock:
+            return self.state == OPEN and time.time() - self.opened_at < self.reset_s
+
+    def _allow(self) -> bool:
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset_s:
+                self._set(HALF_OPEN)
+            if self.state == HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def _done(self, outage: bool):
+        with self.lock:
+            self.trial_running = False
+            if not outage:
+                self.failures = 0
+                self._set(CLOSED)
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failures_to_open:
+                self.opened_at = time.time()
+                self._set(OPEN)
+
+    def _enter(self):
+        if not self._allow():
+            count_outbound(self.name, "rejected")
+            raise CircuitOpenError(self.name, max(0.0, self.opened_at + self.reset_s - time.time()))
+
+    def _exit(self, error: Optional[Exception]):
+        if error is None:
+            self._done(False)
+            count_outbound(self.name, "ok")
+            return
+        outage = is_outage(error)
+        self._done(outage)
+        count_outbound(self.name, _outcome(error, outage))
+
+    def call(self, fn: Callable[[], Any]) -> Any:
+        self._enter()
+        try:
+            result = fn()
+        except Exception as e:
+            self._exit(e)
+            raise
+        self._exit(None)
+        return result
+
+    async def acall(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """call() for coroutines: `await circuit("graph").acall(lambda: client.get(url))`."""
+        self._enter()
+        try:
+            result = await fn()
+        except Exception as e:
+            self._exit(e)
+            raise
+        self._exit(None)
+        return result
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit(dependency: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if dependency not in _breakers:
+            _breakers[dependency] = CircuitBreaker(dependency)
+        return _breakers[dependency]
+
+
+def timeouts(dependency: str) -> Tuple[float, float]:
+    """(connect, read) timeout for a requests call to `dependency`."""
+    return CONNECT_TIMEOUT_S, READ_TIMEOUT_S.get(dependency, 30.0)
+
+
+# ------------------- requests (Graph API) -------------------
+
+_local = threading.local()
+
+
+def _session():
+    import requests
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = requests.Session()
+    return session
+
+
+def request(dependency: str, method: str, url: str, **kwargs) -> Any:
+    """requests call with the dependency's timeouts, under its breaker. Raises for 4xx/5xx."""
+    kwargs.setdefault("timeout", timeouts(dependency))
+
+    def send():
+        response = _session().request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    return circuit(dependency).call(send)
+
+
+# ------------------- httpx (event loop) -------------------
+
+POOL_CONNECTIONS = int(os.getenv("OUTBOUND_POOL_CONNECTIONS", "20"))
+POOL_KEEPALIVE_S = float(os.getenv("OUTBOUND_POOL_KEEPALIVE_S", "60"))
+
+_async_clients: Dict[str, Any] = {}
+
+
+def async_client(dependency: str):
+    """
+    Shared httpx.AsyncClient for `dependency` (created on first use, in the
+    running event loop): a pool of POOL_CONNECTIONS kept-alive connections
+    with the dependency's timeouts.
+    """
+    client = _async_clients.get(dependency)
+    if client is None or client.is_closed:
+        import httpx
+        connect, read = timeouts(dependency)
+        client = _async_clients[dependency] = httpx.AsyncClient(
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(max_connections=POOL_CONNECTIONS, max_keepalive_connections=POOL_CONNECTIONS,
+                                keepalive_expiry=POOL_KEEPALIVE_S),
+            follow_redirects=True,
+        )
+    return client
+
+
+async def aclose():
+    """Close the pooled async clients (FastAPI shutdown)."""
+    while _async_clients:
+        _, client = _async_clients.popitem()
+        await client.aclose()
+
+
+# ------------------- Google API clients -------------------
+
+def google_http(credentials, dependency: str):
+    """
+    Authorized httplib2 transport with a socket timeout, for
+    build(..., http=google_http(creds, "drive")). httplib2 has one timeout
+    for connect and each read, so the read timeout is used.
+    """
+    import httplib2
+    import google_auth_httplib2
+    return google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=READ_TIMEOUT_S[dependency]))
+
+
+def states() -> Dict[str, Dict[str, Any]]:
+    """Breaker state of this process, per dependency."""
+    with _breakers_lock:
+        return {name: {"state": b.state, "consecutive_failures": b.failures} for name, b in _breakers.items()}
@@ -0,0 +1,377 @@
+
+# app/utils/outbox.py
+#
+# Durable local outbox for sheet rows. process_receipt commits the row to a
+# SQLite database (WAL mode) and returns; a background flusher drains pending
+# rows to Google Sheets in batches. Each row carries an idempotency key, so a
+# receipt delivered twice by Celery or the listener is stored once, and a
+# row stays 'pending' until Sheets has accepted it. The key is also written to
+# a hidden column after the headers (gsheet.ROW_KEY_COLUMN), which is how a
+# row retried after a lost lease is recognised as already sent.
+#
+#   python -m app.utils.outbox status      # pending / sending / delivered counts
+#   python -m app.utils.outbox flush       # drain once
+#   python -m app.utils.outbox run         # keep draining (standalone flusher)
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from app.utils.metrics import timed, count_failure
+from app.utils.tracing import export_child_span
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_PATH = os.getenv(
+    "OUTBOX_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "outbox.sqlite3")
+)
+FLUSH_INTERVAL_S = float(os.getenv("OUTBOX_FLUSH_INTERVAL_S", "2"))
+BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+LEASE_S = float(os.getenv("OUTBOX_LEASE_S", "120"))
+KEEP_DELIVERED_DAYS = float(os.getenv("OUTBOX_KEEP_DELIVERED_DAYS", "30"))
+SHARD_WORKERS = int(os.getenv("OUTBOX_SHARD_WORKERS", "4"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    idem_key        TEXT NOT NULL UNIQUE,
+    spreadsheet_id  TEXT NOT NULL,
+    sheet_base_name TEXT NOT NULL,
+    max_rows        INTEGER NOT NULL,
+    row_json        TEXT NOT NULL,
+    state           TEXT NOT NULL DEFAULT 'pending',   -- pending | sending | delivered
+    claim           TEXT,
+    lease_until     REAL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    last_error      TEXT,
+    created_at      REAL NOT NULL,
+    delivered_at    REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, id);
+"""
+
+# Columns added after the first release, created on existing databases at connect time
+_ADDED_COLUMNS = {
+    "sheet_row": "TEXT",   # '<tab>!<row number>' once delivered
+    "trace": "TEXT",       # '<trace_id>:<span_id>' of the receipt (app/utils/tracing.py)
+    "patches": "TEXT",     # {column: value} still to be written to the delivered row (set_cell)
+}
+
+_local = threading.local()
+
+
+def _connect(path: Optional[str] = None) -> sqlite3.Connection:
+    """One connection per thread (and per forked worker process)."""
+    path = path or OUTBOX_PATH
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid() and _local.path == path:
+        return conn
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # NORMAL in WAL mode survives process crashes; only an OS crash can lose the last commits
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+    for column, kind in _ADDED_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} {kind}")
+    conn.execute("CREATE INDEX IF NOT EXISTS outbox_patches ON outbox (id) WHERE patches IS NOT NULL")
+    _local.conn, _local.pid, _local.path = conn, os.getpid(), path
+    return conn
+
+
+def enqueue_row(idem_key: str, spreadsheet_id: str, row_values: List[Any],
+                sheet_base_name: str = "botnogal", max_rows: int = 1000, trace: Optional[str] = None) -> bool:
+    """
+    Commit one sheet row to the outbox. Returns False if a row with the
+    same idempotency key is already there (the row is not stored twice).
+    """
+    cur = _connect().execute(
+        "INSERT OR IGNORE INTO outbox (idem_key, spreadsheet_id, sheet_base_name, max_rows, row_json, created_at, trace) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (idem_key, spreadsheet_id, sheet_base_name, max_rows, json.dumps(row_values, default=str), time.time(), trace)
+    )
+    return cur.rowcount == 1
+
+
+def _claim(conn: sqlite3.Connection, limit: int) -> List[sqlite3.Row]:
+    """Lease up to `limit` deliverable rows to this flusher (expired leases are taken over)."""
+    token, now = uuid.uuid4().hex, time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "UPDATE outbox SET state='sending', claim=?, lease_until=?, attempts=attempts+1 "
+            "WHERE id IN (SELECT id FROM outbox "
+            "             WHERE state='pending' OR (state='sending' AND lease_until < ?) "
+            "             ORDER BY id LIMIT ?)",
+            (token, now + LEASE_S, now, limit)
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute("SELECT * FROM outbox WHERE claim=? ORDER BY id", (token,)).fetchall()
+    conn.row_factory = None
+    return rows
+
+
+def _row_addresses(results: List[Dict[str, Any]]) -> List[str]:
+    """['botnogal_2!12', 'botnogal_2!13', ...] from values.append responses, in row order."""
+    addresses = []
+    for result in results:
+        updated = result.get("updates", {}).get("updatedRange", "")
+        m = re.match(r"^(.*)!\$?[A-Z]+\$?(\d+)(?::\$?[A-Z]+\$?(\d+))?$", updated)
+        if not m:
+            return []
+        tab, first = m.group(1).strip("'"), int(m.group(2))
+        last = int(m.group(3) or first)
+        addresses.extend(f"{tab}!{n}" for n in range(first, last + 1))
+    return addresses
+
+
+def _mark(conn: sqlite3.Connection, ids: List[int], state: str, error: Optional[str] = None,
+          addresses: Optional[List[str]] = None):
+    if not ids:
+        return
+    marks = ",".join("?" * len(ids))
+    if state == "delivered":
+        conn.execute(f"UPDATE outbox SET state='delivered', claim=NULL, delivered_at=?, last_error=NULL "
+                     f"WHERE id IN ({marks})", (time.time(), *ids))
+        if addresses and len(addresses) == len(ids):
+            conn.executemany("UPDATE outbox SET sheet_row=? WHERE id=?", list(zip(addresses, ids)))
+    else:
+        conn.execute(f"UPDATE outbox SET state='pending', claim=NULL, lease_until=NULL, last_error=? "
+                     f"WHERE id IN ({marks})", (error, *ids))
+
+
+def _sheet_values(entry: sqlite3.Row) -> List[Any]:
+    """The row as sent: its SHEET_HEADERS values, then the row key (as text) in the hidden column."""
+    from app.utils.gsheet import SHEET_HEADERS
+    row = json.loads(entry["row_json"])
+    return row + [""] * (len(SHEET_HEADERS) - len(row)) + ["'" + entry["idem_key"]]
+
+
+def _trace_delivery(entries: List[sqlite3.Row], started: float, ended: float, sheet_base_name: str,
+                    error: Optional[str] = None):
+    """outbox_wait and sheets_write spans for each traced row of a batch."""
+    for e in entries:
+        if e["trace"]:
+            export_child_span(e["trace"], "outbox_wait", e["created_at"], started, attempt=e["attempts"])
+            export_child_span(e["trace"], "sheets_write", started, ended, error=error,
+                              tab=sheet_base_name, batch_rows=len(entries))
+
+
+def _deliver_group(spreadsheet_id: str, sheet_base_name: str, max_rows: int,
+                   entries: List[sqlite3.Row]) -> int:
+    """Send one shard's rows (one spreadsheet tab family). Runs in its own thread."""
+    from app.utils.gsheet import write_rows, recent_row_keys
+
+    conn = _connect()
+    delivered = 0
+    started = time.time()
+    try:
+        # A row retried after an expired lease may have reached Sheets before the
+        # previous flusher died; skip it if its key is already in the tab family.
+        retried = [e for e in entries if e["attempts"] > 1]
+        if retried:
+            seen = recent_row_keys(spreadsheet_id, sheet_base_name)
+            already = [e for e in retried if e["idem_key"] in seen]
+            if already:
+                _mark(conn, [e["id"] for e in already], "delivered",
+                      addresses=[seen[e["idem_key"]] for e in already])
+                delivered += len(already)
+                entries = [e for e in entries if e["idem_key"] not in seen]
+                logger.info(f"Outbox: {len(already)} row(s) already in {sheet_base_name}, not re-sent")
+
+        results = []
+        if entries:
+            with timed("sheets_write"):
+                results = write_rows(spreadsheet_id, [_sheet_values(e) for e in entries],
+                                     sheet_base_name=sheet_base_name, max_rows=max_rows)
+        _mark(conn, [e["id"] for e in entries], "delivered", addresses=_row_addresses(results))
+        delivered += len(entries)
+        _trace_delivery(entries, started, time.time(), sheet_base_name)
+    except Exception as err:
+        _mark(conn, [e["id"] for e in entries], "pending", error=str(err)[:500])
+        count_failure("sheets_write", len(entries))
+        _trace_delivery(entries, started, time.time(), sheet_base_name, error=str(err)[:200])
+        logger.error(f"Outbox: failed to deliver {len(entries)} row(s) to {sheet_base_name}: {err}")
+    return delivered
+
+
+def apply_patches(limit: int = BATCH_SIZE) -> int:
+    """
+    Write the cells changed by set_cell into delivered rows, one batched
+    update per spreadsheet. Returns the number of rows patched.
+    """
+    from app.utils.gsheet import SHEET_HEADERS, update_cells
+
+    conn = _connect()
+    todo = conn.execute("SELECT id, idem_key, spreadsheet_id, sheet_row, patches FROM outbox "
+                        "WHERE patches IS NOT NULL AND state='delivered' ORDER BY id LIMIT ?", (limit,)).fetchall()
+    cells: Dict[str, Dict[str, Any]] = {}
+    rows: Dict[str, List[tuple]] = {}
+    for row_id, idem_key, spreadsheet_id, sheet_row, patches in todo:
+        if not sheet_row:
+            logger.warning(f"Outbox: no sheet position for {idem_key}, {patches} not patched")
+            conn.execute("UPDATE outbox SET patches=NULL WHERE id=? AND patches=?", (row_id, patches))
+            continue
+        tab, number = sheet_row.rsplit("!", 1)
+        for column, value in json.loads(patches).items():
+            cells.setdefault(spreadsheet_id, {})[f"{tab}!{chr(ord('A') + SHEET_HEADERS.index(column))}{number}"] = value
+        rows.setdefault(spreadsheet_id, []).append((row_id, patches))
+
+    patched = 0
+    for spreadsheet_id, sheet_cells in cells.items():
+        try:
+            update_cells(spreadsheet_id, sheet_cells, BATCH_SIZE)
+        except Exception as e:
+            logger.error(f"Outbox: could not patch {len(rows[spreadsheet_id])} row(s) of {spreadsheet_id}, "
+                         f"retrying next round: {e}")
+            continue
+        # Only clear what was written; set_cell may have added a patch meanwhile
+        conn.executemany("UPDATE outbox SET patches=NULL WHERE id=? AND patches=?", rows[spreadsheet_id])
+        patched += len(rows[spreadsheet_id])
+        logger.info(f"✅ Outbox: patched {len(sheet_cells)} cell(s) in {len(rows[spreadsheet_id])} row(s) of {spreadsheet_id}")
+    return patched
+
+
+def flush_once(batch_size: int = BATCH_SIZE) -> int:
+    """Deliver one batch of pending rows. Returns the number of rows delivered."""
+    conn = _connect()
+    claimed = _claim(conn, batch_size)
+    if not claimed:
+        apply_patches()
+        return 0
+
+    groups: Dict[tuple, List[sqlite3.Row]] = {}
+    for row in claimed:
+        groups.setdefault((row["spreadsheet_id"], row["sheet_base_name"], row["max_rows"]), []).append(row)
+
+    # Shards (see sheet_routing.py) go out in parallel; all of them still share
+    # the per-API quota in ratelimit.py.
+    if len(groups) == 1 or SHARD_WORKERS <= 1:
+        delivered = sum(_deliver_group(*key, entries) for key, entries in groups.items())
+    else:
+        with ThreadPoolExecutor(max_workers=min(SHARD_WORKERS, len(groups)),
+                                thread_name_prefix="outbox-shard") as pool:
+            delivered = sum(pool.map(lambda item: _deliver_group(*item[0], item[1]), groups.items()))
+
+    if delivered:
+        logger.info(f"✅ Outbox: delivered {delivered} row(s) to Google Sheets ({len(groups)} shard(s))")
+    apply_patches()
+    return delivered
+
+
+def set_cell(idem_key: str, column: str, value: Any) -> bool:
+    """
+    Change one column of a row after it was enqueued (e.g. the image link once
+    its upload finishes). Pending rows are rewritten in place; for rows being
+    sent or already delivered the change is also recorded in `patches`, which
+    the flusher writes to the sheet once the row is delivered. Returns False
+    if the row is unknown.
+    """
+    from app.utils.gsheet import SHEET_HEADERS
+
+    conn = _connect()
+    col = SHEET_HEADERS.index(column)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        found = conn.execute("SELECT row_json, state, patches FROM outbox WHERE idem_key=?", (idem_key,)).fetchone()
+        if found is None:
+            conn.execute("ROLLBACK")
+            return False
+        row_json, state, patches = found
+        row = json.loads(row_json)
+        row[col] = value
+        patches = json.loads(patches or "{}")
+        if state != "pending":
+            # A row being sent right now may go out with the old value
+            patches[column] = value
+        conn.execute("UPDATE outbox SET row_json=?, patches=? WHERE idem_key=?",
+                     (json.dumps(row, default=str), json.dumps(patches, default=str) if patches else None, idem_key))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return True
+
+
+def sheet_position(idem_key: str) -> Optional[tuple]:
+    """(spreadsheet_id, '<tab>!<row number>') of a delivered row, or None if unknown or pruned."""
+    found = _connect().execute("SELECT spreadsheet_id, sheet_row FROM outbox WHERE idem_key=? AND sheet_row IS NOT NULL",
+                               (idem_key,)).fetchone()
+    return tuple(found) if found else None
+
+
+def flush_all(batch_size: int = BATCH_SIZE) -> int:
+    total = 0
+    while True:
+        n = flush_once(batch_size)
+        total += n
+        if n < batch_size:
+            return total
+
+
+def prune_delivered(days: float = KEEP_DELIVERED_DAYS) -> int:
+    """Drop delivered rows older than `days` (idempotency keys are kept that long)."""
+    cur = _connect().execute("DELETE FROM outbox WHERE state='delivered' AND delivered_at < ?",
+                             (time.time() - days * 86400,))
+    return cur.rowcount
+
+
+def stats() -> Dict[str, Any]:
+    conn = _connect()
+    counts = dict(conn.execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall())
+    oldest = conn.execute("SELECT MIN(created_at) FROM outbox WHERE state != 'delivered'").fetchone()[0]
+    return {
+        "pending": counts.get("pending", 0),
+        "sending": counts.get("sending", 0),
+        "delivered": counts.get("delivered", 0),
+        "oldest_pending_age_s": round(time.time() - oldest, 1) if oldest else 0.0,
+    }
+
+
+def run_flusher(stop: Optional[threading.Event] = None, interval: float = FLUSH_INTERVAL_S):
+    """Drain the outbox until `stop` is set. Errors are logged and retried next round."""
+    stop = stop or threading.Event()
+    logger.info(f"Outbox flusher started ({OUTBOX_PATH}, every {interval}s)")
+    last_prune = 0.0
+    while not stop.is_set():
+        try:
+            flush_all()
+            if time.time() - last_prune > 3600:
+                prune_delivered()
+                last_prune = time.time()
+        except Exception as e:
+            logger.error(f"Outbox flusher error: {e}")
+        stop.wait(interval)
+
+
+def start_flusher_thread() -> threading.Event:
+    """Run the flusher in a daemon thread; set the returned event to stop it."""
+    stop = threading.Event()
+    threading.Thread(target=run_flusher, args=(stop,), name="outbox-flusher", daemon=True).start()
+    return stop
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if command == "flush":
+        print(f"delivered {flush_all()} row(s)")
+    elif command == "run":
+        run_flusher()
+    else:
+        print(json.dumps(stats(), indent=2))
@@ -0,0 +1,600 @@
+
+# app/utils/parser.py
+
+import os
+import re
+import bisect
+import time
+import logging
+from typing import Dict, Any, Optional, List, Callable
+from datetime import datetime
+import pytz
+
+logger = logging.getLogger(__name__)
+
+# ------------------- Limits -------------------
+# Every pattern below is linear in the input (bounded repetitions, no nested
+# unbounded quantifiers), so the worst case is set by the text length cap.
+# Real receipts are well under 1 000 characters once whitespace is collapsed.
+MAX_TEXT_CHARS = int(os.getenv("PARSER_MAX_TEXT_CHARS", "8000"))
+FIELD_BUDGET_MS = float(os.getenv("PARSER_FIELD_BUDGET_MS", "50"))
+
+# Supplier detection
+SUPPLIERS = [
+    "Transgestiona",
+    "Prestigio pagos",
+    "Plataforma de pago",
+    "Aurinegros",
+    "Cobro Express",
+    "Cobro Sur Sa",
+    "CLAN SRL",
+    "RAZ Y CIA",
+    "Cobro sur"
+]
+DEFAULT_SUPPLIER = "Other"
+
+# "para ... ciudad" inside one run of letters; bounded so a long run without
+# "ciudad" is not rescanned from every "para"/"banco" occurrence.
+BANK_CIUDAD_PATTERN = re.compile(
+    r'(?:banco\s+destino|para|banco)\s*[:\-]?\s*([a-z\s]{1,200}?ciudad[a-z\s]{0,40}?)', re.S
+)
+
+# mapping from detected code -> bank name
+DESTINO_MAP = {
+    "007": "Galicia",
+    "285": "Macro",
+    "191": "Credicoop Nueva",
+    "053": "Agil Pagos",        # normalize 0000053 -> take last 3 as '053'
+    "044": "Hipotecario",
+    "011": "Nacion",
+    "029": "Ciudad",
+    "072": "Santander",
+}
+
+BANK_NAME_PATTERNS = ["Hipotecario", "Santander", "Galicia", "Provincia", "Macro",
+                      "BBVA", "ICBC", "Ciudad", "Credicoop", "Agil Pagos", "Nacion"]
+
+MONTHS = {
+    "enero": "01", "febrero": "02", "marzo": "03", "abril": "04",
+    "mayo": "05", "junio": "06", "julio": "07", "agosto": "08",
+    "septiembre": "09", "setiembre": "09", "octubre": "10",
+    "noviembre": "11", "diciembre": "12",
+    "ene": "01", "feb": "02", "mar": "03", "abr": "04", "may": "05",
+    "jun": "06", "jul": "07", "ago": "08", "sep": "09", "oct": "10",
+    "nov": "11", "dic": "12"
+}
+
+PATTERNS = {
+    # Date: handles both numeric and Spanish text dates
+    'date': r'(\b\d{1,2}[-/]\d{1,2}[-/]\d{2,4}\b' # DD/MM/YYYY
+        r'|\b\d{1,2}[-/](?:ene|feb|mar|abr|may|jun|jul|ago|sep|oct|nov|dic)\w{0,12}[-/]\d{2,4}\b' # <-- NEW HYBRID FORMAT
+        r'|\b(?:lunes|martes|miércoles|jueves|viernes|sábado|domingo)?[,]?\s*\d{1,2}\s*(?:de\s+)?(?:ene|feb|mar|abr|may|jun|jul|ago|sep|oct|nov|dic)\w{0,12}\s*(?:de\s+)?\d{4})',
+}
+
+COMPILED = {
+    'date': re.compile(PATTERNS['date'], re.I),
+}
+
+# Single left-to-right tokenizer for amount, CUIT and operation number.
+# Labels are matched before generic words so "Nro. de comprobante" is one
+# token; values are whole digit groups or words, so every alternative is
+# tried at most once per token start and the sweep stays linear.
+SWEEP_PATTERN = re.compile(
+    r'(?P<op_label>'
+    r'n[uú]mero\s+de\s+operaci[oó]n(?:\s+de\s+mercado\s*pago)?'
+    r'|n[°º]?\s*de\s+(?:operaci[oó]n|comprobante|control|transacci[oó]n)'
+    r'|nro\.?\s*(?:de\s+)?(?:control|comprobante|operaci[oó]n|transacci[oó]n)'
+    r'|nro\.'
+    r'|n[°º]\s*(?:control|c[oó]mprobante|operaci[oó]n)'
+    r'|c[oó]digo\s+de\s+(?:transacci[oó]n|identificaci[oó]n|operaci[oó]n)'
+    r'|id\s*op\.?|referen[cñ]ia|c[oó]mprobante|transacci[oó]n|transacti[oó]n|operaci[oó]n|operation|control|ref\.'
+    r')(?![a-z])'
+    r'|(?P<cuit_label>cuit|cuil|dni|origen|n[úu]m\s*doc)(?![a-z])'
+    r'|(?P<amount_label>importe|pesos|monto|total|pago|\$)(?![a-z])'
+    r'|(?P<number>\d[\d.,\-]*\d|\d)(?!\w)'
+    r'|(?P<word>\w[\w\-]*)',
+    re.I
+)
+# Only separators may sit between a label and its value.
+LABEL_GAP = re.compile(r'[\s:\-.#°º]{0,4}')
+AMOUNT_SHAPE = re.compile(r'\d+(?:[.,]\d+)+')
+AMOUNT_WELL_FORMED = re.compile(r'\d{1,3}(?:[.,]\d{3})+(?:[.,]\d{2})?|\d+[.,]\d{2}')
+DATE_SHAPE = re.compile(r'\d{1,2}[.,]\d{1,2}[.,]\d{2,4}')
+CUIT_DASHED = re.compile(r'\d{2}-\d{8}-\d')
+CUIT_PREFIXES = ("20", "23", "24", "27", "30", "33", "34")
+CUIT_WEIGHTS = (5, 4, 3, 2, 7, 6, 5, 4, 3, 2)
+LOW_CONFIDENCE = 0.5
+
+
+def clean_ocr_text(text_lines: List[str]) -> str:
+    """Join OCR lines into one whitespace-collapsed string, capped at MAX_TEXT_CHARS."""
+    full_text = "\n".join(text_lines)
+    cleaned_text = re.sub(r'\s+', ' ', full_text).strip()
+    if len(cleaned_text) > MAX_TEXT_CHARS:
+        logger.warning(f"OCR text truncated from {len(cleaned_text)} to {MAX_TEXT_CHARS} chars")
+        cleaned_text = cleaned_text[:MAX_TEXT_CHARS]
+    return cleaned_text
+
+
+def detect_supplier(text: str) -> str:
+    text_lower = text.lower()
+
+    # 1. Check for the hardcoded rule FIRST.
+    if BANK_CIUDAD_PATTERN.search(text_lower):
+        return "Transgestiona"
+    for supplier in SUPPLIERS:
+        if supplier.lower() in text_lower:
+            return supplier
+    return DEFAULT_SUPPLIER
+
+
+def norm_code(code: str) -> str:
+    code = re.sub(r'\D', '', code or "")  # remove non-digits
+    # Agil Pagos special case (e.g., 0000053...)
+    if code.startswith("00000") and len(code) >= 7:
+        return code[5:8]  # take digits 6,7,8
+    # General case: take first 3 digits
+    if len(code) >= 3:
+        return code[:3]
+    # If code is shorter than 3 digits, pad with zeros
+    return code.zfill(3)
+
+
+# Supplier-specific fallbacks: (supplier names, CBU that must appear in the text or None, bank)
+SUPPLIER_BANK_RULES = [
+    (("transgestiona", "transgestiona S A"), "0110074720007400875197", "Nacion"),
+    (("transgestiona", "transgestiona S A"), None, "Ciudad"),
+    (("cobro sur sa", "cobro sur"), None, "Hipotecario"),
+    (("prestigio pagos",), "0440000430000010401791", "Hipotecario"),
+    (("prestigio pagos",), "0000053600000033387693", "Agil Pagos"),
+    (("prestigio pagos", "prestigio pagos sa"), None, "Agil Pagos"),
+    (("aurinegros sa", "aurinegros"), ("044000043", "0440000044"), "Hipotecario"),
+    (("aurinegros sa", "aurinegros"), "0110001320000100574191", "Nacion"),
+    (("aurinegros sa", "aurinegros"), "0290031500000502572582", "Ciudad"),
+    (("raz y cia sa", "raz y cia"), "0070158320000001103504", "Galicia"),
+    (("clan srl", "clan"), "0720039720000000390554", "Santander"),
+    (("clan srl", "caln"), "2850302630094201041381", "Macro"),
+    (("clan srl", "clan"), "1910233555023300527178", "Credicoop nueva"),
+    (("plataforma de", "plataforma de pago sa"), "2850759230094207764521", "Macro"),
+    (("plataforma de", "plataforma de pago sa"), "0110074720007400875197", "Nacion"),
+    (("plataforma de", "plataforma de pago sa"), "0290031500000502079632", "Ciudad"),
+]
+
+
+def extract_destination_bank(cleaned_text: str, supplier: str) -> Optional[str]:
+    """Detect the destination bank from destino codes, CBU/CVU prefixes and supplier rules."""
+    cleaned_lower = cleaned_text.lower()
+    supplier_lower = (supplier or '').lower()
+    bank = None
+
+    # 1) Try explicit "destino" followed by short code (1–7 digits)
+    m = re.search(r'destino[:\s]*([0-9]{1,7})', cleaned_lower)
+    if m:
+        code_raw = m.group(1)
+        code = norm_code(code_raw)
+        bank = DESTINO_MAP.get(code)
+        logger.info(f"destino match -> raw:{code_raw} normalized:{code} bank:{bank}")
+
+    # 2) If not found, look for a 22-digit CBU/CVU and extract its first 3 digits (common case)
+    if not bank:
+        m = re.search(r'(?:CBU|CVU)[:\s]*([0-9]{22})', cleaned_lower)
+        if m:
+            bank_code = m.group(1)[:3]  # first 3 digits of CBU are the bank code
+            code = norm_code(bank_code)
+            bank = DESTINO_MAP.get(code)
+            logger.info(f"22-digit CBU found -> bank_code:{bank_code} normalized:{code} bank:{bank}")
+
+    # 3) If still not found, try cbu/cvu with any digits and take first 3 digits
+    if not bank:
+        m = re.search(r'(?:CBU|CVU)[:\s]*([0-9]{3,7})', cleaned_lower)
+        if m:
+            code_raw = m.group(1)
+            code = norm_code(code_raw)
+            bank = DESTINO_MAP.get(code)
+            logger.info(f"short cbu/cvu match -> raw:{code_raw} normalized:{code} bank:{bank}")
+
+    # 4) Fallback: text-based bank detection after 'para'
+    before, sep, after_para = cleaned_lower.partition("para")
+    if not bank and sep:
+        for b in BANK_NAME_PATTERNS:
+            if b.lower() in after_para:
+                bank = b
+                logger.info(f"text match -> bank:{b}")
+                break
+
+    # 5) Special rule: if supplier == "Cobro Express" and no 'para' use Agil Pagos
+    if not bank and supplier_lower in ("cobro express buenos aires sa", "cobro express"):
+        bank = "Agil Pagos"
+        logger.info("No 'para' and supplier Cobro Express -> set Agil Pagos")
+
+    # 6) 22-digit CBU/CVU in the "after para" text
+    if not bank and sep:
+        m = re.search(r'(?:CVU|CBU)[:\s]*([0-9]{22})', after_para, re.IGNORECASE)
+        if m:
+            bank_code = m.group(1)[:3]
+            code = norm_code(bank_code)
+            bank = DESTINO_MAP.get(code)
+            logger.info(f"'para' section 22-digit CBU found -> bank_code:{bank_code} normalized:{code} bank:{bank}")
+
+    # 7) Supplier-specific account rules
+    if not bank:
+        for names, accounts, rule_bank in SUPPLIER_BANK_RULES:
+            if supplier_lower not in names:
+                continue
+            if accounts is not None:
+                if isinstance(accounts, str):
+                    accounts = (accounts,)
+                if not any(a in cleaned_text for a in accounts):
+                    continue
+            bank = rule_bank
+            logger.info(f"supplier rule -> {supplier} -> set {rule_bank}")
+            break
+
+    # 8) Otherwise, search in full text
+    if not bank:
+        for b in BANK_NAME_PATTERNS:
+            if b.lower() in cleaned_lower:
+                bank = b
+                break
+
+    logger.info(f"Final Destination_Bank: {bank}")
+    return bank
+
+
+def extract_date(cleaned_text: str, report: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Return the receipt date as YYYY-MM-DD, or today's Argentina date when none
+    is found (recorded as report["date_fallback"] if report is given).
+    """
+    date_match = COMPILED['date'].search(cleaned_text)
+    if report is not None:
+        report["date_fallback"] = date_match is None
+    if date_match:
+        date_str = date_match.group(1).strip().lower()
+
+        # Try to normalize date
+        try:
+            # Example: "06 de noviembre de 2025"
+            parts = re.findall(r"(\d{1,2})\D+(ene|feb|mar|abr|may|jun|jul|ago|sep|oct|nov|dic)\w*\D+(\d{4})", date_str)
+            if parts:
+                day, month_abbr, year = parts[0]
+                month = MONTHS.get(month_abbr, "01")
+                return f"{year}-{month}-{int(day):02d}"
+            # fallback for numeric formats like 06/11/2025 or 6-11-25
+            d = re.findall(r"\d{1,2}", date_str)
+            y = re.findall(r"\d{2,4}", date_str)
+            if len(d) >= 2 and y:
+                day = d[0]
+                month = d[1]
+                year = y[-1]
+                if len(year) == 2:
+                    year = f"20{year}"
+                return f"{year}-{int(month):02d}-{int(day):02d}"
+            return date_str
+        except Exception as e:
+            logger.warning(f"Date parsing failed: {e}")
+            return date_str
+
+    argentina_tz = pytz.timezone("America/Argentina/Buenos_Aires")
+    current_date = datetime.now(argentina_tz).strftime("%Y-%m-%d")
+    logger.info(f"No date found — using current Argentina date: {current_date}")
+    return current_date
+
+
+def normalize_amount(text, force_two_decimals=False):
+    """
+    Normaliza importes detectados por OCR:
+    - Detecta coma o punto final + 2 dígitos como parte decimal.
+    - Devuelve número con coma decimal y puntos de miles.
+    Ejemplo: "$ 754528.27" -> "754.528,27"
+    """
+    if text is None:
+        return None
+
+    s = str(text).strip()
+    s = re.sub(r'[^\d\.,\s]', '', s)   # dejar solo dígitos, puntos, comas y espacios
+    s = s.strip()
+
+    # Buscar si termina con . o , y exactamente 2 dígitos
+    m = re.search(r'([.,])(\d{2})\s*$', s)
+    if m:
+        decimals = m.group(2)
+        prefix = s[:m.start(1)]
+        integer_digits = re.sub(r'[^0-9]', '', prefix)  # eliminar separadores
+        if integer_digits == '':
+            integer_digits = '0'
+        # Formatear con puntos de miles
+        integer_with_dots = f"{int(integer_digits):,}".replace(",", ".")
+        return f"{integer_with_dots},{decimals}"
+    else:
+        # No hay parte decimal válida
+        digits = re.sub(r'[^0-9]', '', s)
+        if digits == '':
+            return ''
+        if force_two_decimals:
+            formatted = f"{int(digits):,}".replace(",", ".")
+            return f"{formatted},00"
+        return f"{int(digits):,}".replace(",", ".")
+
+
+def build_confidence_index(text_lines: List[str], scores: Optional[List[float]]) -> Optional[List[tuple]]:
+    """
+    Map OCR line scores onto offsets in clean_ocr_text(text_lines).
+    Returns sorted (start_offset, score) pairs, or None when there are no scores.
+    """
+    if not scores or len(scores) != len(text_lines):
+        return None
+    index = []
+    pos = 0
+    for line, score in zip(text_lines, scores):
+        collapsed = re.sub(r'\s+', ' ', line or '').strip()
+        if not collapsed:
+            continue
+        index.append((pos, float(score)))
+        pos += len(collapsed) + 1
+    return index
+
+
+def _confidence_at(confidence: Optional[List[tuple]], pos: int) -> Optional[float]:
+    if not confidence:
+        return None
+    i = bisect.bisect_right(confidence, (pos, float('inf'))) - 1
+    return confidence[i][1] if i >= 0 else None
+
+
+def cuit_is_valid(digits: str) -> bool:
+    """Mod-11 check digit for an 11-digit CUIT/CUIL."""
+    if len(digits) != 11 or not digits.isdigit():
+        return False
+    total = sum(int(d) * w for d, w in zip(digits[:10], CUIT_WEIGHTS))
+    check = 11 - total % 11
+    if check == 11:
+        check = 0
+    elif check == 10:
+        check = 9
+    return check == int(digits[10])
+
+
+def amount_value(raw: str) -> float:
+    """Numeric value of an OCR amount, using the same decimal rule as normalize_amount."""
+    normalized = normalize_amount(raw) or '0'
+    try:
+        return float(normalized.replace('.', '').replace(',', '.'))
+    except ValueError:
+        return 0.0
+
+
+def collect_candidates(cleaned_text: str, confidence: Optional[List[tuple]] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    One finditer sweep over the text. Every amount, CUIT and operation number
+    candidate is returned with its position, the label right before it (if any)
+    and the OCR confidence of its line. Scoring happens afterwards.
+    """
+    candidates = {'Amount': [], 'Sender_CUIT': [], 'Transaction_Number': []}
+    label = None  # (kind, text, end)
+
+    for m in SWEEP_PATTERN.finditer(cleaned_text):
+        kind = m.lastgroup
+        if kind in ('op_label', 'cuit_label', 'amount_label'):
+            label = (kind, m.group(), m.end())
+            continue
+
+        token = m.group()
+        attached = None
+        if label and LABEL_GAP.fullmatch(cleaned_text, label[2], m.start()):
+            attached = label
+        label = None
+
+        base = {
+            'raw': token,
+            'start': m.start(),
+            'label': attached[1] if attached else None,
+            'confidence': _confidence_at(confidence, m.start()),
+        }
+        label_kind = attached[0] if attached else None
+
+        if kind == 'number':
+            digits = re.sub(r'\D', '', token)
+            has_sep = '.' in token or ',' in token
+
+            if len(digits) == 11 and not has_sep and (label_kind == 'cuit_label' or CUIT_DASHED.fullmatch(token)):
+                candidates['Sender_CUIT'].append(dict(base, value=digits, label_kind=label_kind))
+
+            if '-' not in token and (AMOUNT_SHAPE.fullmatch(token) or (label_kind == 'amount_label' and len(digits) <= 12)):
+                candidates['Amount'].append(dict(base, value=token, label_kind=label_kind))
+
+            if label_kind == 'op_label' and not has_sep:
+                candidates['Transaction_Number'].append(dict(base, value=digits, numeric=True, label_kind=label_kind))
+
+        elif kind == 'word' and label_kind == 'op_label':
+            value = token.replace('-', '')
+            if 5 <= len(value) <= 36 and re.search(r'[A-Za-z]', value) and re.search(r'\d', value):
+                candidates['Transaction_Number'].append(dict(base, value=value, numeric=False, label_kind=label_kind))
+
+    return candidates
+
+
+def _apply_confidence(candidate: Dict[str, Any], score: int, reasons: List[str]) -> int:
+    conf = candidate.get('confidence')
+    if conf is not None and conf < LOW_CONFIDENCE:
+        reasons.append(f"low OCR confidence {conf:.2f} (-1)")
+        return score - 1
+    return score
+
+
+def score_amount(candidate: Dict[str, Any]) -> Dict[str, Any]:
+    raw, label = candidate['raw'], (candidate['label'] or '').lower()
+    score, reasons = 0, []
+    if label in ('$', 'importe', 'monto', 'total', 'pesos'):
+        score += 3
+        reasons.append(f"currency label '{candidate['label']}' (+3)")
+    elif label:
+        score += 1
+        reasons.append(f"label '{candidate['label']}' (+1)")
+    if AMOUNT_WELL_FORMED.fullmatch(raw):
+        score += 1
+        reasons.append("well-formed thousands/decimals (+1)")
+    elif AMOUNT_SHAPE.fullmatch(raw):
+        score -= 2
+        reasons.append("irregular separators (-2)")
+    if DATE_SHAPE.fullmatch(raw):
+        score -= 3
+        reasons.append("looks like a date (-3)")
+    score = _apply_confidence(candidate, score, reasons)
+    return dict(candidate, score=score, reasons=reasons, amount=amount_value(raw))
+
+
+def score_cuit(candidate: Dict[str, Any], sender_area: tuple) -> Dict[str, Any]:
+    digits = candidate['value']
+    score, reasons = 0, []
+    if candidate['label_kind'] == 'cuit_label':
+        score += 2
+        reasons.append(f"label '{candidate['label']}' (+2)")
+    if cuit_is_valid(digits):
+        score += 3
+        reasons.append("mod-11 check digit ok (+3)")
+    else:
+        reasons.append("mod-11 check digit mismatch")
+    if CUIT_DASHED.fullmatch(candidate['raw']):
+        score += 1
+        reasons.append("NN-NNNNNNNN-N format (+1)")
+    if digits[:2] in CUIT_PREFIXES:
+        score += 1
+        reasons.append(f"known prefix {digits[:2]} (+1)")
+    in_area = sender_area[0] <= candidate['start'] < sender_area[1]
+    if not in_area:
+        reasons.append("outside sender area (rejected)")
+    score = _apply_confidence(candidate, score, reasons)
+    return dict(candidate, score=score, reasons=reasons, eligible=in_area)
+
+
+def score_operation(candidate: Dict[str, Any]) -> Dict[str, Any]:
+    value, label = candidate['value'], (candidate['label'] or '').lower()
+    score, reasons = 0, []
+    if candidate['numeric']:
+        score += 3
+        reasons.append("numeric value after operation label (+3)")
+        if len(value) >= 6:
+            score += 1
+            reasons.append("6+ digits (+1)")
+        elif len(value) < 4:
+            score -= 2
+            reasons.append("fewer than 4 digits (-2)")
+    else:
+        score += 2
+        reasons.append("alphanumeric value after operation label (+2)")
+    if re.match(r'(?:n[uú]mero|nro|n[°º]|c[oó]digo|id)', label):
+        score += 1
+        reasons.append(f"explicit number label '{candidate['label']}' (+1)")
+    score = _apply_confidence(candidate, score, reasons)
+    return dict(candidate, score=score, reasons=reasons)
+
+
+def _choose(field: str, scored: List[Dict[str, Any]], key: Callable, report: Optional[Dict[str, Any]]):
+    """Pick the best scored candidate and record every candidate for the report."""
+    eligible = [c for c in scored if c.get('eligible', True)]
+    best = max(eligible, key=key) if eligible else None
+    if report is not None:
+        report.setdefault("candidates", {})[field] = [
+            {k: c[k] for k in ('raw', 'value', 'start', 'label', 'confidence', 'score', 'reasons') if k in c}
+            | {'chosen': c is best}
+            for c in scored
+        ]
+    if best is not None:
+        logger.info(f"{field}: chose {best['raw']!r} (score {best['score']}: {'; '.join(best['reasons'])}) "
+                    f"from {len(scored)} candidate(s)")
+    return best
+
+
+def _sender_area(cleaned_text: str) -> tuple:
+    """Character span between the first 'De' and the following 'Para' (whole text if no 'De')."""
+    de_idx = cleaned_text.find('De')
+    if de_idx < 0:
+        return (0, len(cleaned_text))
+    start = de_idx + 2
+    para_idx = cleaned_text.find('Para', start)
+    return (start, para_idx if para_idx >= 0 else len(cleaned_text))
+
+
+def extract_amount(candidates: List[Dict[str, Any]], report: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """Prefer a currency label, then the largest value, then the earliest position."""
+    scored = [score_amount(c) for c in candidates]
+    best = _choose('Amount', scored, lambda c: (c['score'], c['amount'], -c['start']), report)
+    return normalize_amount(best['raw']) if best else None
+
+
+def extract_sender_cuit(cleaned_text: str, candidates: List[Dict[str, Any]],
+                        report: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """Return the best 11-digit CUIT between 'De' and 'Para', if any."""
+    area = _sender_area(cleaned_text)
+    scored = [score_cuit(c, area) for c in candidates]
+    best = _choose('Sender_CUIT', scored, lambda c: (c['score'], -c['start']), report)
+    if best is None:
+        return None
+    cuit_digits = best['value']
+    if ('De' in cleaned_text and not "BNA" in cleaned_text) or cuit_digits.startswith('2'):
+        return cuit_digits
+    return None
+
+
+def _last_six(op_value: str) -> str:
+    return op_value[-6:].lower() if len(op_value) >= 6 else op_value.lower()
+
+
+def extract_transaction_number(candidates: List[Dict[str, Any]],
+                               report: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """Return the last 6 characters of the best operation / control / reference number."""
+    scored = [score_operation(c) for c in candidates]
+    best = _choose('Transaction_Number', scored, lambda c: (c['score'], -c['start']), report)
+    return _last_six(best['value']) if best else None
+
+
+def _timed(field: str, func: Callable, report: Optional[Dict[str, Any]], *args):
+    """Run one field extractor, record its wall time and warn when it exceeds FIELD_BUDGET_MS."""
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if report is not None:
+            report.setdefault("timings", {})[field] = elapsed_ms
+        if elapsed_ms > FIELD_BUDGET_MS:
+            logger.warning(f"⏱️ {field} extraction took {elapsed_ms:.1f} ms (budget {FIELD_BUDGET_MS:.0f} ms)")
+
+
+def extract_fields(cleaned_text: str, supplier: Optional[str] = None,
+                   report: Optional[Dict[str, Any]] = None,
+                   confidence: Optional[List[tuple]] = None) -> Dict[str, Any]:
+    """
+    Extract receipt fields from whitespace-collapsed OCR text.
+    confidence is the output of build_confidence_index() for the same lines.
+    If report is given, per-field timings (ms) are stored under report["timings"],
+    every scored candidate under report["candidates"], and whether Receipt_Date
+    is extract_date's fallback to today under report["date_fallback"].
+    """
+    if len(cleaned_text) > MAX_TEXT_CHARS:
+        cleaned_text = cleaned_text[:MAX_TEXT_CHARS]
+    if supplier is None:
+        supplier = _timed('Supplier', detect_supplier, report, cleaned_text)
+
+    candidates = _timed('candidate_sweep', collect_candidates, report, cleaned_text, confidence)
+
+    return {
+        'Receipt_Date': _timed('Receipt_Date', extract_date, report, cleaned_text, report),
+        'Amount': _timed('Amount', extract_amount, report, candidates['Amount'], report),
+        'Sender_CUIT': _timed('Sender_CUIT', extract_sender_cuit, report, cleaned_text, candidates['Sender_CUIT'], report),
+        'Receiver_CUIT': None,
+        'Transaction_Number': _timed('Transaction_Number', extract_transaction_number, report,
+                                     candidates['Transaction_Number'], report),
+        'Destination_Bank': _timed('Destination_Bank', extract_destination_bank, report, cleaned_text, supplier),
+        'Supplier': supplier,
+    }
+
+
+def extract_receipt(text_lines: List[str], scores: Optional[List[float]] = None,
+                    report: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """clean_ocr_text + extract_fields for one OCR result (lines and optional per-line scores)."""
+    return extract_fields(
+        clean_ocr_text(text_lines), report=report,
+        confidence=build_confidence_index(text_lines, scores)
+    )
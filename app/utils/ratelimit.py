@@ -0,0 +1,216 @@
+
+# app/utils/ratelimit.py
+#
+# Shared quota limiter and retry for Google API calls (Sheets, Drive).
+# Every worker takes tokens from the same Redis-backed bucket per API, so a
+# burst of receipts is spread over the per-minute quota instead of failing
+# with 429. Calls that still fail with a retryable error are retried with
+# jittered exponential backoff, honoring Retry-After when Google sends one.
+
+import os
+import time
+import random
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from googleapiclient.errors import HttpError
+
+from app.utils.metrics import observe_ratelimit_wait
+from app.utils.outbound import CircuitOpenError, circuit
+from app.utils.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Requests per minute and burst size per API. Defaults sit below the
+# per-project quotas (Sheets: 60 writes/min/user, Drive: far higher).
+QUOTAS = {
+    "sheets": (float(os.getenv("SHEETS_RATE_PER_MIN", "55")), float(os.getenv("SHEETS_BURST", "10"))),
+    "drive": (float(os.getenv("DRIVE_RATE_PER_MIN", "600")), float(os.getenv("DRIVE_BURST", "50"))),
+}
+
+MAX_ATTEMPTS = int(os.getenv("GOOGLE_API_MAX_ATTEMPTS", "6"))
+BACKOFF_BASE_S = float(os.getenv("GOOGLE_API_BACKOFF_BASE_S", "1"))
+BACKOFF_MAX_S = float(os.getenv("GOOGLE_API_BACKOFF_MAX_S", "64"))
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded"}
+
+KEY_PREFIX = "google_ratelimit"
+
+# Reserve `requested` tokens and return how long the caller must wait for them.
+# Tokens may go negative: later callers queue behind earlier reservations
+# instead of all waking up at once. A pause key (set after a 429) holds
+# everyone back until the time Google asked for.
+_RESERVE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - requested
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 60000)
+local wait = 0
+if tokens < 0 then wait = -tokens / rate end
+local pause = tonumber(redis.call('GET', KEYS[2]) or '0')
+if pause - now > wait then wait = pause - now end
+return tostring(wait)
+"""
+
+
+class _LocalBucket:
+    """Per-process fallback when Redis is unreachable (same reservation rule)."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.ts, self.pause = burst, time.time(), 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, requested: float = 1.0) -> float:
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + max(0.0, now - self.ts) * self.rate) - requested
+            self.ts = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.pause - now)
+
+
+_script = None
+_local: Dict[str, _LocalBucket] = {}
+_stats: Dict[str, Dict[str, float]] = {}
+_stats_lock = threading.Lock()
+
+
+def _reserve_script(client):
+    global _script
+    if _script is None:
+        _script = client.register_script(_RESERVE_SCRIPT)
+    return _script
+
+
+def _record(api: str, key: str, value: float):
+    with _stats_lock:
+        stats = _stats.setdefault(api, {"calls": 0, "wait_s_total": 0.0, "wait_s_max": 0.0,
+                                        "retries": 0, "rate_limited": 0, "failures": 0})
+        if key == "wait_s":
+            stats["calls"] += 1
+            stats["wait_s_total"] += value
+            stats["wait_s_max"] = max(stats["wait_s_max"], value)
+        else:
+            stats[key] += value
+    client = get_redis()
+    if client is not None:
+        try:
+            client.hincrbyfloat(f"{KEY_PREFIX}:stats:{api}", key, value)
+        except Exception:
+            pass
+
+
+def limiter_stats() -> Dict[str, Dict[str, float]]:
+    """Limiter wait time and retry counters for this process, per API."""
+    with _stats_lock:
+        return {api: dict(stats) for api, stats in _stats.items()}
+
+
+def acquire(api: str, tokens: float = 1.0) -> float:
+    """Block until `api` has quota for one call. Returns the seconds waited."""
+    rate_per_min, burst = QUOTAS[api]
+    rate = rate_per_min / 60.0
+    wait = None
+    client = get_redis()
+    if client is not None:
+        try:
+            wait = float(_reserve_script(client)(keys=[f"{KEY_PREFIX}:{api}", f"{KEY_PREFIX}:{api}:pause"],
+                                 args=[rate, burst, time.time(), tokens], client=client))
+        except Exception as e:
+            logger.warning(f"Rate limiter: Redis call failed ({e}), using per-process limits")
+    if wait is None:
+        wait = _local.setdefault(api, _LocalBucket(rate, burst)).reserve(tokens)
+
+    if wait > 0:
+        logger.info(f"⏳ {api} quota: waiting {wait:.2f}s")
+        time.sleep(wait)
+    _record(api, "wait_s", wait)
+    observe_ratelimit_wait(api, wait)
+    return wait
+
+
+def _pause_all(api: str, seconds: float):
+    """Tell every worker to hold `api` calls for `seconds` (after a 429 with a retry hint)."""
+    until = time.time() + seconds
+    client = get_redis()
+    if client is not None:
+        try:
+            client.set(f"{KEY_PREFIX}:{api}:pause", until, px=int(seconds * 1000) + 1000)
+            return
+        except Exception:
+            pass
+    bucket = _local.get(api)
+    if bucket is not None:
+        bucket.pause = max(bucket.pause, until)
+
+
+def _retry_after(error: HttpError) -> Optional[float]:
+    try:
+        value = error.resp.get("retry-after")
+        return float(value) if value is not None else None
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _is_rate_limited(error: HttpError) -> bool:
+    status = getattr(error.resp, "status", None)
+    if status == 429:
+        return True
+    if status == 403:
+        return any(reason in str(error) for reason in RATE_LIMIT_REASONS)
+    return False
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, HttpError):
+        return getattr(error.resp, "status", None) in RETRYABLE_STATUS or _is_rate_limited(error)
+    return isinstance(error, OSError)  # connection resets, socket timeouts
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff; a server retry hint is used as the floor."""
+    delay = random.uniform(0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def execute(request: Any, api: str, max_attempts: int = MAX_ATTEMPTS, tokens: float = 1.0) -> Any:
+    """
+    Run a googleapiclient request under the shared quota for `api`
+    ("sheets" or "drive"), retrying retryable failures with backoff.
+    A batch request should pass tokens=<number of calls in the batch>.
+    Raises the last error once attempts are exhausted, or CircuitOpenError
+    at once while the API's circuit breaker is open (outbound.py).
+    """
+    breaker = circuit(api)
+    for attempt in range(max_attempts):
+        if breaker.is_open():
+            raise CircuitOpenError(api, breaker.opened_at + breaker.reset_s - time.time())
+        acquire(api, tokens)
+        try:
+            return breaker.call(request.execute)
+        except CircuitOpenError:
+            _record(api, "failures", 1)
+            raise
+        except Exception as e:
+            if not _is_retryable(e) or attempt == max_attempts - 1:
+                _record(api, "failures", 1)
+                raise
+            retry_after = _retry_after(e) if isinstance(e, HttpError) else None
+            if isinstance(e, HttpError) and _is_rate_limited(e):
+                _record(api, "rate_limited", 1)
+                if retry_after:
+                    _pause_all(api, retry_after)
+            delay = backoff_delay(attempt, retry_after)
+            _record(api, "retries", 1)
+            logger.warning(f"{api} call failed ({e}); retry {attempt + 1}/{max_attempts - 1} in {delay:.1f}s")
+            time.sleep(delay)
@@ -0,0 +1,265 @@
+
+# app/utils/receipt_store.py
+#
+# Local indexed copy of every receipt written to the sheet, so lookups like
+# "was this operation number already paid?" or "total per supplier today"
+# take milliseconds and cost no Google quota, however many botnogal_<n>
+# tabs the sheet has. SQLite (WAL) next to the outbox.
+#
+#   python -m app.utils.receipt_store tx 94kvgo
+#   python -m app.utils.receipt_store cuit 20123456786
+#   python -m app.utils.receipt_store totals 2025-10-31
+#   python -m app.utils.receipt_store backfill <spreadsheet_id> [botnogal]
+
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from app.utils.parser import amount_value
+
+logger = logging.getLogger(__name__)
+
+STORE_PATH = os.getenv(
+    "RECEIPT_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "receipts.sqlite3")
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    id                 INTEGER PRIMARY KEY AUTOINCREMENT,
+    idem_key           TEXT NOT NULL UNIQUE,
+    message_id         TEXT,
+    receipt_date       TEXT,      -- YYYY-MM-DD
+    amount             TEXT,      -- as written to the sheet ("10.000,00")
+    amount_value       REAL,
+    sender_cuit        TEXT,      -- digits only
+    transaction_number TEXT,      -- lower-case, alphanumerics only
+    supplier           TEXT,
+    destination_bank   TEXT,
+    whatsapp_group     TEXT,
+    sent_at            TEXT,
+    image_link         TEXT,
+    payment_key        TEXT,      -- see app/utils/dedup.py
+    duplicate_of       TEXT,      -- idem_key of the original receipt
+    created_at         REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS receipts_tx       ON receipts (transaction_number);
+CREATE INDEX IF NOT EXISTS receipts_cuit     ON receipts (sender_cuit, receipt_date);
+CREATE INDEX IF NOT EXISTS receipts_date     ON receipts (receipt_date);
+CREATE INDEX IF NOT EXISTS receipts_supplier ON receipts (supplier, receipt_date);
+CREATE INDEX IF NOT EXISTS receipts_amount   ON receipts (amount_value);
+"""
+
+# Columns added after the first release, created on existing databases at connect time
+_ADDED_COLUMNS = {"payment_key": "TEXT", "duplicate_of": "TEXT"}
+_ADDED_INDEXES = "CREATE INDEX IF NOT EXISTS receipts_payment ON receipts (payment_key, id);"
+
+_local = threading.local()
+
+
+def _connect(path: Optional[str] = None) -> sqlite3.Connection:
+    """One connection per thread (and per forked worker process)."""
+    path = path or STORE_PATH
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid() and _local.path == path:
+        return conn
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(receipts)")}
+    for column, kind in _ADDED_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f"ALTER TABLE receipts ADD COLUMN {column} {kind}")
+    conn.executescript(_ADDED_INDEXES)
+    conn.row_factory = sqlite3.Row
+    _local.conn, _local.pid, _local.path = conn, os.getpid(), path
+    return conn
+
+
+def norm_transaction(value: Any) -> Optional[str]:
+    value = re.sub(r"[^0-9a-z]", "", str(value or "").lower())
+    return value or None
+
+
+def norm_cuit(value: Any) -> Optional[str]:
+    value = re.sub(r"\D", "", str(value or ""))
+    return value or None
+
+
+def norm_date(value: Any) -> Optional[str]:
+    """'2025-10-31', '31/10/2025' or '31-10-2025' -> '2025-10-31'."""
+    value = str(value or "").strip()[:10]
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(value, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return value or None
+
+
+def norm_amount(amount: Any) -> Optional[float]:
+    if amount in (None, ""):
+        return None
+    if isinstance(amount, (int, float)):
+        return float(amount)
+    return amount_value(str(amount))
+
+
+def record_receipt(idem_key: str, extracted_data: Dict[str, Any], metadata: Dict[str, Any],
+                   payment_key: Optional[str] = None, duplicate_of: Optional[str] = None) -> bool:
+    """Store one receipt (same values as its sheet row). Returns False if idem_key is already stored."""
+    cur = _connect().execute(
+        "INSERT OR IGNORE INTO receipts (idem_key, message_id, receipt_date, amount, amount_value, sender_cuit, "
+        "transaction_number, supplier, destination_bank, whatsapp_group, sent_at, image_link, "
+        "payment_key, duplicate_of, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            idem_key,
+            metadata.get("message_id"),
+            norm_date(extracted_data.get("Receipt_Date")),
+            extracted_data.get("Amount"),
+            norm_amount(extracted_data.get("Amount")),
+            norm_cuit(extracted_data.get("Sender_CUIT")),
+            norm_transaction(extracted_data.get("Transaction_Number")),
+            extracted_data.get("Supplier"),
+            extracted_data.get("Destination_Bank"),
+            metadata.get("group_name") or extracted_data.get("WhatsApp_Group"),
+            str(metadata.get("sent_at") or extracted_data.get("Receipt_Sent_Time") or ""),
+            extracted_data.get("image_URL") or "",
+            payment_key,
+            duplicate_of,
+            time.time(),
+        )
+    )
+    return cur.rowcount == 1
+
+
+def set_image_link(idem_key: str, image_link: str):
+    _connect().execute("UPDATE receipts SET image_link=? WHERE idem_key=?", (image_link, idem_key))
+
+
+def _rows(sql: str, params: tuple = ()) -> List[Dict[str, Any]]:
+    return [dict(r) for r in _connect().execute(sql, params).fetchall()]
+
+
+def find_by_transaction(transaction_number: str) -> List[Dict[str, Any]]:
+    return _rows("SELECT * FROM receipts WHERE transaction_number = ? ORDER BY id",
+                 (norm_transaction(transaction_number),))
+
+
+def find_original_payment(payment_key: str) -> Optional[Dict[str, Any]]:
+    """First receipt stored with this payment key, if any."""
+    rows = _rows("SELECT * FROM receipts WHERE payment_key = ? ORDER BY id LIMIT 1", (payment_key,))
+    return rows[0] if rows else None
+
+
+def iter_payment_keys():
+    """(payment_key, receipt) for the first receipt of every payment key."""
+    conn = _connect()
+    for row in conn.execute("SELECT * FROM receipts WHERE payment_key IS NOT NULL AND duplicate_of IS NULL ORDER BY id"):
+        yield row["payment_key"], dict(row)
+
+
+def find_by_cuit(sender_cuit: str, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                 limit: int = 100) -> List[Dict[str, Any]]:
+    return query(sender_cuit=sender_cuit, date_from=date_from, date_to=date_to, limit=limit)
+
+
+def query(transaction_number: Optional[str] = None, sender_cuit: Optional[str] = None,
+          supplier: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None,
+          min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+          limit: int = 100) -> List[Dict[str, Any]]:
+    """Receipts matching every given filter, newest first. Dates are inclusive (YYYY-MM-DD)."""
+    where, params = [], []
+    if transaction_number:
+        where.append("transaction_number = ?")
+        params.append(norm_transaction(transaction_number))
+    if sender_cuit:
+        where.append("sender_cuit = ?")
+        params.append(norm_cuit(sender_cuit))
+    if supplier:
+        where.append("supplier = ?")
+        params.append(supplier)
+    if date_from:
+        where.append("receipt_date >= ?")
+        params.append(norm_date(date_from))
+    if date_to:
+        where.append("receipt_date <= ?")
+        params.append(norm_date(date_to))
+    if min_amount is not None:
+        where.append("amount_value >= ?")
+        params.append(min_amount)
+    if max_amount is not None:
+        where.append("amount_value <= ?")
+        params.append(max_amount)
+    sql = "SELECT * FROM receipts"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY receipt_date DESC, id DESC LIMIT ?"
+    return _rows(sql, (*params, limit))
+
+
+def totals_by_supplier(date_from: str, date_to: Optional[str] = None) -> List[Dict[str, Any]]:
+    """[{"supplier", "receipts", "total"}] for receipts dated in [date_from, date_to]."""
+    return _rows(
+        "SELECT supplier, COUNT(*) AS receipts, ROUND(SUM(amount_value), 2) AS total FROM receipts "
+        "WHERE receipt_date BETWEEN ? AND ? GROUP BY supplier ORDER BY total DESC",
+        (norm_date(date_from), norm_date(date_to or date_from))
+    )
+
+
+def backfill_from_sheet(spreadsheet_id: str, sheet_base_name: str = "botnogal") -> int:
+    """Load every '<base>' / '<base>_<n>' tab into the store (idempotent). Returns rows added."""
+    from app.utils.gsheet import get_sheets_service, SHEET_HEADERS
+    from app.utils.ratelimit import execute
+    from app.utils.dedup import payment_key
+
+    service = get_sheets_service()
+    spreadsheet = execute(service.spreadsheets().get(spreadsheetId=spreadsheet_id), "sheets")
+    titles = [s["properties"]["title"] for s in spreadsheet.get("sheets", [])]
+    titles = [t for t in titles if t == sheet_base_name or re.fullmatch(re.escape(sheet_base_name) + r"_\d+", t)]
+
+    added = 0
+    for title in titles:
+        result = execute(service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id, range=f"{title}!A2:Z"), "sheets")
+        for n, values in enumerate(result.get("values", []), start=2):
+            row = dict(zip(SHEET_HEADERS, values + [""] * (len(SHEET_HEADERS) - len(values))))
+            extracted = dict(row, image_URL=row.get("Image_Link"))
+            metadata = {"group_name": row.get("WhatsApp_Group"), "sent_at": row.get("Receipt_Sent_Time")}
+            key = payment_key(extracted)
+            original = find_original_payment(key) if key else None
+            # Rows written by the outbox carry their idempotency key in the hidden column
+            idem_key = values[len(SHEET_HEADERS)] if len(values) > len(SHEET_HEADERS) else ""
+            added += record_receipt(idem_key or f"sheet:{title}:{n}", extracted, metadata, payment_key=key,
+                                    duplicate_of=original["idem_key"] if original else None)
+        logger.info(f"Backfilled {title}")
+    return added
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    command, args = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else ("help", [])
+    start = time.perf_counter()
+    if command == "tx" and args:
+        out = find_by_transaction(args[0])
+    elif command == "cuit" and args:
+        out = find_by_cuit(args[0], *args[1:3])
+    elif command == "totals" and args:
+        out = totals_by_supplier(*args[:2])
+    elif command == "backfill" and args:
+        out = {"added": backfill_from_sheet(*args[:2])}
+    else:
+        print("usage: python -m app.utils.receipt_store tx <number> | cuit <cuit> [from] [to] | totals <from> [to] | backfill <spreadsheet_id> [base]")
+        sys.exit(1)
+    print(json.dumps(out, indent=2, ensure_ascii=False, default=str))
+    print(f"({(time.perf_counter() - start) * 1000:.1f} ms)", file=sys.stderr)
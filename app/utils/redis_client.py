@@ -0,0 +1,34 @@
+
+# app/utils/redis_client.py
+
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.environ.get("REDIS_URL", os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/0"))
+
+_redis = None
+_redis_failed_at = 0.0
+
+
+def get_redis():
+    """
+    Shared Redis client for this process, or None if Redis is unreachable.
+    After a failure, connecting is retried at most once a minute.
+    """
+    global _redis, _redis_failed_at
+    if _redis is not None:
+        return _redis
+    if time.time() - _redis_failed_at < 60:
+        return None
+    try:
+        import redis
+        client = redis.Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+        client.ping()
+        _redis = client
+    except Exception as e:
+        _redis_failed_at = time.time()
+        logger.warning(f"Redis unavailable ({e}), falling back to local state")
+    return _redis
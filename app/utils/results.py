@@ -0,0 +1,200 @@
+
+# app/utils/results.py
+#
+# Per-receipt result store: status, timestamps, stage durations and the
+# extracted fields, kept in Redis for a day and keyed by WhatsApp message id.
+# The webhook marks a receipt "queued", the task "processing" and then "ok"
+# or a failure reason. GET /receipts/{message_id} (main.py) reads it, and
+# load_webhook.py uses it to see where the time went.
+#
+#   receipt_result:<message_id> = {"status", "received_at", "queued_at", "started_at", "done_at",
+#                                  "trace_id", "<stage>_ms", ..., "fields": <JSON>}
+#
+# Every status change is also published on the channel of the same name, so
+# waiting clients (long-poll, SSE) are woken up instead of polling.
+
+import os
+import json
+import time
+import logging
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from app.utils.redis_client import get_redis, REDIS_URL
+from app.utils.metrics import observe_stage
+from app.utils.tracing import Trace
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "receipt_result"
+TTL_S = int(os.getenv("RECEIPT_RESULT_TTL_S", str(24 * 3600)))
+PENDING_STATES = ("queued", "processing")
+
+# Extracted fields returned to clients (same names as the sheet columns)
+RESULT_FIELDS = ["Receipt_Date", "Amount", "Sender_CUIT", "Transaction_Number", "Supplier",
+                 "Destination_Bank", "WhatsApp_Group", "Receipt_Sent_Time", "image_URL", "Duplicate_Of"]
+
+
+class StageTimer:
+    """Collects <stage>_ms durations for one receipt (also exported as metrics and trace spans)."""
+
+    def __init__(self, trace: Optional[Trace] = None):
+        self.started_at = time.time()
+        self.stages: Dict[str, float] = {}
+        self.failure: Optional[str] = None   # reason, when the receipt could not be processed
+        self.error: Optional[str] = None     # the error behind it
+        self.resume: Dict[str, Any] = {"stage": "ocr"}   # where a dead-letter replay would pick up
+        self.trace = trace
+
+    @contextmanager
+    def stage(self, name: str):
+        start_wall = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[f"{name}_ms"] = round(elapsed * 1000, 3)
+            observe_stage(name, elapsed)
+            if self.trace is not None:
+                self.trace.add(name, start_wall, start_wall + elapsed)
+
+
+def _key(message_id: str) -> str:
+    return f"{KEY_PREFIX}:{message_id}"
+
+
+def _store(message_id: Optional[str], fields: Dict[str, Any]):
+    """Merge fields into the receipt's hash and notify waiters (no-op without a message_id or Redis)."""
+    client = get_redis()
+    if not message_id or message_id == "N/A" or client is None:
+        return
+    try:
+        key = _key(message_id)
+        pipe = client.pipeline(transaction=False)
+        pipe.hset(key, mapping={k: "" if v is None else v for k, v in fields.items()})
+        pipe.expire(key, TTL_S)
+        pipe.publish(key, fields.get("status", ""))
+        pipe.execute()
+    except Exception as e:
+        logger.debug(f"Could not store result for {message_id}: {e}")
+
+
+def mark_queued(metadata: Dict[str, Any]):
+    _store(metadata.get("message_id"), {
+        "status": "queued",
+        "received_at": metadata.get("received_at"),
+        "queued_at": metadata.get("queued_at"),
+        "trace_id": metadata.get("trace_id"),
+        "group_name": metadata.get("group_name"),
+    })
+
+
+def mark_processing(metadata: Dict[str, Any], timer: StageTimer):
+    _store(metadata.get("message_id"), {"status": "processing", "started_at": timer.started_at})
+
+
+def record(metadata: Dict[str, Any], timer: StageTimer, status: str, result: Optional[Dict[str, Any]] = None):
+    """Store one processed receipt's final status, timings and extracted fields."""
+    fields = {
+        "received_at": metadata.get("received_at"),
+        "queued_at": metadata.get("queued_at"),
+        "started_at": timer.started_at,
+        "done_at": time.time(),
+        "status": status,
+        "trace_id": timer.trace.trace_id if timer.trace else "",
+        **timer.stages,
+    }
+    if result:
+        fields["fields"] = json.dumps({k: result.get(k) for k in RESULT_FIELDS}, ensure_ascii=False, default=str)
+    _store(metadata.get("message_id"), fields)
+
+
+def _decode(raw: Dict[Any, Any]) -> Dict[str, Any]:
+    out = {}
+    for k, v in raw.items():
+        k = k.decode() if isinstance(k, bytes) else k
+        v = v.decode() if isinstance(v, bytes) else v
+        if k == "fields":
+            out[k] = json.loads(v) if v else {}
+            continue
+        try:
+            out[k] = float(v)
+        except ValueError:
+            out[k] = v
+    return out
+
+
+def fetch(message_ids: List[str], client=None) -> Dict[str, Optional[Dict[str, Any]]]:
+    """{message_id: stored result or None if unknown}, numbers as floats."""
+    client = client or get_redis()
+    if client is None:
+        raise RuntimeError("Redis is not reachable")
+    pipe = client.pipeline(transaction=False)
+    for message_id in message_ids:
+        pipe.hgetall(_key(message_id))
+    return {message_id: _decode(raw) if raw else None for message_id, raw in zip(message_ids, pipe.execute())}
+
+
+def is_done(stored: Optional[Dict[str, Any]]) -> bool:
+    return bool(stored) and stored.get("status") not in PENDING_STATES
+
+
+def to_response(message_id: str, stored: Dict[str, Any]) -> Dict[str, Any]:
+    """API view of a stored result."""
+    def ms(a, b):
+        a, b = stored.get(a), stored.get(b)
+        return round((b - a) * 1000, 1) if isinstance(a, float) and isinstance(b, float) else None
+
+    return {
+        "message_id": message_id,
+        "status": stored.get("status"),
+        "done": is_done(stored),
+        "trace_id": stored.get("trace_id") or None,
+        "queue_wait_ms": ms("queued_at", "started_at"),
+        "processing_ms": ms("started_at", "done_at"),
+        "stages_ms": {k[:-3]: v for k, v in stored.items() if k.endswith("_ms")},
+        "fields": stored.get("fields") or {},
+    }
+
+
+# ------------------- Async side (FastAPI) -------------------
+
+_async_redis = None
+
+
+def get_async_redis():
+    """redis.asyncio client for the API's event loop (created on first use)."""
+    global _async_redis
+    if _async_redis is None:
+        import redis.asyncio as aioredis
+        _async_redis = aioredis.Redis.from_url(REDIS_URL, socket_connect_timeout=2)
+    return _async_redis
+
+
+async def fetch_async(message_id: str) -> Optional[Dict[str, Any]]:
+    raw = await get_async_redis().hgetall(_key(message_id))
+    return _decode(raw) if raw else None
+
+
+async def wait_for_change(message_id: str, timeout: float, known_status: Optional[str] = None):
+    """
+    Return the stored result once its status differs from `known_status`
+    (or it is done), or after `timeout` seconds with whatever is stored.
+    """
+    pubsub = get_async_redis().pubsub()
+    await pubsub.subscribe(_key(message_id))
+    try:
+        # Subscribed before reading, so a change in between is not missed
+        stored = await fetch_async(message_id)
+        deadline = time.monotonic() + timeout
+        while not is_done(stored) and (known_status is None or (stored or {}).get("status") == known_status):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await pubsub.get_message(ignore_subscribe_messages=True, timeout=min(remaining, 5.0))
+            stored = await fetch_async(message_id)
+        return stored
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.close()
@@ -0,0 +1,71 @@
+
+# app/utils/sheet_routing.py
+#
+# Which spreadsheet and tab family a receipt row goes to. By default every
+# row goes to SPREADSHEET_ID / botnogal, as before. With SHEET_SHARD_BY set,
+# rows are sharded by WhatsApp group or by supplier: explicit routes come
+# from SHEET_ROUTES (JSON, inline or a file path), and with SHEET_AUTO_TABS=1
+# any other group/supplier gets its own '<base>-<name>' tab family.
+#
+#   SHEET_SHARD_BY=group
+#   SHEET_ROUTES='{"Pagos Ortega": {"spreadsheet_id": "1AbC...", "tab": "ortega"},
+#                  "Tarjeta":      {"tab": "tarjeta"}}'
+#
+# Each (spreadsheet, tab) pair is one shard with its own SheetWriter (gsheet.py)
+# and is delivered by the outbox independently of the others.
+
+import os
+import re
+import json
+import logging
+from typing import Any, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+SHEET_SHARD_BY = os.getenv("SHEET_SHARD_BY", "none").lower()     # none | group | supplier
+SHEET_AUTO_TABS = os.getenv("SHEET_AUTO_TABS", "0") == "1"
+DEFAULT_TAB = os.getenv("SHEET_BASE_NAME", "botnogal")
+
+
+def _load_routes() -> Dict[str, Dict[str, str]]:
+    raw = os.getenv("SHEET_ROUTES", "").strip()
+    if not raw:
+        return {}
+    try:
+        if not raw.startswith("{"):
+            with open(raw, encoding="utf-8") as f:
+                raw = f.read()
+        routes = json.loads(raw)
+    except Exception as e:
+        logger.error(f"Invalid SHEET_ROUTES, sharding disabled: {e}")
+        return {}
+    return {str(k).strip().lower(): v for k, v in routes.items()}
+
+
+SHEET_ROUTES = _load_routes()
+
+
+def _slug(name: str) -> str:
+    return re.sub(r"[^0-9a-z]+", "-", name.lower()).strip("-")[:40]
+
+
+def shard_key(extracted_data: Dict[str, Any], metadata: Dict[str, Any]) -> str:
+    if SHEET_SHARD_BY == "group":
+        return str(metadata.get("group_name") or extracted_data.get("WhatsApp_Group") or "")
+    if SHEET_SHARD_BY == "supplier":
+        return str(extracted_data.get("Supplier") or "")
+    return ""
+
+
+def route_row(extracted_data: Dict[str, Any], metadata: Dict[str, Any],
+              default_spreadsheet_id: str, default_tab: str = DEFAULT_TAB) -> Tuple[str, str]:
+    """(spreadsheet_id, tab base name) for one receipt row."""
+    key = shard_key(extracted_data, metadata).strip()
+    if not key:
+        return default_spreadsheet_id, default_tab
+    route = SHEET_ROUTES.get(key.lower())
+    if route:
+        return route.get("spreadsheet_id") or default_spreadsheet_id, route.get("tab") or default_tab
+    if SHEET_AUTO_TABS and _slug(key):
+        return default_spreadsheet_id, f"{default_tab}-{_slug(key)}"
+    return default_spreadsheet_id, default_tab
@@ -0,0 +1,347 @@
+
+# app/utils/tracing.py
+#
+# Per-receipt traces and opt-in profiling.
+#
+# webhook_receiver starts a trace and passes its context in the task metadata
+# (trace_id, trace_parent). process_receipt adds a root span, a queue_wait
+# span and one span per stage; the Drive upload and the outbox delivery add
+# theirs later, from their own threads. Spans are exported as OTLP/JSON:
+#
+#   OTEL_EXPORTER_OTLP_ENDPOINT=http://localhost:4318   POST <endpoint>/v1/traces (OpenTelemetry collector, Jaeger, Tempo)
+#   TRACE_FILE=app/data/traces.jsonl                    one OTLP/JSON document per line
+#
+# With neither set, trace IDs are still generated and logged, nothing is exported.
+#
+# Profiling is opt-in per task, for a fraction of traffic and/or some groups.
+# It is set in Redis, so it takes effect on running workers:
+#
+#   python -m app.utils.tracing profile --rate 0.05 --ttl 3600
+#   python -m app.utils.tracing profile --groups "Pagos Ortega" --mode cprofile
+#   python -m app.utils.tracing profile --off
+#
+# (or PROFILE_RATE / PROFILE_GROUPS / PROFILE_MODE in the environment).
+# "sample" mode writes <trace_id>.folded (collapsed stacks for flamegraph.pl
+# or speedscope); "cprofile" writes <trace_id>.pstats. Files go to PROFILE_DIR.
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import argparse
+import threading
+import urllib.request
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from app.utils.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "").rstrip("/")
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "whatsapp-receipt-bot")
+EXPORT_ENABLED = bool(OTLP_ENDPOINT or TRACE_FILE)
+EXPORT_BATCH = 200
+EXPORT_INTERVAL_S = 2.0
+
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "profiles")
+)
+PROFILE_CONFIG_KEY = "profile_config"
+PROFILE_SAMPLE_INTERVAL_S = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5")) / 1000
+
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CONSUMER = 1, 2, 5
+STATUS_OK, STATUS_ERROR = 1, 2
+
+
+def new_trace_id() -> str:
+    return os.urandom(16).hex()
+
+
+def new_span_id() -> str:
+    return os.urandom(8).hex()
+
+
+def _attr(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def make_span(trace_id: str, name: str, start: float, end: float, parent: Optional[str] = None,
+              span_id: Optional[str] = None, kind: int = SPAN_KIND_INTERNAL, error: Optional[str] = None,
+              **attributes) -> Dict[str, Any]:
+    """One OTLP/JSON span. start/end are epoch seconds."""
+    span = {
+        "traceId": trace_id,
+        "spanId": span_id or new_span_id(),
+        "name": name,
+        "kind": kind,
+        "startTimeUnixNano": str(int(start * 1e9)),
+        "endTimeUnixNano": str(int(max(end, start) * 1e9)),
+        "attributes": [_attr(k, v) for k, v in attributes.items() if v is not None],
+        "status": {"code": STATUS_ERROR, "message": error} if error else {"code": STATUS_OK},
+    }
+    if parent:
+        span["parentSpanId"] = parent
+    return span
+
+
+# ------------------- Export -------------------
+
+_queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=10000)
+_exporter: Optional[threading.Thread] = None
+_exporter_pid = None
+_exporter_lock = threading.Lock()
+
+
+def _document(spans: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {"resourceSpans": [{
+        "resource": {"attributes": [_attr("service.name", SERVICE_NAME), _attr("process.pid", os.getpid())]},
+        "scopeSpans": [{"scope": {"name": "app.utils.tracing"}, "spans": spans}],
+    }]}
+
+
+def _send(spans: List[Dict[str, Any]]):
+    body = json.dumps(_document(spans)).encode()
+    if OTLP_ENDPOINT:
+        request = urllib.request.Request(f"{OTLP_ENDPOINT}/v1/traces", data=body,
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=5):
+            pass
+    if TRACE_FILE:
+        os.makedirs(os.path.dirname(os.path.abspath(TRACE_FILE)), exist_ok=True)
+        with open(TRACE_FILE, "ab") as f:
+            f.write(body + b"\n")
+
+
+def _export_loop():
+    while True:
+        spans = [_queue.get()]
+        deadline = time.time() + EXPORT_INTERVAL_S
+        while len(spans) < EXPORT_BATCH and time.time() < deadline:
+            try:
+                spans.append(_queue.get(timeout=max(0.0, deadline - time.time())))
+            except queue.Empty:
+                break
+        try:
+            _send(spans)
+        except Exception as e:
+            logger.warning(f"Could not export {len(spans)} span(s): {e}")
+
+
+def export(spans: List[Dict[str, Any]]):
+    """Queue spans for the background exporter of this process (dropped when the queue is full)."""
+    global _exporter, _exporter_pid
+    if not EXPORT_ENABLED or not spans:
+        return
+    with _exporter_lock:
+        if _exporter is None or _exporter_pid != os.getpid() or not _exporter.is_alive():
+            _exporter = threading.Thread(target=_export_loop, name="trace-export", daemon=True)
+            _exporter.start()
+            _exporter_pid = os.getpid()
+    for span in spans:
+        try:
+            _queue.put_nowait(span)
+        except queue.Full:
+            break
+
+
+# ------------------- Per-receipt trace -------------------
+
+class Trace:
+    """Spans of one receipt in one process; parented to the context it was started from."""
+
+    def __init__(self, trace_id: Optional[str] = None, parent: Optional[str] = None):
+        self.trace_id = trace_id or new_trace_id()
+        self.parent = parent
+        self.root_id = new_span_id()
+        self.spans: List[Dict[str, Any]] = []
+
+    @classmethod
+    def from_metadata(cls, metadata: Dict[str, Any]) -> "Trace":
+        return cls(metadata.get("trace_id"), metadata.get("trace_parent"))
+
+    def context(self) -> str:
+        """'<trace_id>:<span_id>' of the root span, for work handed to other threads/processes."""
+        return f"{self.trace_id}:{self.root_id}"
+
+    def add(self, name: str, start: float, end: float, parent: Optional[str] = None, **attributes):
+        """Record a finished span (child of the root span unless `parent` is given)."""
+        self.spans.append(make_span(self.trace_id, name, start, end, parent=parent or self.root_id, **attributes))
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        start = time.time()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.add(name, start, time.time(), error=error, **attributes)
+
+    def finish(self, name: str, start: float, status: str, kind: int = SPAN_KIND_CONSUMER, **attributes):
+        """Close the root span and export everything recorded."""
+        root = make_span(self.trace_id, name, start, time.time(), parent=self.parent, span_id=self.root_id,
+                         kind=kind, error=None if status == "ok" else status, **attributes)
+        export(self.spans + [root])
+
+
+def parse_context(context: Optional[str]):
+    """'<trace_id>:<span_id>' -> (trace_id, span_id), or (None, None)."""
+    if not context or ":" not in context:
+        return None, None
+    trace_id, span_id = context.split(":", 1)
+    return trace_id, span_id
+
+
+def export_child_span(context: Optional[str], name: str, start: float, end: float,
+                      error: Optional[str] = None, **attributes):
+    """Export one span under a context from Trace.context() (e.g. from the uploader or the outbox)."""
+    trace_id, parent = parse_context(context)
+    if trace_id and EXPORT_ENABLED:
+        export([make_span(trace_id, name, start, end, parent=parent, error=error, **attributes)])
+
+
+# ------------------- Profiling -------------------
+
+_profile_config: Dict[str, Any] = {}
+_profile_config_at = 0.0
+
+
+def _load_profile_config() -> Dict[str, Any]:
+    """Profiling settings: Redis (set with the CLI) overrides the environment. Cached for 10 s."""
+    global _profile_config, _profile_config_at
+    if time.time() - _profile_config_at < 10:
+        return _profile_config
+    config = {
+        "rate": float(os.getenv("PROFILE_RATE", "0")),
+        "groups": [g.strip() for g in os.getenv("PROFILE_GROUPS", "").split(",") if g.strip()],
+        "mode": os.getenv("PROFILE_MODE", "sample"),
+    }
+    client = get_redis()
+    if client is not None:
+        try:
+            raw = client.get(PROFILE_CONFIG_KEY)
+            if raw:
+                config.update(json.loads(raw))
+        except Exception:
+            pass
+    _profile_config, _profile_config_at = config, time.time()
+    return config
+
+
+def profile_mode_for(metadata: Dict[str, Any]) -> Optional[str]:
+    """'sample' / 'cprofile' if this task should be profiled, else None."""
+    config = _load_profile_config()
+    selected = metadata.get("group_name") in config["groups"] or random.random() < config["rate"]
+    return config["mode"] if selected else None
+
+
+class SamplingProfiler:
+    """Samples one thread's Python stack every `interval` seconds into collapsed stacks."""
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_SAMPLE_INTERVAL_S):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write_folded(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def maybe_profile(metadata: Dict[str, Any], name: str):
+    """Profile the block if profiling is enabled for this task; output is PROFILE_DIR/<name>.*"""
+    mode = profile_mode_for(metadata)
+    if mode is None:
+        yield
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if mode == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = os.path.join(PROFILE_DIR, f"{name}.pstats")
+            profiler.dump_stats(path)
+            logger.info(f"🔬 Profile written to {path}")
+        return
+    sampler = SamplingProfiler(threading.get_ident())
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        path = os.path.join(PROFILE_DIR, f"{name}.folded")
+        sampler.write_folded(path)
+        logger.info(f"🔬 Profile written to {path} ({sum(sampler.stacks.values())} samples)")
+
+
+def set_profile_config(rate: float = 0.0, groups: Optional[List[str]] = None, mode: str = "sample",
+                       ttl_s: int = 3600):
+    client = get_redis()
+    if client is None:
+        raise RuntimeError("Redis is not reachable; use PROFILE_RATE / PROFILE_GROUPS instead")
+    client.set(PROFILE_CONFIG_KEY, json.dumps({"rate": rate, "groups": groups or [], "mode": mode}), ex=ttl_s)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    ap = argparse.ArgumentParser(prog="python -m app.utils.tracing")
+    sub = ap.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("profile", help="profile a fraction of tasks and/or some groups on all workers")
+    p.add_argument("--rate", type=float, default=0.0, help="fraction of tasks to profile (0-1)")
+    p.add_argument("--groups", default="", help="comma-separated WhatsApp group names to always profile")
+    p.add_argument("--mode", choices=["sample", "cprofile"], default="sample")
+    p.add_argument("--ttl", type=int, default=3600, help="seconds until profiling switches itself off")
+    p.add_argument("--off", action="store_true", help="stop profiling")
+    args = ap.parse_args()
+
+    if args.off:
+        client = get_redis()
+        if client is not None:
+            client.delete(PROFILE_CONFIG_KEY)
+        print("Profiling off (environment settings still apply)")
+    else:
+        groups = [g.strip() for g in args.groups.split(",") if g.strip()]
+        set_profile_config(args.rate, groups, args.mode, args.ttl)
+        print(f"Profiling {args.rate:.0%} of tasks and groups {groups or '-'} ({args.mode}) for {args.ttl}s; "
+              f"output in {PROFILE_DIR}")
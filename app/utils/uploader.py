@@ -0,0 +1,224 @@
+
+# app/utils/uploader.py
+#
+# Drive uploads off the OCR critical path. process_receipt spools the image
+# bytes to disk, gets the file's link up front from a pre-allocated Drive
+# file ID, and hands the upload to a small thread pool. The sheet row is
+# written with that link right away. If no ID could be allocated the row goes
+# out with an empty link, which is patched (outbox.set_cell) once the upload
+# finishes. Spooled jobs survive a worker restart and are resumed at startup.
+#
+# The pool lives in whichever process queued the upload, usually a prefork
+# child, and children exit routinely (worker_max_memory_per_child, pool_shrink).
+# Each job therefore carries a lease, renewed at every attempt. The worker's
+# main process re-submits jobs whose lease has run out (start_spool_watcher),
+# so uploads of a child that went away are finished within UPLOAD_LEASE_S.
+# A retried upload with a pre-allocated file ID is a no-op in Drive.
+
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+from app.utils.deadletter import capture as capture_dead_letter, resolve as resolve_dead_letter
+from app.utils.drive import allocate_file_id, file_link, upload_file_and_get_link
+from app.utils.metrics import timed, count_failure
+from app.utils.tracing import export_child_span
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.getenv(
+    "UPLOAD_SPOOL_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "upload_spool")
+)
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+MAX_UPLOAD_ATTEMPTS = int(os.getenv("UPLOAD_MAX_ATTEMPTS", "5"))
+UPLOAD_LEASE_S = float(os.getenv("UPLOAD_LEASE_S", "300"))     # > one attempt's timeout plus backoff
+SPOOL_WATCH_S = float(os.getenv("UPLOAD_SPOOL_WATCH_S", "60"))
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    """One pool per process (a pool inherited through fork has no threads)."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="drive-upload")
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _job_paths(job_id: str):
+    safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in job_id)
+    base = os.path.join(SPOOL_DIR, safe)
+    return base + ".img", base + ".json"
+
+
+def _write_job(job_path: str, job: Dict[str, Any]):
+    """Atomic rewrite: the spool watcher may read the job at any time."""
+    tmp = f"{job_path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(job, f)
+    os.replace(tmp, job_path)
+
+
+def submit_upload(image_bytes: bytes, dest_name: str, supplier_folder: Optional[str], idem_key: str,
+                  mimetype: Optional[str] = None, trace: Optional[str] = None) -> str:
+    """
+    Queue an image for upload and return its link: the final Drive link when a
+    file ID could be pre-allocated, otherwise "" (patched in the sheet later).
+    """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    file_id = allocate_file_id()
+    image_path, job_path = _job_paths(idem_key)
+    with open(image_path, "wb") as f:
+        f.write(image_bytes)
+    job = {
+        "idem_key": idem_key,
+        "dest_name": dest_name,
+        "mimetype": mimetype,
+        "supplier_folder": supplier_folder,
+        "file_id": file_id,
+        "attempts": 0,
+        "queued_at": time.time(),
+        "lease_until": time.time() + UPLOAD_LEASE_S,
+        "trace": trace,
+    }
+    _write_job(job_path, job)
+
+    _get_pool().submit(_run, job_path)
+    return file_link(file_id) if file_id else ""
+
+
+def _run(job_path: str):
+    try:
+        with open(job_path, encoding="utf-8") as f:
+            job: Dict[str, Any] = json.load(f)
+    except FileNotFoundError:
+        return  # already done by another process resuming the spool
+    image_path = job_path[:-len(".json")] + ".img"
+
+    link = ""
+    started = time.perf_counter()
+    started_at = time.time()
+    while job["attempts"] < MAX_UPLOAD_ATTEMPTS:
+        job["attempts"] += 1
+        job["lease_until"] = time.time() + UPLOAD_LEASE_S
+        _write_job(job_path, job)
+        try:
+            with timed("drive_upload"):
+                link = upload_file_and_get_link(
+                    local_path=image_path,
+                    dest_name=job["dest_name"],
+                    supplier_folder=job["supplier_folder"],
+                    file_id=job["file_id"],
+                    mimetype=job.get("mimetype"),
+                )
+        except Exception as e:
+            # Would otherwise vanish into the pool's future, leaving the job leased
+            logger.error(f"Drive upload attempt {job['attempts']} for {job['idem_key']} failed: {e}")
+            link = ""
+        if link:
+            break
+        time.sleep(min(60, 2 ** job["attempts"]))
+
+    export_child_span(job.get("trace"), "drive_upload", started_at, time.time(),
+                      error=None if link else "upload failed", attempts=job["attempts"],
+                      queued_s=round(started_at - job["queued_at"], 3))
+    if not link:
+        count_failure("drive_upload")
+        job["lease_until"] = None   # dead-lettered: left to replays, not to the spool watcher
+        _write_job(job_path, job)
+        logger.error(f"Drive upload for {job['idem_key']} failed {job['attempts']} times, kept in {SPOOL_DIR}")
+        capture_dead_letter(job["idem_key"], "upload", "drive_upload", error=f"failed {job['attempts']} times",
+                            blob=image_path, payload={"job_path": job_path})
+        return
+
+    logger.info(f"✅ Uploaded {job['idem_key']} in {time.perf_counter() - started:.2f}s "
+                f"(queued {time.time() - job['queued_at']:.1f}s ago)")
+    if not job["file_id"]:
+        # The row was written without a link; fill it in now
+        from app.utils.outbox import set_cell
+        from app.utils.receipt_store import set_image_link
+        try:
+            set_cell(job["idem_key"], "Image_Link", link)
+            set_image_link(job["idem_key"], link)
+        except Exception as e:
+            logger.error(f"Uploaded {job['idem_key']} but could not patch its link ({link}): {e}")
+    for path in (image_path, job_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    resolve_dead_letter(job["idem_key"], ("upload",))
+
+
+def retry_spooled(job_path: str):
+    """Give a spooled upload a fresh set of attempts."""
+    with open(job_path, encoding="utf-8") as f:
+        job = json.load(f)
+    job["attempts"] = 0
+    job["lease_until"] = time.time() + UPLOAD_LEASE_S
+    _write_job(job_path, job)
+    _get_pool().submit(_run, job_path)
+
+
+def resume_spool() -> int:
+    """Re-submit uploads left in the spool by a previous process. Returns the number queued."""
+    if not os.path.isdir(SPOOL_DIR):
+        return 0
+    jobs = [os.path.join(SPOOL_DIR, n) for n in sorted(os.listdir(SPOOL_DIR)) if n.endswith(".json")]
+    for job_path in jobs:
+        retry_spooled(job_path)
+    if jobs:
+        logger.info(f"Resumed {len(jobs)} spooled Drive upload(s)")
+    return len(jobs)
+
+
+def resume_stale(now: Optional[float] = None) -> int:
+    """Re-submit live jobs whose lease ran out (their process went away). Returns the number queued."""
+    if not os.path.isdir(SPOOL_DIR):
+        return 0
+    now = now or time.time()
+    resumed = 0
+    for name in os.listdir(SPOOL_DIR):
+        if not name.endswith(".json"):
+            continue
+        job_path = os.path.join(SPOOL_DIR, name)
+        try:
+            with open(job_path, encoding="utf-8") as f:
+                job = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue   # finished meanwhile
+        lease_until = job.get("lease_until", 0)
+        if lease_until is None or lease_until > now:
+            continue
+        job["lease_until"] = now + UPLOAD_LEASE_S
+        _write_job(job_path, job)
+        _get_pool().submit(_run, job_path)
+        resumed += 1
+    if resumed:
+        logger.warning(f"Resumed {resumed} Drive upload(s) abandoned by an exited worker process")
+    return resumed
+
+
+def run_spool_watcher(stop: Optional[threading.Event] = None):
+    stop = stop or threading.Event()
+    while not stop.wait(SPOOL_WATCH_S):
+        try:
+            resume_stale()
+        except Exception as e:
+            logger.error(f"Upload spool watch failed: {e}")
+
+
+def start_spool_watcher() -> threading.Event:
+    """Run the watcher in a daemon thread (worker main process); set the returned event to stop it."""
+    stop = threading.Event()
+    threading.Thread(target=run_spool_watcher, args=(stop,), name="upload-spool-watcher", daemon=True).start()
+    return stop
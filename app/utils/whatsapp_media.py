@@ -0,0 +1,144 @@
+
+# app/utils/whatsapp_media.py
+#
+# WhatsApp Cloud API media download for the webhook, on the event loop:
+#
+#   1. GET /<version>/<media_id> for the media's download URL, size and type.
+#      Lookups are cached (process and Redis) for MEDIA_URL_TTL_S, below the
+#      five minutes Graph keeps a URL valid, so a redelivered webhook or a
+#      retry does not look the media up again.
+#   2. GET <url>, streamed in chunks to a .part file and renamed into place,
+#      so the image is never held in memory whole and a half-written file is
+#      never seen under its final name. Oversized media are refused from the
+#      looked-up size or Content-Length before any byte is downloaded.
+#
+# Both calls share outbound.py's pooled httpx client (keep-alive to
+# graph.facebook.com and the media CDN), timeouts and "graph" circuit breaker.
+
+import os
+import json
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from app.utils.imageprobe import IMAGE_MAX_BYTES
+from app.utils.outbound import async_client, circuit
+from app.utils.results import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+MEDIA_URL_TTL_S = int(os.getenv("MEDIA_URL_TTL_S", "240"))
+CHUNK_BYTES = 64 * 1024
+_LOCAL_CACHE_SIZE = 1024
+
+KEY_PREFIX = "wa_media"
+
+_local_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+
+class MediaTooLarge(ValueError):
+    """The media is over IMAGE_MAX_BYTES; nothing (more) is downloaded."""
+
+
+# ------------------- URL lookup cache -------------------
+
+async def _cached(media_id: str) -> Optional[Dict[str, Any]]:
+    hit = _local_cache.get(media_id)
+    if hit and hit[0] > time.time():
+        return hit[1]
+    try:
+        raw = await get_async_redis().get(f"{KEY_PREFIX}:{media_id}")
+    except Exception as e:
+        logger.debug(f"Media URL cache unavailable: {e}")
+        return None
+    if not raw:
+        return None
+    info = json.loads(raw)
+    _remember_locally(media_id, info)
+    return info
+
+
+def _remember_locally(media_id: str, info: Dict[str, Any]):
+    _local_cache[media_id] = (time.time() + MEDIA_URL_TTL_S, info)
+    _local_cache.move_to_end(media_id)
+    while len(_local_cache) > _LOCAL_CACHE_SIZE:
+        _local_cache.popitem(last=False)
+
+
+async def _remember(media_id: str, info: Dict[str, Any]):
+    _remember_locally(media_id, info)
+    try:
+        await get_async_redis().set(f"{KEY_PREFIX}:{media_id}", json.dumps(info), ex=MEDIA_URL_TTL_S)
+    except Exception as e:
+        logger.debug(f"Media URL cache unavailable: {e}")
+
+
+async def _forget(media_id: str):
+    _local_cache.pop(media_id, None)
+    try:
+        await get_async_redis().delete(f"{KEY_PREFIX}:{media_id}")
+    except Exception:
+        pass
+
+
+# ------------------- Graph calls -------------------
+
+async def lookup(media_id: str, graph_url: str, headers: Dict[str, str], refresh: bool = False) -> Dict[str, Any]:
+    """Graph media object ({"url", "mime_type", "file_size", "sha256", ...}), cached."""
+    info = None if refresh else await _cached(media_id)
+    if info is None:
+        async def get():
+            response = await async_client("graph").get(f"{graph_url}/{media_id}", headers=headers)
+            response.raise_for_status()
+            return response.json()
+        info = await circuit("graph").acall(get)
+        await _remember(media_id, info)
+    return info
+
+
+async def _stream_to(url: str, dest_path: str, headers: Dict[str, str], max_bytes: int) -> int:
+    part_path = dest_path + ".part"
+    size = 0
+    try:
+        async with async_client("graph").stream("GET", url, headers=headers) as response:
+            response.raise_for_status()
+            length = int(response.headers.get("content-length") or 0)
+            if length > max_bytes:
+                raise MediaTooLarge(f"media is {length / 1048576:.1f} MB, limit {max_bytes / 1048576:.0f} MB")
+            with open(part_path, "wb") as f:
+                async for chunk in response.aiter_bytes(CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise MediaTooLarge(f"media exceeds the {max_bytes / 1048576:.0f} MB limit")
+                    f.write(chunk)
+        os.replace(part_path, dest_path)
+        return size
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+async def download(media_id: str, dest_path: str, token: str, graph_url: str,
+                   max_bytes: int = IMAGE_MAX_BYTES) -> Dict[str, Any]:
+    """
+    Download a WhatsApp media object to dest_path. Returns {"size", "mime_type",
+    "sha256"}. Raises MediaTooLarge, CircuitOpenError or the httpx error.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    info = await lookup(media_id, graph_url, headers)
+    for attempt in (1, 2):
+        declared = int(info.get("file_size") or 0)
+        if declared > max_bytes:
+            raise MediaTooLarge(f"media is {declared / 1048576:.1f} MB, limit {max_bytes / 1048576:.0f} MB")
+        try:
+            size = await circuit("graph").acall(lambda: _stream_to(info["url"], dest_path, headers, max_bytes))
+            return {"size": size, "mime_type": info.get("mime_type"), "sha256": info.get("sha256")}
+        except Exception as e:
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            if attempt == 2 or status not in (401, 403, 404):
+                raise
+            # A cached URL that has expired: look it up again once
+            logger.info(f"Media URL for {media_id} expired ({status}), looking it up again")
+            await _forget(media_id)
+            info = await lookup(media_id, graph_url, headers, refresh=True)
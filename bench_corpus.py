@@ -0,0 +1,403 @@
+
+# bench_corpus.py
+#
+# Golden-corpus benchmark: runs the receipt images in incoming/ through
+# decode -> OCR -> field extraction and scores the result against a labeled
+# ground-truth file. Prints a summary and writes machine-readable JSON so
+# engines, preprocessing modes and parser changes can be compared.
+#
+#   python bench_corpus.py --init-truth golden.jsonl            # draft labels from current output, then fix by hand
+#   python bench_corpus.py --truth golden.jsonl --out run.json  # full run (PaddleOCR pipeline)
+#   python bench_corpus.py --engine paddle-split --out split.json   # separate detection / recognition timings
+#   python bench_corpus.py --engine stored --out parser.json        # parser only, replays stored OCR results
+#   python bench_corpus.py --compare run.json --out new.json        # print deltas against a previous run
+#
+# Ground truth is JSONL, one object per image:
+#   {"image": "1761917221806_AC35....jpg", "Amount": "10.000,00", "Receipt_Date": "2025-10-31",
+#    "Sender_CUIT": "20123456786", "Transaction_Number": "94kvgo", "Supplier": "Ortega", "Destination_Bank": "Galicia"}
+# Fields that are missing from a label are not scored for that image; null means
+# the receipt does not show the field. golden.jsonl labels every image in
+# incoming/ by hand, as the sheet should have it (Transaction_Number is the last
+# six characters, lowercased; Receipt_Date is the receipt's own date, never the
+# parser's fallback to today).
+
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from app.utils.ocr import load_stored_ocr, parse_paddle_result, receipt_id_from_path, stored_ocr_index
+from app.utils.parser import amount_value, clean_ocr_text, detect_supplier, extract_fields, build_confidence_index
+
+INCOMING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "incoming")
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden.jsonl")
+FIELDS = ["Amount", "Receipt_Date", "Sender_CUIT", "Transaction_Number", "Supplier", "Destination_Bank"]
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".webp")
+
+logger = logging.getLogger("bench_corpus")
+
+
+# ---------------------------------------------------------------------------
+# Field comparison
+# ---------------------------------------------------------------------------
+
+def _digits(value) -> str:
+    return re.sub(r"\D", "", str(value or ""))
+
+
+def _alnum(value) -> str:
+    return re.sub(r"[^0-9a-z]", "", str(value or "").lower())
+
+
+def _amount(value) -> Optional[float]:
+    return amount_value(str(value)) if value not in (None, "") else None
+
+
+NORMALIZERS: Dict[str, Callable[[Any], Any]] = {
+    "Amount": _amount,
+    "Receipt_Date": lambda v: str(v or "").strip(),
+    "Sender_CUIT": _digits,
+    "Transaction_Number": _alnum,
+    "Supplier": lambda v: str(v or "").strip().lower(),
+    "Destination_Bank": lambda v: str(v or "").strip().lower(),
+}
+
+
+def field_matches(field: str, expected, predicted) -> bool:
+    normalize = NORMALIZERS[field]
+    return normalize(expected) == normalize(predicted)
+
+
+# ---------------------------------------------------------------------------
+# Engines: each returns {"lines", "scores"} and fills timings[stage] in ms
+# ---------------------------------------------------------------------------
+
+def _preprocess(img, mode: str, max_side: int):
+    import cv2
+
+    if mode in ("gray", "binarize"):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if mode == "binarize":
+            gray = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+        img = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+    if max_side and max(img.shape[:2]) > max_side:
+        scale = max_side / float(max(img.shape[:2]))
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return img
+
+
+class PaddlePipelineEngine:
+    """The same PaddleOCR pipeline the worker uses; detection and recognition timed together."""
+
+    name = "paddle"
+    stages = ["decode", "ocr"]
+
+    def __init__(self, preprocess: str, max_side: int):
+        import paddleocr
+        from paddleocr import PaddleOCR
+
+        self.preprocess, self.max_side = preprocess, max_side
+        self.version = getattr(paddleocr, "__version__", None)
+        self.ocr = PaddleOCR(use_angle_cls=False, lang="es")
+
+    def run(self, path: str, timings: Dict[str, float]) -> Dict[str, Any]:
+        import cv2
+
+        start = time.perf_counter()
+        img = _preprocess(cv2.imread(path), self.preprocess, self.max_side)
+        timings["decode"] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        result = self.ocr.ocr(img)
+        timings["ocr"] = (time.perf_counter() - start) * 1000
+        return parse_paddle_result(result)
+
+
+class PaddleSplitEngine:
+    """PaddleOCR detection and recognition modules called separately, so each stage is timed."""
+
+    name = "paddle-split"
+    stages = ["decode", "detection", "recognition"]
+
+    def __init__(self, preprocess: str, max_side: int, det_model: Optional[str], rec_model: Optional[str]):
+        import paddleocr
+        from paddleocr import TextDetection, TextRecognition
+
+        self.preprocess, self.max_side = preprocess, max_side
+        self.version = getattr(paddleocr, "__version__", None)
+        self.det = TextDetection(model_name=det_model) if det_model else TextDetection()
+        self.rec = TextRecognition(model_name=rec_model) if rec_model else TextRecognition()
+
+    def run(self, path: str, timings: Dict[str, float]) -> Dict[str, Any]:
+        import cv2
+        import numpy as np
+
+        start = time.perf_counter()
+        img = _preprocess(cv2.imread(path), self.preprocess, self.max_side)
+        timings["decode"] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        det = self.det.predict(img)
+        polys = list(det[0]["dt_polys"]) if det else []
+        timings["detection"] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        crops, boxes = [], []
+        for poly in polys:
+            x, y, w, h = cv2.boundingRect(np.asarray(poly, dtype=np.int32))
+            if w > 0 and h > 0:
+                crops.append(img[y:y + h, x:x + w])
+                boxes.append([x, y, x + w, y + h])
+        recs = self.rec.predict(crops) if crops else []
+        # Reading order: top-to-bottom, then left-to-right
+        order = sorted(range(len(recs)), key=lambda i: (boxes[i][1], boxes[i][0]))
+        lines = [recs[i]["rec_text"] for i in order]
+        scores = [float(recs[i]["rec_score"]) for i in order]
+        timings["recognition"] = (time.perf_counter() - start) * 1000
+        return {"lines": lines, "scores": scores, "boxes": [boxes[i] for i in order]}
+
+
+class StoredEngine:
+    """Replays OCR results already stored next to the images (parser-only runs, no models)."""
+
+    name = "stored"
+    stages = ["decode"]
+    version = None
+
+    def __init__(self, directory: str):
+        self.paths = stored_ocr_index(directory)
+
+    def run(self, path: str, timings: Dict[str, float]) -> Optional[Dict[str, Any]]:
+        start = time.perf_counter()
+        stored = self.paths.get(receipt_id_from_path(path))
+        result = load_stored_ocr(stored) if stored else None
+        timings["decode"] = (time.perf_counter() - start) * 1000
+        return result
+
+
+# ---------------------------------------------------------------------------
+# Corpus and reporting
+# ---------------------------------------------------------------------------
+
+def load_truth(path: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    truth = {}
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    truth[receipt_id_from_path(entry["image"])] = entry
+    return truth
+
+
+def list_images(directory: str, limit: Optional[int]) -> List[str]:
+    names = sorted(n for n in os.listdir(directory) if n.lower().endswith(IMAGE_SUFFIXES))
+    paths = [os.path.join(directory, n) for n in names]
+    return paths[:limit] if limit else paths
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def _stats(values: List[float]) -> Dict[str, Any]:
+    return {
+        "n": len(values),
+        "mean_ms": round(sum(values) / len(values), 3) if values else None,
+        "p50_ms": round(percentile(values, 50), 3) if values else None,
+        "p95_ms": round(percentile(values, 95), 3) if values else None,
+        "max_ms": round(max(values), 3) if values else None,
+    }
+
+
+def run_image(engine, path: str) -> Dict[str, Any]:
+    timings: Dict[str, float] = {}
+    record: Dict[str, Any] = {"receipt_id": receipt_id_from_path(path), "image": os.path.basename(path)}
+    start = time.perf_counter()
+    try:
+        ocr = engine.run(path, timings)
+    except Exception as e:
+        record.update({"error": f"{type(e).__name__}: {e}", "timings_ms": timings})
+        return record
+    if not ocr:
+        record.update({"error": "no OCR result", "timings_ms": timings})
+        return record
+
+    extract_start = time.perf_counter()
+    cleaned = clean_ocr_text(ocr["lines"])
+    fields = extract_fields(cleaned, detect_supplier(cleaned),
+                            confidence=build_confidence_index(ocr["lines"], ocr.get("scores")))
+    timings["extraction"] = (time.perf_counter() - extract_start) * 1000
+    timings["total"] = (time.perf_counter() - start) * 1000
+
+    record.update({
+        "lines": len(ocr["lines"]),
+        "fields": {k: fields.get(k) for k in FIELDS},
+        "timings_ms": {k: round(v, 3) for k, v in timings.items()},
+    })
+    return record
+
+
+def summarize(records: List[Dict[str, Any]], truth: Dict[str, Dict[str, Any]],
+              stages: List[str], wall_s: float) -> Dict[str, Any]:
+    ok = [r for r in records if "error" not in r]
+    latency = {stage: _stats([r["timings_ms"][stage] for r in ok if stage in r["timings_ms"]])
+               for stage in stages + ["extraction", "total"]}
+
+    accuracy = {}
+    for field in FIELDS:
+        labeled = correct = 0
+        for r in records:
+            label = truth.get(r["receipt_id"])
+            if not label or field not in label:
+                continue
+            labeled += 1
+            predicted = r.get("fields", {}).get(field)
+            match = "error" not in r and field_matches(field, label[field], predicted)
+            correct += match
+            if not match:
+                r.setdefault("mismatches", {})[field] = {"expected": label[field], "predicted": predicted}
+        accuracy[field] = {
+            "labeled": labeled,
+            "correct": correct,
+            "accuracy": round(correct / labeled, 4) if labeled else None,
+        }
+
+    return {
+        "images": len(records),
+        "errors": len(records) - len(ok),
+        "labeled_images": sum(1 for r in records if r["receipt_id"] in truth),
+        "wall_s": round(wall_s, 3),
+        "images_per_s": round(len(records) / wall_s, 3) if wall_s else None,
+        "latency": latency,
+        "accuracy": accuracy,
+    }
+
+
+def print_summary(summary: Dict[str, Any], previous: Optional[Dict[str, Any]] = None):
+    def delta(new, old, fmt):
+        if new is None or old is None:
+            return ""
+        return f" ({new - old:+{fmt}})"
+
+    prev = previous or {}
+    print(f"{summary['images']} images ({summary['errors']} errors, {summary['labeled_images']} labeled) "
+          f"in {summary['wall_s']:.2f}s -> {summary['images_per_s'] or 0:.2f} images/s"
+          f"{delta(summary['images_per_s'], prev.get('images_per_s'), '.2f')}")
+    print(f"{'stage':<14} {'p50 ms':>10} {'p95 ms':>10} {'mean ms':>10}")
+    for stage, s in summary["latency"].items():
+        if not s["n"]:
+            continue
+        old = prev.get("latency", {}).get(stage, {})
+        print(f"{stage:<14} {s['p50_ms']:>10.2f} {s['p95_ms']:>10.2f} {s['mean_ms']:>10.2f}"
+              f"{delta(s['p95_ms'], old.get('p95_ms'), '.2f')}")
+    print(f"{'field':<20} {'accuracy':>9} {'correct':>9}")
+    for field, a in summary["accuracy"].items():
+        if not a["labeled"]:
+            continue
+        old = prev.get("accuracy", {}).get(field, {})
+        print(f"{field:<20} {a['accuracy']:>9.1%} {a['correct']:>4}/{a['labeled']:<4}"
+              f"{delta(a['accuracy'], old.get('accuracy'), '.1%')}")
+
+
+def write_truth_draft(path: str, records: List[Dict[str, Any]]):
+    with open(path, "w", encoding="utf-8") as f:
+        for r in records:
+            if "fields" in r:
+                f.write(json.dumps(dict({"image": r["image"]}, **r["fields"]), ensure_ascii=False) + "\n")
+    print(f"✅ wrote draft labels for {sum(1 for r in records if 'fields' in r)} images to {path} (review before use)")
+
+
+def build_engine(args):
+    if args.engine == "stored":
+        return StoredEngine(args.dir)
+    if args.engine == "paddle-split":
+        return PaddleSplitEngine(args.preprocess, args.max_side, args.det_model, args.rec_model)
+    return PaddlePipelineEngine(args.preprocess, args.max_side)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Accuracy and latency benchmark over the receipt image corpus.")
+    ap.add_argument("--dir", default=INCOMING_DIR, help="directory with receipt images")
+    ap.add_argument("--truth", default=GOLDEN_PATH, help="ground-truth labels (JSONL)")
+    ap.add_argument("--engine", choices=["paddle", "paddle-split", "stored"], default="paddle")
+    ap.add_argument("--preprocess", choices=["none", "gray", "binarize"], default="none")
+    ap.add_argument("--max-side", type=int, default=0, help="downscale images so the longest side is at most N px")
+    ap.add_argument("--det-model", help="detection model name for --engine paddle-split")
+    ap.add_argument("--rec-model", help="recognition model name for --engine paddle-split")
+    ap.add_argument("--warmup", type=int, default=1, help="images run before timing starts")
+    ap.add_argument("--limit", type=int, help="only the first N images")
+    ap.add_argument("--label", help="free-form name for this run, stored in the results")
+    ap.add_argument("--out", help="write results (config, summary, per-image records) as JSON")
+    ap.add_argument("--compare", help="previous results JSON to print deltas against")
+    ap.add_argument("--init-truth", metavar="PATH", help="write current predictions as a draft ground-truth file")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("app").setLevel(logging.ERROR)
+
+    truth = load_truth(args.truth)
+    images = list_images(args.dir, args.limit)
+    if not images:
+        print(f"❌ no images in {args.dir}")
+        sys.exit(1)
+
+    load_start = time.perf_counter()
+    engine = build_engine(args)
+    model_load_s = time.perf_counter() - load_start
+
+    for path in images[:args.warmup]:
+        run_image(engine, path)
+
+    records = []
+    start = time.perf_counter()
+    for path in images:
+        records.append(run_image(engine, path))
+    wall_s = time.perf_counter() - start
+
+    summary = summarize(records, truth, engine.stages, wall_s)
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f).get("summary")
+    print_summary(summary, previous)
+
+    if args.out:
+        results = {
+            "config": {
+                "label": args.label,
+                "engine": engine.name,
+                "engine_version": engine.version,
+                "preprocess": args.preprocess,
+                "max_side": args.max_side,
+                "det_model": args.det_model,
+                "rec_model": args.rec_model,
+                "truth": args.truth if truth else None,
+                "model_load_s": round(model_load_s, 3),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "summary": summary,
+            "records": records,
+        }
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"✅ results written to {args.out}")
+
+    if args.init_truth:
+        write_truth_draft(args.init_truth, records)
+
+
+if __name__ == "__main__":
+    main()
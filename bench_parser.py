@@ -0,0 +1,127 @@
+
+# bench_parser.py
+#
+# Worst-case timing for the receipt field extractor (app/utils/parser.py).
+# Feeds real OCR dumps from incoming/ plus adversarial and oversized text
+# through extract_fields() and fails if any field goes over its time budget.
+#
+#   python bench_parser.py                 # run all cases
+#   python bench_parser.py --size 200000   # bigger adversarial inputs
+#   python bench_parser.py --legacy        # also time the old unbounded patterns
+
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+import logging
+
+from app.utils.parser import extract_fields, FIELD_BUDGET_MS, MAX_TEXT_CHARS
+
+logging.disable(logging.WARNING)
+
+INCOMING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "incoming")
+
+# Patterns as they were before the backtracking guard, kept for comparison only.
+LEGACY_PATTERNS = {
+    'amount': r'(?:(?:IMPORTE|PESOS|MONTO|TOTAL|PAGO)\s*[:$]?\s*|[\$])?\s*(\d+(?:[.,]\d+)+)(?:\s*[\$]|\s*|\s*\d+)?',
+    'alphanumeric_op': r'(?:C[oó]digo\s+de\s+transacci[oó]n|C[oó]digo\s+de\s+identificaci[oó]n|referencia|control|id Op.|transacci[oó]n:|operation|operaci[oó]n:|C[oó]mprobante|transacci[oó]n|Ref.)\s*[:\-]?\s*'
+                       r'(?=[A-Za-z0-9\s\n\-]*[A-Za-z])(?=[A-Za-z0-9\s\n\-]*[0-9])'
+                       r'([A-Za-z0-9\s\n\-]{5,36})',
+    'bank_ciudad': r'(?:banco\s+destino|para|banco)\s*[:\-]?\s*([a-z\s\n]+ciudad[a-z\s\n]*?)',
+}
+
+
+def load_corpus():
+    """Plain-text OCR dumps from incoming/ (skips empty files and raw result reprs)."""
+    texts = []
+    for path in sorted(glob.glob(os.path.join(INCOMING_DIR, "*.txt"))):
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            text = f.read()
+        if text.strip() and not text.startswith("{"):
+            texts.append(text)
+    return texts
+
+
+def adversarial_cases(size, corpus):
+    """Inputs built to trigger backtracking in the old patterns."""
+    real = " ".join(corpus) or "Comprobante 123456 $ 1.000,00"
+    return {
+        "alnum_run_after_labels": ("control " + "A" * 30 + " ") * (size // 40),
+        "repeated_labels_no_digit": "referencia control " * (size // 19),
+        "long_digit_run": "$ " + "1" * size,
+        "digits_with_trailing_sep": ("1" * 50 + ". ") * (size // 52),
+        "para_letters_no_ciudad": "para " + "a" * size,
+        "repeated_month_prefix": "1 ene" * (size // 5),
+        "oversized_real_corpus": (real + " ") * max(1, size // max(1, len(real))),
+    }
+
+
+def run_case(name, text, repeat):
+    worst = {}
+    for _ in range(repeat):
+        report = {}
+        extract_fields(re.sub(r'\s+', ' ', text).strip(), report=report)
+        for field, ms in report.get("timings", {}).items():
+            worst[field] = max(worst.get(field, 0.0), ms)
+    return worst
+
+
+def time_legacy(text, limit):
+    text = text[:limit]
+    out = {}
+    for name, pattern in LEGACY_PATTERNS.items():
+        start = time.perf_counter()
+        re.search(pattern, text, re.I | re.S)
+        out[name] = (time.perf_counter() - start) * 1000
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Worst-case timing for the receipt field extractor.")
+    ap.add_argument("--size", type=int, default=50000, help="characters per adversarial input")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--legacy", action="store_true", help="also time the pre-guard patterns")
+    ap.add_argument("--legacy-limit", type=int, default=5000,
+                    help="truncate inputs for the legacy run (they are quadratic)")
+    args = ap.parse_args()
+
+    corpus = load_corpus()
+    print(f"corpus: {len(corpus)} OCR dumps | text cap {MAX_TEXT_CHARS} chars | budget {FIELD_BUDGET_MS:.0f} ms/field")
+
+    cases = {f"corpus[{i}]": t for i, t in enumerate(corpus)}
+    cases.update(adversarial_cases(args.size, corpus))
+
+    over_budget = []
+    corpus_worst = {}
+    for name, text in cases.items():
+        worst = run_case(name, text, args.repeat)
+        for field, ms in worst.items():
+            if ms > FIELD_BUDGET_MS:
+                over_budget.append((name, field, ms))
+        if name.startswith("corpus["):
+            for field, ms in worst.items():
+                corpus_worst[field] = max(corpus_worst.get(field, 0.0), ms)
+            continue
+        slowest = max(worst.items(), key=lambda kv: kv[1])
+        print(f"{name:<28} {len(text):>9} chars  slowest {slowest[0]:<18} {slowest[1]:8.3f} ms")
+        if args.legacy:
+            for pattern, ms in time_legacy(text, args.legacy_limit).items():
+                print(f"{'':<28} legacy {pattern:<18} {ms:8.3f} ms (first {args.legacy_limit} chars)")
+
+    if corpus_worst:
+        print("corpus worst case per field:")
+        for field, ms in sorted(corpus_worst.items()):
+            print(f"  {field:<20} {ms:8.3f} ms")
+
+    if over_budget:
+        print("❌ over budget:")
+        for name, field, ms in over_budget:
+            print(f"  {name}: {field} {ms:.1f} ms")
+        sys.exit(1)
+    print("✅ all fields within budget")
+
+
+if __name__ == "__main__":
+    main()
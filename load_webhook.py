@@ -0,0 +1,226 @@
+
+# load_webhook.py
+#
+# Load generator: replays the receipt images in incoming/ against /webhook in
+# the listener's payload shape and reports how the stack keeps up. Requests
+# are sent open-loop (on a fixed schedule, whether or not earlier requests
+# have returned), so a slow server shows up as latency instead of quietly
+# lowering the offered rate.
+#
+#   python load_webhook.py --rate 2 --duration 60                      # constant 2 receipts/s for a minute
+#   python load_webhook.py --profile burst --burst-size 50 --bursts 4 --burst-interval 30
+#   python load_webhook.py --rate 5 --duration 120 --groups 8 --out load.json
+#
+# Ingest latency is measured by this script. Queue wait, per-stage times and
+# completion come from the result each worker writes to Redis
+# (app/utils/results.py), so REDIS_URL must point at the stack's Redis and the
+# clocks of this machine and the workers must agree (same host, or NTP).
+# For runs without Google/WhatsApp access start the stack with FAKE_GOOGLE=1
+# (app/utils/fakes.py).
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from app.utils.fakes import listener_payload, media_files
+from app.utils.results import fetch as fetch_timings, is_done
+
+INCOMING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "incoming")
+STAGES = ["decode", "ocr", "archive", "upload_submit", "extract", "dedup", "commit"]
+
+_session = threading.local()
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def _stats(values: List[float]) -> Dict[str, Any]:
+    return {
+        "n": len(values),
+        "mean_ms": round(sum(values) / len(values), 3) if values else None,
+        "p50_ms": round(percentile(values, 50), 3) if values else None,
+        "p95_ms": round(percentile(values, 95), 3) if values else None,
+        "p99_ms": round(percentile(values, 99), 3) if values else None,
+        "max_ms": round(max(values), 3) if values else None,
+    }
+
+
+def schedule(args) -> List[float]:
+    """Send offsets in seconds from the start of the run."""
+    if args.profile == "burst":
+        return [b * args.burst_interval for b in range(args.bursts) for _ in range(args.burst_size)]
+    count = args.count or int(args.rate * args.duration)
+    return [i / args.rate for i in range(count)]
+
+
+def send(url: str, payload: Dict[str, Any], intended_at: float, timeout: float) -> Dict[str, Any]:
+    session = getattr(_session, "session", None)
+    if session is None:
+        session = _session.session = requests.Session()
+    sent_at = time.time()
+    record = {"message_id": payload["message_id"], "intended_at": intended_at, "sent_at": sent_at}
+    try:
+        response = session.post(url, json=payload, timeout=timeout)
+        record["status"] = response.status_code
+    except requests.RequestException as e:
+        record["status"] = None
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["responded_at"] = time.time()
+    return record
+
+
+def run(args) -> List[Dict[str, Any]]:
+    images = media_files(args.dir)
+    if args.limit:
+        images = images[:args.limit]
+    if not images:
+        sys.exit(f"No images in {args.dir}")
+    corpus = []
+    for path in images:
+        with open(path, "rb") as f:
+            corpus.append(f.read())
+
+    offsets = schedule(args)
+    run_id = uuid.uuid4().hex[:8].upper()
+    print(f"Run {run_id}: {len(offsets)} request(s) to {args.url} ({args.profile}), "
+          f"{len(corpus)} distinct image(s)")
+
+    # Payloads are built up front so encoding does not eat into the send schedule
+    payloads = [
+        listener_payload(corpus[i % len(corpus)], message_id=f"LOAD{run_id}{i:06d}",
+                         group_name=f"Load Test {i % args.groups + 1}")
+        for i in range(len(offsets))
+    ]
+
+    records = []
+    start = time.time() + 0.5
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = []
+        for offset, payload in zip(offsets, payloads):
+            intended_at = start + offset
+            delay = intended_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(send, args.url, payload, intended_at, args.timeout))
+        records = [f.result() for f in futures]
+    return records
+
+
+def wait_for_completion(records: List[Dict[str, Any]], wait_s: float, poll_s: float = 1.0):
+    """Poll worker timings until every accepted request has finished or wait_s passes."""
+    pending = {r["message_id"]: r for r in records if r.get("status") == 200}
+    deadline = time.time() + wait_s
+    while pending and time.time() < deadline:
+        ids = list(pending)
+        for start in range(0, len(ids), 500):
+            for message_id, timings in fetch_timings(ids[start:start + 500]).items():
+                if is_done(timings):
+                    pending.pop(message_id)["timings"] = timings
+        if pending:
+            print(f"\r  waiting for {len(pending)} receipt(s)...", end="", file=sys.stderr)
+            time.sleep(poll_s)
+    print(file=sys.stderr)
+
+
+def summarize(records: List[Dict[str, Any]], args) -> Dict[str, Any]:
+    accepted = [r for r in records if r.get("status") == 200]
+    done = [r for r in accepted if "timings" in r]
+    ok = [r for r in done if r["timings"].get("status") == "ok"]
+    first = min((r["intended_at"] for r in records), default=0)
+    send_s = max((r["intended_at"] for r in records), default=first) - first
+    last_done = max((r["timings"]["done_at"] for r in done), default=first)
+
+    def ms(a, b):
+        return (b - a) * 1000
+
+    latency = {
+        # Measured from the scheduled send time, so client-side lag counts too
+        "ingest": _stats([ms(r["intended_at"], r["responded_at"]) for r in accepted]),
+        "queue_wait": _stats([ms(r["timings"]["queued_at"], r["timings"]["started_at"])
+                              for r in done if isinstance(r["timings"].get("queued_at"), float)]),
+        "processing": _stats([ms(r["timings"]["started_at"], r["timings"]["done_at"]) for r in done]),
+        "end_to_end": _stats([ms(r["intended_at"], r["timings"]["done_at"]) for r in done]),
+    }
+    for stage in STAGES:
+        latency[stage] = _stats([r["timings"][f"{stage}_ms"] for r in done if f"{stage}_ms" in r["timings"]])
+
+    statuses: Dict[str, int] = {}
+    for r in records:
+        key = str(r.get("status") or "error")
+        statuses[key] = statuses.get(key, 0) + 1
+
+    return {
+        "profile": args.profile,
+        "requests": len(records),
+        "http_status": statuses,
+        "offered_rate_per_s": round(len(records) / send_s, 3) if send_s else None,
+        "completed": len(done),
+        "completed_ok": len(ok),
+        "completion_rate": round(len(done) / len(accepted), 4) if accepted else None,
+        "throughput_per_s": round(len(done) / (last_done - first), 3) if done and last_done > first else None,
+        "latency": latency,
+    }
+
+
+def print_summary(summary: Dict[str, Any]):
+    print(f"{summary['requests']} requests ({summary['profile']}, offered "
+          f"{summary['offered_rate_per_s'] or 0:.2f}/s), HTTP {summary['http_status']}")
+    print(f"completed {summary['completed']} ({summary['completed_ok']} ok), completion rate "
+          f"{(summary['completion_rate'] or 0):.1%}, throughput {summary['throughput_per_s'] or 0:.2f} receipts/s")
+    print(f"{'stage':<14} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+    for stage, s in summary["latency"].items():
+        if not s["n"]:
+            continue
+        print(f"{stage:<14} {s['p50_ms']:>10.1f} {s['p95_ms']:>10.1f} {s['p99_ms']:>10.1f} {s['max_ms']:>10.1f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Open-loop load generator for the /webhook endpoint.")
+    ap.add_argument("--url", default=os.getenv("WEBHOOK_URL", "http://127.0.0.1:8000/webhook"))
+    ap.add_argument("--dir", default=INCOMING_DIR, help="directory with receipt images to replay")
+    ap.add_argument("--limit", type=int, help="only use the first N images")
+    ap.add_argument("--profile", choices=["constant", "burst"], default="constant")
+    ap.add_argument("--rate", type=float, default=1.0, help="requests per second (constant profile)")
+    ap.add_argument("--duration", type=float, default=30.0, help="seconds (constant profile)")
+    ap.add_argument("--count", type=int, help="total requests instead of rate x duration (constant profile)")
+    ap.add_argument("--burst-size", type=int, default=20, help="requests sent at once (burst profile)")
+    ap.add_argument("--bursts", type=int, default=3, help="number of bursts (burst profile)")
+    ap.add_argument("--burst-interval", type=float, default=30.0, help="seconds between bursts (burst profile)")
+    ap.add_argument("--groups", type=int, default=1, help="spread requests over N WhatsApp group names")
+    ap.add_argument("--concurrency", type=int, default=64, help="max requests in flight")
+    ap.add_argument("--timeout", type=float, default=30.0, help="HTTP timeout per request (s)")
+    ap.add_argument("--wait", type=float, default=300.0, help="seconds to wait for workers to finish")
+    ap.add_argument("--no-wait", action="store_true", help="report ingest latency only")
+    ap.add_argument("--out", help="write summary and per-request records as JSON")
+    args = ap.parse_args()
+
+    records = run(args)
+    if not args.no_wait:
+        try:
+            wait_for_completion(records, args.wait)
+        except Exception as e:
+            print(f"Cannot read worker timings ({e}); reporting ingest latency only", file=sys.stderr)
+    summary = summarize(records, args)
+    print_summary(summary)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "summary": summary, "records": records}, f, indent=2, default=str)
+        print(f"✅ wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+
+# reparse.py
+#
+# Re-run field extraction over OCR results already stored in incoming/
+# (no OCR models involved) and show which fields changed per receipt.
+#
+#   python reparse.py --out results.jsonl                      # first run: write a baseline
+#   python reparse.py --baseline results.jsonl --out new.jsonl  # after a parser change: diff
+#   python reparse.py --baseline results.jsonl --push-sheet botnogal
+#
+# --push-sheet writes the changed cells into each receipt's original sheet row,
+# found through the outbox (app/utils/outbox.py) or, for rows it no longer
+# holds, the row key column of the given tab family. Receipts whose row is not
+# found are listed and left alone.
+#
+# A Receipt_Date that is extract_date's fallback to today (no date on the
+# receipt) is not a change: it is never diffed or pushed.
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from app.utils.ocr import iter_stored_ocr, load_stored_ocr
+from app.utils.parser import extract_receipt
+
+INCOMING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "incoming")
+FIELDS = ["Receipt_Date", "Amount", "Sender_CUIT", "Transaction_Number", "Supplier", "Destination_Bank"]
+
+
+def _quiet_worker():
+    logging.disable(logging.WARNING)
+
+
+def reparse_one(path):
+    """Worker: stored OCR file -> (receipt_id, fields, date_fallback) or None."""
+    ocr = load_stored_ocr(path)
+    if ocr is None:
+        return None
+    report = {}
+    fields = extract_receipt(ocr["lines"], ocr["scores"], report=report)
+    return ocr["receipt_id"], {k: fields.get(k) for k in FIELDS}, report["date_fallback"]
+
+
+def load_baseline(path):
+    """{receipt_id: entry}; entries are {"receipt_id", "fields", "date_fallback"} (older files lack the flag)."""
+    baseline = {}
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    baseline[entry["receipt_id"]] = entry
+    return baseline
+
+
+def diff_fields(old, fields, date_fallback):
+    """{field: (old, new)} for the fields that changed; fallback dates on either side are not compared."""
+    skip = set()
+    if date_fallback or old.get("date_fallback"):
+        skip.add("Receipt_Date")
+    return {k: (old["fields"].get(k), fields.get(k)) for k in FIELDS
+            if k not in skip and old["fields"].get(k) != fields.get(k)}
+
+
+def original_rows(receipt_ids, spreadsheet_id, sheet_base_name):
+    """{receipt_id: (spreadsheet_id, '<tab>!<row number>')} for the receipts whose sheet row is found."""
+    from app.utils.gsheet import row_keys
+    from app.utils.outbox import sheet_position
+
+    rows, missing = {}, []
+    for receipt_id in receipt_ids:
+        # '<epoch ms>_<message id>' as written by the listener; the message id is the row's key
+        message_id = receipt_id.partition("_")[2] or receipt_id
+        position = sheet_position(message_id)
+        if position:
+            rows[receipt_id] = position
+        else:
+            missing.append((receipt_id, message_id))
+    if missing:
+        keys = row_keys(spreadsheet_id, sheet_base_name)
+        for receipt_id, message_id in missing:
+            if message_id in keys:
+                rows[receipt_id] = (spreadsheet_id, keys[message_id])
+    return rows
+
+
+def push_changes(changes, spreadsheet_id, sheet_base_name, batch_size):
+    """Write each receipt's changed fields into its original row. Returns (cells written, receipts not found)."""
+    from app.utils.gsheet import SHEET_HEADERS, update_cells
+
+    rows = original_rows(list(changes), spreadsheet_id, sheet_base_name)
+    cells = {}
+    for receipt_id, diff in changes.items():
+        if receipt_id not in rows:
+            continue
+        sheet_id, sheet_row = rows[receipt_id]
+        tab, number = sheet_row.rsplit("!", 1)
+        for field, (_, value) in diff.items():
+            column = chr(ord("A") + SHEET_HEADERS.index(field))
+            cells.setdefault(sheet_id, {})[f"{tab}!{column}{number}"] = "" if value is None else value
+    written = sum(update_cells(sheet_id, sheet_cells, batch_size) for sheet_id, sheet_cells in cells.items())
+    return written, [r for r in changes if r not in rows]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Re-extract receipt fields from stored OCR results.")
+    ap.add_argument("--dir", default=INCOMING_DIR, help="directory with stored OCR results")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--chunksize", type=int, default=16)
+    ap.add_argument("--baseline", help="previous results (JSONL) to diff against")
+    ap.add_argument("--out", help="write new results as JSONL")
+    ap.add_argument("--push-sheet", metavar="BASE",
+                    help="write changed fields into the receipts' original rows (BASE: tab family to search)")
+    ap.add_argument("--batch-size", type=int, default=500, help="cells per Sheets update call")
+    ap.add_argument("--spreadsheet-id", default=os.environ.get("SPREADSHEET_ID"))
+    args = ap.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    paths = list(iter_stored_ocr(args.dir))
+    out = open(args.out, "w", encoding="utf-8") if args.out else None
+
+    start = time.perf_counter()
+    total = changed = 0
+    corrected = {}
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_quiet_worker) as pool:
+        for item in pool.map(reparse_one, paths, chunksize=args.chunksize):
+            if item is None:
+                continue
+            receipt_id, fields, date_fallback = item
+            total += 1
+            if out:
+                out.write(json.dumps({"receipt_id": receipt_id, "fields": fields, "date_fallback": date_fallback},
+                                     ensure_ascii=False) + "\n")
+
+            old = baseline.get(receipt_id)
+            if old is None:
+                continue
+            diff = diff_fields(old, fields, date_fallback)
+            if diff:
+                changed += 1
+                print(receipt_id)
+                for k, (a, b) in diff.items():
+                    print(f"  {k}: {a!r} -> {b!r}")
+                corrected[receipt_id] = diff
+    if out:
+        out.close()
+    elapsed = time.perf_counter() - start
+
+    print(f"{total} receipts reparsed in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.0f}/s), "
+          f"{changed} changed vs baseline ({len(baseline)} in baseline)")
+
+    if args.push_sheet and corrected:
+        if not args.spreadsheet_id:
+            print("❌ --push-sheet needs --spreadsheet-id or SPREADSHEET_ID")
+            sys.exit(1)
+        written, not_found = push_changes(corrected, args.spreadsheet_id, args.push_sheet, args.batch_size)
+        print(f"✅ wrote {written} changed cell(s) to {len(corrected) - len(not_found)} original row(s)")
+        if not_found:
+            print(f"⚠️ no sheet row found for {len(not_found)} receipt(s), left alone: {' '.join(not_found)}")
+
+
+if __name__ == "__main__":
+    main()